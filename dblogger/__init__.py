@@ -102,6 +102,25 @@
     In this last case, :mod:`dblogger <dblogger.query>` can print out
     the saved log messages.
 
+    To keep logging calls from ever waiting on a slow database, bound
+    the database handler's queue and choose what to drop when it is
+    full:
+
+    .. code-block:: yaml
+
+        logging:
+          handlers:
+            dblogger:
+              class: dblogger.DatabaseLogHandler
+              storage_config: *kvlayer
+              queue_size: 10000
+              overflow: drop_below
+              overflow_level: WARNING
+
+    The ``overflow`` policy may be ``drop_newest``, ``drop_oldest``,
+    ``drop_below``, or ``block`` (with a ``block_timeout`` in seconds);
+    see :mod:`dblogger.writer`.
+
     For further details about what is allowed, see the Python library
     :mod:`logging.config` documentation.
 
@@ -0,0 +1,831 @@
+'''Benchmarks for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:program:`dblogger-benchmark` measures the logging path against an
+in-memory or file-backed :mod:`kvlayer` backend, so it needs no
+database server and its numbers reflect :mod:`dblogger` itself rather
+than the network.
+
+.. program:: dblogger-benchmark
+
+.. option:: emit
+
+    Time :meth:`logging.Logger.log` calls through a
+    :class:`~dblogger.DatabaseLogHandler`, for every combination of
+    :option:`--sizes`, :option:`--threads`, :option:`--processes`,
+    and with and without exception tracebacks.  For each, this
+    reports records per second, the 50th, 99th, and 99.9th percentile
+    latency of a single call, stored bytes and rows per record, the
+    net number of :mod:`gc` tracked objects each call leaves behind,
+    and peak resident memory.
+
+.. option:: query
+
+    Fill the backend with :option:`--records` generated records,
+    spread over the last :option:`--span` seconds, at mixed levels,
+    from several loggers, with :option:`--tracebacks` of them
+    carrying exception tracebacks.  Then time each of these, each
+    in its own forked process so that none disturbs the others:
+
+    ``scan``, ``scan-lazy``
+        read every record with :meth:`dblogger.DBLoggerQuery.filter`,
+        decoding fully or lazily
+    ``format``
+        read and format every record as the :program:`dblogger`
+        command does
+    ``window``
+        read :option:`--windows` random :option:`--window` second
+        time ranges
+    ``regex-1`` through ``regex-0.001``
+        read every record matching a message pattern that selects
+        all of them through a thousandth of them
+    ``level``
+        read every ``ERROR`` record, through the level index with
+        :option:`--index`
+    ``tail``
+        catch up with :meth:`dblogger.DBLoggerQuery.follow` from the
+        earliest record
+    ``clear``
+        delete every record with
+        :meth:`dblogger.DBLoggerQuery.delete_range`, as
+        :program:`dblogger --clear` does
+
+    For each, this reports rows returned or deleted per second,
+    records scanned per second for whole-table scenarios, and peak
+    resident memory.  Since the records live in process memory, this
+    requires :func:`os.fork`.
+
+.. option:: format
+
+    Time formatting :option:`--records` records from
+    :option:`--sites` distinct call sites with the default ``fixed``
+    console format, using :class:`~dblogger.FixedWidthFormatter`
+    (``fixed``), the same with its caches disabled
+    (``fixed-uncached``), and a plain :class:`logging.Formatter`
+    (``logging``) with a similar format.  This reports records per
+    second and the speedup over ``fixed-uncached``.
+
+.. option:: --output <file>
+
+    Also write the results as JSON to `file`, or to standard output
+    if `file` is ``-``.  The document has a ``benchmark`` name, the
+    ``python`` version, the ``time`` it was run, the ``options``
+    used, and a list of ``results``, one per scenario.
+
+.. option:: --records <n>
+
+    For :option:`emit`, log `n` records per scenario, divided among
+    its threads and processes.  For :option:`query`, store `n`
+    records before the scenarios run.
+
+.. option:: --storage-type <type>
+
+    :mod:`kvlayer` backend to use: ``memory``, the default, is
+    :class:`MemoryStorage`; ``local`` and ``filestorage`` are the
+    :mod:`kvlayer` backends of those names.
+
+.. option:: --codec <codec>, --batch, --segment-size <n>, --index, --fields <name,...>
+
+    Configure the handler as the corresponding
+    :class:`~dblogger.DatabaseLogHandler` parameters do.
+
+.. autoclass:: MemoryStorage
+.. autofunction:: run_emit
+.. autofunction:: fill
+.. autofunction:: run_query
+.. autofunction:: run_format
+
+'''
+from __future__ import absolute_import, division
+import argparse
+import bisect
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from dblogger.configure import default_config
+from dblogger.format import FixedWidthFormatter
+from dblogger.logger import DatabaseLogHandler, BODY_SUFFIX, index_tables
+from dblogger.query import DBLoggerQuery
+import kvlayer
+from kvlayer._local_memory import LocalStorage
+
+timer = time.time
+
+#: Percentiles reported for latencies, as (name, fraction) pairs
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+#: Levels of records generated for the query benchmark, with weights
+LEVEL_MIX = ((logging.DEBUG, 4), (logging.INFO, 4), (logging.WARNING, 1),
+             (logging.ERROR, 1))
+
+#: Logger names of records generated for the query benchmark
+LOGGER_NAMES = ('app.web', 'app.worker', 'app.db.pool', 'lib.cache')
+
+#: Query benchmark scenarios, in the order they run
+QUERY_SCENARIOS = ('scan', 'scan-lazy', 'format', 'window', 'regex-1',
+                   'regex-0.1', 'regex-0.01', 'regex-0.001', 'level',
+                   'tail', 'clear')
+
+#: Formatter benchmark scenarios, in the order they run
+FORMAT_SCENARIOS = ('logging', 'fixed-uncached', 'fixed')
+
+#: Message patterns of the ``regex`` query scenarios
+_REGEX_PATTERNS = {
+    'regex-1': r'\d{3} ',
+    'regex-0.1': r'0\d{2} ',
+    'regex-0.01': r'00\d ',
+    'regex-0.001': r'000 ',
+}
+
+
+class MemoryStorage(LocalStorage):
+    '''In-memory :mod:`kvlayer` backend with cheap range scans.
+
+    The ``local`` backend sorts a whole table on every scan, so
+    reading a one-second window costs as much as reading the table.
+    This keeps each table's keys sorted until the next write, as an
+    ordered database would, so a scan costs only the rows it reads.
+
+    '''
+    def __init__(self, *args, **kwargs):
+        super(MemoryStorage, self).__init__(*args, **kwargs)
+        self._sorted = {}
+
+    def put(self, table_name, *keys_and_values, **kwargs):
+        self._sorted.pop(table_name, None)
+        return super(MemoryStorage, self).put(table_name, *keys_and_values,
+                                              **kwargs)
+
+    def delete(self, table_name, *keys):
+        self._sorted.pop(table_name, None)
+        return super(MemoryStorage, self).delete(table_name, *keys)
+
+    def clear_table(self, table_name):
+        self._sorted.pop(table_name, None)
+        return super(MemoryStorage, self).clear_table(table_name)
+
+    def sort_tables(self):
+        '''Sort every table now rather than on its next scan.'''
+        for table_name in self._table_names:
+            self._ordered(table_name)
+
+    def _ordered(self, table_name):
+        ordered = self._sorted.get(table_name)
+        if ordered is None:
+            key_spec = self._table_names[table_name]
+            pairs = sorted((self._encoder.serialize(key, key_spec), key)
+                           for key in self.data[table_name])
+            ordered = ([joined for joined, key in pairs],
+                       [key for joined, key in pairs])
+            self._sorted[table_name] = ordered
+        return ordered
+
+    def scan(self, table_name, *key_ranges, **kwargs):
+        key_spec = self._table_names[table_name]
+        table = self.data[table_name]
+        joined, keys = self._ordered(table_name)
+        for start, finish in key_ranges or [(None, None)]:
+            start = self._encoder.make_start_key(start, key_spec)
+            finish = self._encoder.make_end_key(finish, key_spec)
+            lo = 0 if start is None else bisect.bisect_left(joined, start)
+            hi = (len(joined) if finish is None
+                  else bisect.bisect_right(joined, finish))
+            for key in keys[lo:hi]:
+                # skip keys deleted since the scan began
+                value = table.get(key)
+                if value is not None:
+                    yield key, value
+
+
+def storage_client(storage_type='memory', directory=None):
+    '''Create a fresh stand-in storage client in its own namespace.
+
+    :param str storage_type: ``memory``, ``local``, or ``filestorage``
+    :param str directory: existing directory ``filestorage`` puts its
+      files in
+    :return: storage client
+    :rtype: :class:`kvlayer.AbstractStorage`
+
+    '''
+    namespace = 'bench_' + uuid.uuid4().hex
+    config = {}
+    if storage_type == 'filestorage':
+        config['filename'] = os.path.join(directory, namespace)
+    if storage_type == 'memory':
+        return MemoryStorage(config, app_name='dblogger_benchmark',
+                             namespace=namespace)
+    return kvlayer.client(config=config, storage_type=storage_type,
+                          app_name='dblogger_benchmark', namespace=namespace)
+
+
+def percentiles(values):
+    '''Get the :data:`PERCENTILES` of a list of numbers.
+
+    :param list values: numbers, which this sorts in place
+    :return: dictionary mapping percentile name to value
+
+    '''
+    values.sort()
+    result = {}
+    for name, fraction in PERCENTILES:
+        if values:
+            index = min(len(values) - 1, int(fraction * len(values)))
+            result[name] = values[index]
+        else:
+            result[name] = None
+    return result
+
+
+def stored_bytes(storage, tables):
+    '''Total the key and value bytes stored in `tables`.'''
+    total = 0
+    rows = 0
+    for table in tables:
+        for key, value in storage.scan(table):
+            rows += 1
+            total += len(value)
+            for part in key:
+                if isinstance(part, uuid.UUID):
+                    total += 16
+                else:
+                    total += len(str(part))
+    return total, rows
+
+
+def run_emit(records=10000, size=256, threads=1, processes=1,
+             exceptions=False, storage_type='memory', directory=None,
+             handler_options=None):
+    '''Run one emit scenario.
+
+    :param int records: total records to log
+    :param int size: bytes of message text per record
+    :param int threads: threads logging concurrently in each process
+    :param int processes: processes logging concurrently
+    :param bool exceptions: attach a traceback to every record
+    :param str storage_type: stand-in :mod:`kvlayer` backend
+    :param str directory: directory for file-backed storage
+    :param dict handler_options: extra
+      :class:`~dblogger.DatabaseLogHandler` parameters
+    :return: dictionary of scenario parameters and measurements
+
+    '''
+    per_process = max(1, records // processes)
+    kwargs = dict(records=per_process, size=size, threads=threads,
+                  exceptions=exceptions, storage_type=storage_type,
+                  directory=directory, handler_options=handler_options)
+    if processes == 1:
+        parts = [_emit_process(**kwargs)]
+    else:
+        queue = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=_emit_child,
+                                            args=(queue, kwargs))
+                    for i in xrange(processes)]
+        for child in children:
+            child.start()
+        parts = [queue.get() for child in children]
+        for child in children:
+            child.join()
+
+    latencies = []
+    for part in parts:
+        latencies.extend(part['latencies'])
+    total = sum(part['records'] for part in parts)
+    elapsed = max(part['elapsed'] for part in parts)
+    result = dict(
+        benchmark='emit', records=total, size=size, threads=threads,
+        processes=processes, exceptions=exceptions,
+        elapsed=elapsed,
+        records_per_sec=total / elapsed if elapsed else None,
+        bytes_per_record=(sum(part['stored_bytes'] for part in parts) /
+                          total),
+        rows_per_record=sum(part['stored_rows'] for part in parts) / total,
+        objects_per_emit=(
+            sum(part['retained_objects'] for part in parts) / total),
+        peak_rss_kb=max(part['peak_rss_kb'] for part in parts),
+    )
+    for name, value in percentiles(latencies).iteritems():
+        result['latency_' + name] = value
+    return result
+
+
+def _emit_child(queue, kwargs):
+    queue.put(_emit_process(**kwargs))
+
+
+def _emit_process(records, size, threads, exceptions, storage_type,
+                  directory, handler_options):
+    '''Log `records` records from `threads` threads in this process.'''
+    if storage_type == 'filestorage':
+        directory = tempfile.mkdtemp(prefix='dblogger-benchmark-',
+                                     dir=directory)
+    storage = storage_client(storage_type, directory)
+    handler_options = dict(handler_options or {})
+    handler = DatabaseLogHandler(storage, **handler_options)
+    logger = logging.getLogger('dblogger.benchmark.{0}'.format(
+        uuid.uuid4().hex))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    payload = 'x' * size
+    exc_info = _exc_info() if exceptions else None
+
+    per_thread = max(1, records // threads)
+    latencies = [[] for i in xrange(threads)]
+    start_gate = threading.Event()
+
+    def work(out):
+        log = logger.log
+        append = out.append
+        start_gate.wait()
+        for i in xrange(per_thread):
+            level = logging.ERROR if i % 10 == 0 else logging.INFO
+            before = timer()
+            log(level, 'record %d: %s', i, payload, exc_info=exc_info)
+            append(timer() - before)
+
+    workers = [threading.Thread(target=work, args=(latencies[i],))
+               for i in xrange(threads)]
+    for worker in workers:
+        worker.start()
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    start = timer()
+    start_gate.set()
+    for worker in workers:
+        worker.join()
+    handler.close()
+    elapsed = timer() - start
+    logger.removeHandler(handler)
+    gc.collect()
+    retained = len(gc.get_objects()) - objects_before
+
+    tables = [handler.table_name, handler.table_name + BODY_SUFFIX]
+    if handler.index:
+        tables.extend(index_tables(handler.table_name))
+    tables = [t for t in tables if t in storage._table_names]
+    total_bytes, rows = stored_bytes(storage, tables)
+    storage.delete_namespace()
+    storage.close()
+    if storage_type == 'filestorage':
+        shutil.rmtree(directory)
+    return dict(
+        records=per_thread * threads,
+        elapsed=elapsed,
+        latencies=[l for part in latencies for l in part],
+        stored_bytes=total_bytes,
+        stored_rows=rows,
+        retained_objects=retained,
+        peak_rss_kb=peak_rss_kb(),
+    )
+
+
+def peak_rss_kb():
+    '''Get the peak resident memory of this process, in kilobytes.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def fill(storage, records, span=3600.0, tracebacks=0.05,
+         handler_options=None, seed=0):
+    '''Store generated records for the query benchmark.
+
+    The records are spread evenly over the `span` seconds ending now,
+    at the levels in :data:`LEVEL_MIX`, from the loggers in
+    :data:`LOGGER_NAMES`.  Each message starts with a random
+    three-digit number, so a message pattern of ``0`` matches about a
+    tenth of the records, ``00`` a hundredth, and so on.
+
+    :param storage: storage client
+    :type storage: :class:`kvlayer.AbstractStorage`
+    :param int records: number of records to store
+    :param float span: seconds the records cover
+    :param float tracebacks: fraction of records with a traceback
+    :param dict handler_options: extra
+      :class:`~dblogger.DatabaseLogHandler` parameters
+    :param seed: random seed
+    :return: triple of the first record's time, the last record's
+      time, and the seconds taken
+
+    '''
+    rng = random.Random(seed)
+    handler = DatabaseLogHandler(storage, **dict(handler_options or {}))
+    levels = [level for level, weight in LEVEL_MIX for i in xrange(weight)]
+    exc_info = _exc_info()
+    end = time.time()
+    begin = end - span
+    step = span / max(1, records - 1)
+    start = timer()
+    for i in xrange(records):
+        record = logging.LogRecord(
+            rng.choice(LOGGER_NAMES), rng.choice(levels), __file__, i % 1000,
+            '%03d request %d took %.3f seconds',
+            (rng.randrange(1000), i, rng.random()),
+            exc_info if rng.random() < tracebacks else None, 'fill')
+        record.created = begin + i * step
+        record.msecs = (record.created - int(record.created)) * 1000
+        handler.handle(record)
+    handler.close()
+    elapsed = timer() - start
+    if isinstance(storage, MemoryStorage):
+        storage.sort_tables()
+    return begin, end, elapsed
+
+
+def run_query(storage, scenario, begin, end, records, indexed=False,
+              window=1.0, windows=100, seed=0):
+    '''Run one query scenario against records stored by :func:`fill`.
+
+    The scenario runs in a forked process, so that it sees the same
+    in-memory storage but cannot change it, and so its peak memory
+    is its own.
+
+    :param storage: storage client
+    :type storage: :class:`kvlayer.AbstractStorage`
+    :param str scenario: name from :data:`QUERY_SCENARIOS`
+    :param float begin: time of the first stored record
+    :param float end: time of the last stored record
+    :param int records: number of stored records
+    :param bool indexed: whether the records have level and logger
+      name indexes
+    :param float window: seconds in each ``window`` query
+    :param int windows: number of ``window`` queries
+    :param seed: random seed for ``window`` query times
+    :return: dictionary of scenario parameters and measurements
+    :raise exceptions.ValueError: if `scenario` is unknown
+
+    '''
+    if scenario not in QUERY_SCENARIOS:
+        raise ValueError('unknown query scenario {0!r}, expected one of {1}'
+                         .format(scenario, ', '.join(QUERY_SCENARIOS)))
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(
+        target=_query_child,
+        args=(queue, storage, scenario, begin, end, indexed, window, windows,
+              seed))
+    child.start()
+    part = queue.get()
+    child.join()
+    if isinstance(part, BaseException):
+        raise part
+
+    rows, queries, elapsed = part['rows'], part['queries'], part['elapsed']
+    result = dict(
+        benchmark='query', scenario=scenario, records=records, rows=rows,
+        queries=queries, elapsed=elapsed,
+        rows_per_sec=rows / elapsed if elapsed else None,
+        scanned_per_sec=None,
+        peak_rss_kb=part['peak_rss_kb'],
+    )
+    if scenario != 'window' and elapsed:
+        result['scanned_per_sec'] = records / elapsed
+    return result
+
+
+def _query_child(queue, storage, scenario, begin, end, indexed, window,
+                 windows, seed):
+    try:
+        query = DBLoggerQuery(storage, indexed=indexed)
+        start = timer()
+        rows, queries = _query_scenario(query, scenario, begin, end, window,
+                                        windows, seed)
+        elapsed = timer() - start
+        queue.put(dict(rows=rows, queries=queries, elapsed=elapsed,
+                       peak_rss_kb=peak_rss_kb()))
+    except Exception, exc:
+        queue.put(exc)
+
+
+def _query_scenario(query, scenario, begin, end, window, windows, seed):
+    '''Run a query scenario, returning rows and number of queries.'''
+    # records are keyed in whole ticks, so pad the ends
+    begin -= 1
+    end += 1
+    if scenario in ('scan', 'scan-lazy'):
+        rows = _count(query.filter(begin, end, lazy=scenario == 'scan-lazy'))
+        return rows, 1
+    if scenario == 'format':
+        formatter = FixedWidthFormatter(
+            default_config['formatters']['fixed']['format'])
+        rows = 0
+        for key, record in query.filter(begin, end):
+            formatter.format(record)
+            rows += 1
+        return rows, 1
+    if scenario == 'window':
+        rng = random.Random(seed)
+        rows = 0
+        for i in xrange(windows):
+            start = rng.uniform(begin, max(begin, end - window))
+            rows += _count(query.filter(start, start + window))
+        return rows, windows
+    if scenario in _REGEX_PATTERNS:
+        return _count(query.filter(begin, end,
+                                   filter_str=_REGEX_PATTERNS[scenario])), 1
+    if scenario == 'level':
+        return _count(query.filter(begin, end, level=logging.ERROR)), 1
+    if scenario == 'tail':
+        return _count(query.follow(begin=begin, idle_timeout=0)), 1
+    if scenario == 'clear':
+        return query.delete_range(begin, end), 1
+
+
+def run_format(scenario, records=200000, sites=100):
+    '''Time formatting records for the console.
+
+    The records are logged one millisecond apart, from `sites`
+    distinct source lines, at mixed levels.
+
+    :param str scenario: name from :data:`FORMAT_SCENARIOS`
+    :param int records: number of records to format
+    :param int sites: number of distinct call sites
+    :return: dictionary of scenario parameters and measurements
+    :raise exceptions.ValueError: if `scenario` is unknown
+
+    '''
+    fmt = default_config['formatters']['fixed']['format']
+    if scenario == 'fixed':
+        formatter = FixedWidthFormatter(fmt)
+    elif scenario == 'fixed-uncached':
+        formatter = FixedWidthFormatter(fmt, cache_size=0)
+    elif scenario == 'logging':
+        formatter = logging.Formatter(
+            '%(asctime)-23s pid=%(process)-5d %(filename)s:%(lineno)-5d '
+            '%(levelname)-8s %(message)s')
+    else:
+        raise ValueError('unknown format scenario {0!r}, expected one of {1}'
+                         .format(scenario, ', '.join(FORMAT_SCENARIOS)))
+
+    levels = [level for level, weight in LEVEL_MIX for i in xrange(weight)]
+    pool = []
+    created = time.time()
+    for i in xrange(min(records, 10000)):
+        record = logging.LogRecord(
+            LOGGER_NAMES[i % len(LOGGER_NAMES)], levels[i % len(levels)],
+            '/src/app/module_{0}.py'.format(i % sites % 10), i % sites,
+            'request %d took %.3f seconds', (i, 0.25), None, 'handle')
+        record.created = created + i * 0.001
+        record.msecs = (record.created - int(record.created)) * 1000
+        pool.append(record)
+
+    format = formatter.format
+    start = timer()
+    for i in xrange(records):
+        format(pool[i % len(pool)])
+    elapsed = timer() - start
+    return dict(benchmark='format', scenario=scenario, records=records,
+                sites=sites, elapsed=elapsed,
+                records_per_sec=records / elapsed if elapsed else None,
+                usec_per_record=elapsed * 1e6 / records)
+
+
+def _count(items):
+    count = 0
+    for item in items:
+        count += 1
+    return count
+
+
+def _exc_info():
+    try:
+        raise ValueError('benchmark exception')
+    except ValueError:
+        return sys.exc_info()
+
+
+def _int_list(value):
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected comma-separated integers, not {0!r}'.format(value))
+
+
+def _emit_summary(result):
+    latency = ' '.join(
+        '{0}={1:.1f}us'.format(name, result['latency_' + name] * 1e6)
+        for name, fraction in PERCENTILES
+        if result['latency_' + name] is not None)
+    return ('size={size} threads={threads} processes={processes} '
+            'exc={exc}: {rate:.0f} rec/s {latency} {bytes:.0f} B/rec'
+            .format(size=result['size'], threads=result['threads'],
+                    processes=result['processes'],
+                    exc='y' if result['exceptions'] else 'n',
+                    rate=result['records_per_sec'] or 0,
+                    latency=latency, bytes=result['bytes_per_record']))
+
+
+def _query_summary(result):
+    line = '{0:<12} {1:>10.0f} rows/s'.format(result['scenario'],
+                                              result['rows_per_sec'] or 0)
+    if result['scanned_per_sec'] is not None:
+        line += ' {0:>10.0f} scanned/s'.format(result['scanned_per_sec'])
+    return line + ' {0} rows {1} kB peak'.format(result['rows'],
+                                                 result['peak_rss_kb'])
+
+
+def _format_summary(result):
+    line = '{0:<15} {1:>10.0f} records/s {2:>6.2f} us/record'.format(
+        result['scenario'], result['records_per_sec'] or 0,
+        result['usec_per_record'])
+    if result.get('speedup') is not None:
+        line += ' {0:.2f}x'.format(result['speedup'])
+    return line
+
+
+def add_storage_arguments(parser):
+    '''Add options shared by every benchmark to `parser`.'''
+    parser.add_argument('--output', metavar='FILE',
+                        help='write JSON results to FILE, or "-" for '
+                        'standard output')
+    parser.add_argument('--storage-type', default='memory',
+                        choices=['memory', 'local', 'filestorage'],
+                        help='stand-in kvlayer backend')
+    parser.add_argument('--directory', metavar='DIR',
+                        help='directory for filestorage files')
+
+
+def write_results(args, name, results):
+    '''Write benchmark results as JSON, if :option:`--output` was given.'''
+    if not args.output:
+        return
+    document = dict(
+        benchmark=name,
+        python=sys.version.split()[0],
+        time=time.time(),
+        options=dict((k, v) for k, v in vars(args).iteritems()
+                     if k not in ('output', 'func')),
+        results=results,
+    )
+    if args.output == '-':
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def emit_main(args):
+    handler_options = dict(codec=args.codec, batch=args.batch,
+                           segment_size=args.segment_size, index=args.index,
+                           fields=args.fields)
+    out = sys.stderr if args.output == '-' else sys.stdout
+    results = []
+    for size in args.sizes:
+        for threads in args.threads:
+            for processes in args.processes:
+                for exceptions in (False, True):
+                    result = run_emit(
+                        records=args.records, size=size, threads=threads,
+                        processes=processes, exceptions=exceptions,
+                        storage_type=args.storage_type,
+                        directory=args.directory,
+                        handler_options=handler_options)
+                    result.update(handler_options)
+                    results.append(result)
+                    out.write(_emit_summary(result) + '\n')
+                    out.flush()
+    write_results(args, 'emit', results)
+
+
+def query_main(args):
+    unknown = set(args.scenarios) - set(QUERY_SCENARIOS)
+    if unknown:
+        raise SystemExit('unknown query scenarios: {0}'
+                         .format(', '.join(sorted(unknown))))
+    handler_options = dict(codec=args.codec, segment_size=args.segment_size,
+                           index=args.index)
+    out = sys.stderr if args.output == '-' else sys.stdout
+    directory = None
+    if args.storage_type == 'filestorage':
+        directory = tempfile.mkdtemp(prefix='dblogger-benchmark-',
+                                     dir=args.directory)
+    try:
+        storage = storage_client(args.storage_type, directory)
+        begin, end, elapsed = fill(storage, args.records, span=args.span,
+                                   tracebacks=args.tracebacks,
+                                   handler_options=handler_options)
+        out.write('stored {0} records in {1:.1f} seconds, {2} kB\n'
+                  .format(args.records, elapsed, peak_rss_kb()))
+        out.flush()
+        results = []
+        for scenario in QUERY_SCENARIOS:
+            if scenario not in args.scenarios:
+                continue
+            result = run_query(storage, scenario, begin, end, args.records,
+                               indexed=args.index, window=args.window,
+                               windows=args.windows)
+            result.update(handler_options)
+            results.append(result)
+            out.write(_query_summary(result) + '\n')
+            out.flush()
+        storage.delete_namespace()
+        storage.close()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    write_results(args, 'query', results)
+
+
+def format_main(args):
+    results = []
+    for scenario in FORMAT_SCENARIOS:
+        results.append(run_format(scenario, records=args.records,
+                                  sites=args.sites))
+    baseline = [r for r in results if r['scenario'] == 'fixed-uncached'][0]
+    for result in results:
+        result['speedup'] = baseline['elapsed'] / result['elapsed']
+        out = sys.stderr if args.output == '-' else sys.stdout
+        out.write(_format_summary(result) + '\n')
+    write_results(args, 'format', results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark dblogger against a stand-in kvlayer')
+    subparsers = parser.add_subparsers(title='benchmarks')
+
+    emit = subparsers.add_parser('emit', help='benchmark logging records')
+    add_storage_arguments(emit)
+    emit.add_argument('--records', type=int, default=20000, metavar='N',
+                      help='records per scenario')
+    emit.add_argument('--sizes', type=_int_list, default=[64, 1024, 16384],
+                      metavar='N,N,...', help='message sizes in bytes')
+    emit.add_argument('--threads', type=_int_list, default=[1, 4],
+                      metavar='N,N,...', help='logging threads per process')
+    emit.add_argument('--processes', type=_int_list, default=[1],
+                      metavar='N,N,...', help='logging processes')
+    emit.add_argument('--codec', default='pickle',
+                      choices=['pickle', 'compact', 'split'])
+    emit.add_argument('--batch', action='store_true', default=False,
+                      help='write from a background thread')
+    emit.add_argument('--segment-size', type=int, default=None, metavar='N',
+                      help='pack up to N records per row')
+    emit.add_argument('--index', action='store_true', default=False,
+                      help='maintain level and logger name indexes')
+    emit.add_argument('--fields', type=lambda v: v.split(','), default=None,
+                      metavar='NAME,...',
+                      help='store only these record attributes')
+    emit.set_defaults(func=emit_main)
+
+    query = subparsers.add_parser('query', help='benchmark reading records')
+    add_storage_arguments(query)
+    query.add_argument('--records', type=int, default=1000000, metavar='N',
+                       help='records to store')
+    query.add_argument('--span', type=float, default=3600.0,
+                       metavar='SECONDS',
+                       help='time covered by the stored records')
+    query.add_argument('--tracebacks', type=float, default=0.05,
+                       metavar='FRACTION',
+                       help='fraction of records with a traceback')
+    query.add_argument('--scenarios', type=lambda v: v.split(','),
+                       default=list(QUERY_SCENARIOS), metavar='NAME,...',
+                       help='scenarios to run, default all of ' +
+                       ', '.join(QUERY_SCENARIOS))
+    query.add_argument('--window', type=float, default=1.0,
+                       metavar='SECONDS', help='length of window queries')
+    query.add_argument('--windows', type=int, default=100, metavar='N',
+                       help='number of window queries')
+    query.add_argument('--codec', default='pickle',
+                       choices=['pickle', 'compact', 'split'])
+    query.add_argument('--segment-size', type=int, default=None,
+                       metavar='N', help='pack up to N records per row')
+    query.add_argument('--index', action='store_true', default=False,
+                       help='maintain and query level and logger name '
+                       'indexes')
+    query.set_defaults(func=query_main)
+
+    format = subparsers.add_parser('format',
+                                   help='benchmark console formatting')
+    format.add_argument('--output', metavar='FILE',
+                        help='write JSON results to FILE, or "-" for '
+                        'standard output')
+    format.add_argument('--records', type=int, default=200000, metavar='N',
+                        help='records to format')
+    format.add_argument('--sites', type=int, default=100, metavar='N',
+                        help='distinct call sites')
+    format.set_defaults(func=format_main)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+'''Compact binary encoding for stored log records.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:class:`dblogger.DatabaseLogHandler` historically stored the pickled
+:attr:`~logging.LogRecord.__dict__` of every record, including
+attributes that are meaningless once the record leaves the process.
+This module stores only the persisted fields, in a fixed order, so
+that a record costs a single :func:`struct.pack` call and a string
+join to encode, and a single :func:`struct.unpack_from` call plus
+slicing to decode.
+
+An encoded record is :data:`MAGIC`, a version byte, a fixed-size
+header, and then the concatenated bytes of the string fields.  The
+header holds the creation time as integer microseconds, the level
+number, line number, process id, and thread id, a bitmask of which
+string fields were :class:`unicode`, and the length of each string
+field.  The string fields are, in order, :data:`STRING_FIELDS`; the
+last of these, ``extras``, is a pickled dictionary of any
+non-standard attributes, such as those passed in a logging call's
+``extra`` parameter.  Pickled records never begin with
+:data:`MAGIC`, so readers can tell the two formats apart.
+
+Attributes that can be recomputed are not stored: ``filename`` and
+``module`` come from ``pathname``, ``msecs`` from ``created``, and
+``humantime`` is reformatted in the reader's local time zone.
+``args`` and ``exc_info`` are always :const:`None` after decoding;
+``msg`` is the already-interpolated message and ``exc_text`` has the
+formatted traceback.
+
+Readers that touch only a few fields of many records can wrap the
+stored value in a :class:`LazyRecord` instead of decoding it.
+
+:func:`encode_split` divides a record into a small header holding
+:data:`HEADER_FIELDS`, which is itself an encoded record with the
+other string fields missing, and a body holding :data:`BODY_FIELDS`.
+Readers can filter on headers without reading bodies at all, and
+then join a header with its body using :func:`merge_body`.
+:func:`has_body` tells split headers apart from whole records.
+
+.. autofunction:: encode
+.. autofunction:: decode
+.. autofunction:: decode_fields
+.. autofunction:: make_record
+.. autofunction:: is_encoded
+.. autofunction:: encode_split
+.. autofunction:: project
+.. autofunction:: merge_body
+.. autofunction:: has_body
+.. autoclass:: LazyRecord
+
+'''
+from __future__ import absolute_import
+
+import cPickle as pickle
+import logging
+import operator
+import os
+import struct
+
+from dblogger.utils import humantime
+
+#: Prefix of every compactly encoded record
+MAGIC = '\xdbL'
+
+#: Current encoding version
+VERSION = 1
+
+#: String fields of the record, in encoded order
+STRING_FIELDS = ('name', 'levelname', 'message', 'exc_text', 'pathname',
+                 'funcName', 'threadName', 'processName', 'extras')
+
+#: Fields returned by :func:`decode_fields`
+FIELDS = frozenset(STRING_FIELDS + ('created', 'levelno', 'lineno',
+                                    'process', 'thread'))
+
+#: Fields kept in the header by :func:`encode_split`
+HEADER_FIELDS = frozenset(['name', 'levelname', 'message', 'created',
+                           'levelno', 'lineno', 'process', 'thread'])
+
+#: Fields moved to the body by :func:`encode_split`
+BODY_FIELDS = FIELDS - HEADER_FIELDS
+
+#: Attributes that are encoded, derived, or deliberately dropped, and
+#: so never end up in ``extras``
+STANDARD_FIELDS = frozenset([
+    'name', 'msg', 'args', 'levelname', 'levelno', 'pathname', 'filename',
+    'module', 'exc_info', 'exc_text', 'lineno', 'funcName', 'created',
+    'msecs', 'relativeCreated', 'thread', 'threadName', 'processName',
+    'process', 'message', 'asctime', 'humantime',
+    # added by dblogger.FixedWidthFormatter
+    'fixed_width_filename_lineno', 'fixed_width_levelname',
+])
+
+_PREFIX = MAGIC + chr(VERSION)
+_HEADER = struct.Struct('>qiiqqH' + 'I' * len(STRING_FIELDS))
+_NONE = 0xffffffff
+_NONE_INT = -1
+# set in the unicode-flags word of a header whose body is stored apart
+_SPLIT = 1 << 15
+_FLAGS = struct.Struct('>H')
+_FLAGS_OFFSET = len(_PREFIX) + struct.calcsize('>qiiqq')
+_BODY_INDEXES = [i for i, field in enumerate(STRING_FIELDS)
+                 if field in BODY_FIELDS]
+_HEADER_INDEXES = [i for i, field in enumerate(STRING_FIELDS)
+                   if field not in BODY_FIELDS]
+_BODY_START = len(_PREFIX) + _HEADER.size
+_get_strings = operator.itemgetter(*STRING_FIELDS[:-1])
+_EXTRAS = len(STRING_FIELDS) - 1
+
+# (filename, module) for recently decoded pathnames
+_path_names = {}
+_PATH_NAMES_SIZE = 1024
+
+
+def is_encoded(value):
+    '''Determine whether a stored value was written by :func:`encode`.'''
+    return value[:len(MAGIC)] == MAGIC
+
+
+def encode(record, fields=None):
+    '''Encode a log record.
+
+    The record must already have ``message`` and ``exc_text`` set, as
+    :meth:`dblogger.DatabaseLogHandler.emit` does.
+
+    If `fields` is given, only those attributes are stored, and the
+    rest decode as :const:`None`.
+
+    :param record: record to encode
+    :type record: :class:`logging.LogRecord`
+    :param fields: names of attributes to store, or :const:`None`
+      for all of them
+    :return: encoded record
+    :rtype: str
+    :raise pickle.PicklingError: if an extra attribute cannot be pickled
+
+    '''
+    return _encode(project(record.__dict__, fields))
+
+
+def encode_split(record, fields=None):
+    '''Encode a log record as a separate header and body.
+
+    The header is an encoded record with only :data:`HEADER_FIELDS`
+    and a mark that the rest is stored apart; the body is an encoded
+    record with only :data:`BODY_FIELDS`.
+
+    :param record: record to encode, as for :func:`encode`
+    :type record: :class:`logging.LogRecord`
+    :param fields: names of attributes to store, as for :func:`encode`
+    :return: pair of header and body
+    :raise pickle.PicklingError: if an extra attribute cannot be pickled
+
+    '''
+    d = project(record.__dict__, fields)
+    return (_encode(d, _BODY_INDEXES, _SPLIT),
+            _encode(d, _HEADER_INDEXES, 0))
+
+
+def project(d, fields):
+    '''Get the items of a record dictionary named in `fields`.
+
+    :param dict d: record attributes
+    :param fields: names to keep, or :const:`None` to keep everything
+    :return: `d` itself if `fields` is :const:`None`, or a new
+      dictionary
+
+    '''
+    if fields is None:
+        return d
+    return dict((k, d[k]) for k in fields if k in d)
+
+
+def _encode(d, omit=(), flags=0):
+    '''Encode a record dictionary, leaving out the strings at `omit`.'''
+    extras = None
+    if not STANDARD_FIELDS.issuperset(d) and _EXTRAS not in omit:
+        extras = pickle.dumps(dict((k, d[k]) for k in d
+                                   if k not in STANDARD_FIELDS),
+                              protocol=pickle.HIGHEST_PROTOCOL)
+
+    get = d.get
+    try:
+        strings = _get_strings(d)
+    except KeyError:
+        strings = [get(field) for field in STRING_FIELDS[:-1]]
+    strings = list(strings)
+    strings.append(extras or '')
+    for i in omit:
+        strings[i] = ''
+    # joining fails on None (or on binary extras next to unicode) and
+    # produces unicode if anything was unicode, so a plain str result
+    # means no field needs conversion
+    try:
+        all_str = type(''.join(strings)) is str
+    except (TypeError, UnicodeDecodeError):
+        all_str = False
+    if all_str:
+        lengths = map(len, strings)
+        if extras is None:
+            lengths[-1] = _NONE
+    else:
+        if extras is None:
+            strings[-1] = None
+        lengths = []
+        for i, s in enumerate(strings):
+            if s is None:
+                lengths.append(_NONE)
+                strings[i] = ''
+                continue
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+                strings[i] = s
+                flags |= 1 << i
+            elif not isinstance(s, str):
+                s = str(s)
+                strings[i] = s
+            lengths.append(len(s))
+    for i in omit:
+        lengths[i] = _NONE
+
+    levelno = get('levelno')
+    lineno = get('lineno')
+    process = get('process')
+    thread = get('thread')
+    header = _HEADER.pack(int(get('created', 0) * 1000000 + 0.5),
+                          _NONE_INT if levelno is None else levelno,
+                          _NONE_INT if lineno is None else lineno,
+                          _NONE_INT if process is None else process,
+                          _NONE_INT if thread is None else thread,
+                          flags, *lengths)
+    return _PREFIX + header + ''.join(strings)
+
+
+def decode(value):
+    '''Decode a log record written by :func:`encode`.
+
+    :param str value: encoded record
+    :return: decoded record
+    :rtype: :class:`logging.LogRecord`
+    :raise exceptions.ValueError: if `value` is not an encoded record
+      or has an unknown version
+
+    '''
+    return make_record(decode_fields(value))
+
+
+def decode_fields(value):
+    '''Decode only the stored fields of a log record.
+
+    This is the cheap part of :func:`decode`: it returns a dictionary
+    with the keys in :data:`FIELDS`, where ``extras`` is still the
+    pickled string (or :const:`None`), and no derived attributes.
+    Callers that only need a few fields, such as query filters, can
+    look at these before paying for :func:`make_record`.
+
+    :param str value: encoded record
+    :return: dictionary of stored fields
+    :raise exceptions.ValueError: if `value` is not an encoded record
+      or has an unknown version
+
+    '''
+    header = _unpack_header(value)
+    created, levelno, lineno, process, thread, flags = header[:6]
+    pos = len(_PREFIX) + _HEADER.size
+    strings = []
+    append = strings.append
+    for length in header[6:]:
+        if length == _NONE:
+            append(None)
+            continue
+        end = pos + length
+        append(value[pos:end])
+        pos = end
+    if flags:
+        for i, s in enumerate(strings):
+            if flags & (1 << i):
+                strings[i] = s.decode('utf-8')
+    fields = dict(zip(STRING_FIELDS, strings))
+    fields.update(created=created / 1000000.0,
+                  levelno=_none_or_int(levelno),
+                  lineno=_none_or_int(lineno),
+                  process=_none_or_int(process),
+                  thread=_none_or_int(thread))
+    return fields
+
+
+def has_body(value):
+    '''Determine whether `value` is a header from :func:`encode_split`.'''
+    return (is_encoded(value) and
+            _FLAGS.unpack_from(value, _FLAGS_OFFSET)[0] & _SPLIT != 0)
+
+
+def merge_body(fields, body):
+    '''Add the fields of an :func:`encode_split` body to a header's.
+
+    :param dict fields: :func:`decode_fields` output for the header,
+      which this updates
+    :param str body: encoded body
+    :return: `fields`
+    :raise exceptions.ValueError: if `body` is not an encoded record
+
+    '''
+    body_fields = decode_fields(body)
+    for field in BODY_FIELDS:
+        fields[field] = body_fields[field]
+    return fields
+
+
+def make_record(fields):
+    '''Build a log record from :func:`decode_fields` output.
+
+    :param dict fields: stored fields, which this consumes
+    :return: decoded record
+    :rtype: :class:`logging.LogRecord`
+
+    '''
+    extras = fields.pop('extras')
+    if extras is not None:
+        d = pickle.loads(extras)
+        d.update(fields)
+    else:
+        d = fields
+    pathname = d['pathname']
+    names = _path_names.get(pathname)
+    if names is None:
+        if pathname is not None:
+            filename = os.path.basename(pathname)
+            names = (filename, os.path.splitext(filename)[0])
+        else:
+            names = (None, None)
+        if len(_path_names) >= _PATH_NAMES_SIZE:
+            _path_names.clear()
+        _path_names[pathname] = names
+    d['filename'], d['module'] = names
+    created = d['created']
+    d.update(msg=d['message'], args=None, exc_info=None,
+             msecs=(created - long(created)) * 1000, relativeCreated=0.0,
+             humantime=humantime(created))
+    # skip LogRecord.__init__, which would compute (and then throw
+    # away) a fresh set of process-local attributes
+    record = logging.LogRecord.__new__(logging.LogRecord)
+    record.__dict__ = d
+    return record
+
+
+class LazyRecord(object):
+    '''Read-only view of a record written by :func:`encode`.
+
+    The numeric fields and ``name``, ``levelname``, and ``message``
+    are decoded when the view is created.  The other stored string
+    fields are sliced out of the stored value when they are first
+    read, and any other attribute, including those from ``extras``,
+    decodes the whole record with :func:`decode` and reads it from
+    that.  Since :class:`logging.Formatter` needs to add attributes
+    to the records it formats, pass it :meth:`to_record` rather than
+    the view itself.
+
+    The view also has a dictionary-style :meth:`get` over the fields
+    in :data:`FIELDS`, so it can stand in for :func:`decode_fields`
+    output.
+
+    '''
+    __slots__ = ('_value', '_flags', '_lengths', '_starts', '_record',
+                 'created', 'levelno', 'lineno', 'process', 'thread',
+                 'name', 'levelname', 'message')
+
+    def __init__(self, value):
+        '''Create a view of an encoded record.
+
+        :param str value: encoded record
+        :raise exceptions.ValueError: if `value` is not an encoded
+          record or has an unknown version
+
+        '''
+        header = _unpack_header(value)
+        self._value = value
+        self._record = None
+        (created, levelno, lineno, process, thread,
+         self._flags) = header[:6]
+        self.created = created / 1000000.0
+        self.levelno = None if levelno == _NONE_INT else levelno
+        self.lineno = None if lineno == _NONE_INT else lineno
+        self.process = None if process == _NONE_INT else process
+        self.thread = None if thread == _NONE_INT else thread
+        self._lengths = lengths = header[6:]
+        self._starts = starts = []
+        append = starts.append
+        pos = _BODY_START
+        for length in lengths:
+            append(pos)
+            if length != _NONE:
+                pos += length
+        self.name = self._string(0)
+        self.levelname = self._string(1)
+        self.message = self._string(2)
+
+    def _string(self, index):
+        length = self._lengths[index]
+        if length == _NONE:
+            return None
+        start = self._starts[index]
+        s = self._value[start:start + length]
+        if self._flags & (1 << index):
+            s = s.decode('utf-8')
+        return s
+
+    def __getattr__(self, attr):
+        # only called for attributes not set in __init__
+        index = _LAZY_INDEX.get(attr)
+        if index is not None:
+            return self._string(index)
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.to_record(), attr)
+
+    @property
+    def msg(self):
+        return self.message
+
+    def getMessage(self):
+        '''Get the message, as :meth:`logging.LogRecord.getMessage` does.'''
+        return self.message
+
+    def get(self, field, default=None):
+        '''Get a stored field as :func:`decode_fields` would return it.'''
+        if field in _EAGER_FIELDS:
+            return getattr(self, field)
+        index = _STRING_INDEX.get(field)
+        if index is None:
+            return default
+        return self._string(index)
+
+    def to_record(self):
+        '''Get the full :class:`logging.LogRecord`, decoding it once.'''
+        if self._record is None:
+            self._record = decode(self._value)
+        return self._record
+
+    def __repr__(self):
+        return '<LazyRecord: %s, %s, %s, %s, "%s">' % (
+            self.name, self.levelno, self.pathname, self.lineno,
+            self.message)
+
+
+_STRING_INDEX = dict((field, i) for i, field in enumerate(STRING_FIELDS))
+_EAGER_FIELDS = frozenset(['created', 'levelno', 'lineno', 'process',
+                           'thread', 'name', 'levelname', 'message'])
+# string fields that LazyRecord slices out on first access; extras
+# needs unpickling, so it goes through the full record instead
+_LAZY_INDEX = dict((field, i) for field, i in _STRING_INDEX.iteritems()
+                   if field not in _EAGER_FIELDS and field != 'extras')
+
+
+def _unpack_header(value):
+    if not is_encoded(value):
+        raise ValueError('not a compact log record')
+    version = ord(value[len(MAGIC)])
+    if version != VERSION:
+        raise ValueError('unknown compact log record version {0}'
+                         .format(version))
+    return _HEADER.unpack_from(value, len(_PREFIX))
+
+
+def _none_or_int(value):
+    if value == _NONE_INT:
+        return None
+    return value
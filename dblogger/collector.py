@@ -0,0 +1,397 @@
+'''Collect log records from many processes into one writer.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`dblogger.DatabaseLogHandler` in every process of a large
+job means a database connection and a stream of small writes per
+process.  :program:`dblogger-collector` instead listens on a Unix
+socket, accepts records serialized by a lightweight
+:class:`CollectorHandler` in each process, and stores them all
+through one batching :class:`~dblogger.DatabaseLogHandler`, so the
+database sees a single client writing large batches.
+
+.. code-block:: yaml
+
+    logging:
+      handlers:
+        db:
+          class: dblogger.collector.CollectorHandler
+          socket_path: /var/run/dblogger.sock
+          codec: compact
+
+Clients serialize records themselves, with the `codec` and `fields`
+described in :class:`~dblogger.DatabaseLogHandler`, so the collector
+never decodes them; records stored through a collector read back
+exactly as if they had been written directly.  Index and partition
+settings belong to the collector.
+
+Each record is sent as one frame: a :data:`FRAME_HEADER` with the
+frame version, creation time, level, and the lengths of the logger
+name, the serialized record, and the serialized body of a ``split``
+record, followed by those three strings.
+
+This supports the standard :option:`--config <yakonfig --config>`,
+:option:`--dump-config <yakonfig --dump-config>`,
+:option:`--verbose <dblogger --verbose>`,
+:option:`--quiet <dblogger --quiet>`, and
+:option:`--debug <dblogger --debug>` options, and reads the
+:mod:`kvlayer` configuration to write to.
+
+.. program:: dblogger-collector
+
+.. option:: --socket <path>
+
+    Listen on the Unix socket `path`, default
+    :data:`DEFAULT_SOCKET`.  A stale socket file left by a collector
+    that is no longer running is replaced.
+
+.. option:: --mode <octal>
+
+    Permissions of the socket file, default ``600``.
+
+.. option:: --table <name>
+
+    Write to the log table `name`, default ``log``.
+
+.. option:: --index
+
+    Maintain the level and logger name indexes.
+
+.. option:: --partition <period>
+
+    Write to a table per ``hour`` or ``day``.
+
+.. option:: --segment-size <n>
+
+    Pack up to `n` records into each stored row.
+
+.. option:: --batch-count <n>, --batch-age <seconds>
+
+    Write once `n` records are buffered or the oldest is `seconds`
+    old, defaults 1000 and 1.0.
+
+.. option:: --queue-size <n>
+
+    Buffer at most `n` records, dropping the newest beyond that.
+
+.. autoclass:: CollectorHandler
+.. autoclass:: CollectorServer
+.. autofunction:: pack_frame
+.. autofunction:: read_frame
+
+'''
+from __future__ import absolute_import
+import argparse
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import struct
+import sys
+import time
+
+import dblogger
+from dblogger.logger import DatabaseLogHandler, SerializingHandler
+import kvlayer
+import yakonfig
+
+logger = logging.getLogger(__name__)
+
+#: Socket the collector listens on by default
+DEFAULT_SOCKET = '/tmp/dblogger-collector.sock'
+
+#: Version number written in every frame
+FRAME_VERSION = 1
+
+#: Frame header: version, created, levelno, and the lengths of the
+#: logger name, record, and body
+FRAME_HEADER = struct.Struct('>BdiIII')
+
+#: Length standing in for a :const:`None` name or body
+_NONE = 0xffffffff
+
+
+def pack_frame(created, levelno, name, dbrec, body=None):
+    '''Build the frame sending one serialized record.
+
+    :param float created: record creation time
+    :param int levelno: record level
+    :param name: logger name, or :const:`None`
+    :param str dbrec: serialized record
+    :param str body: serialized body, or :const:`None`
+    :return: frame bytes
+
+    '''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    if not isinstance(levelno, (int, long)):
+        levelno = logging.NOTSET
+    header = FRAME_HEADER.pack(
+        FRAME_VERSION, created, levelno,
+        _NONE if name is None else len(name), len(dbrec),
+        _NONE if body is None else len(body))
+    return ''.join([header, name or '', dbrec, body or ''])
+
+
+def read_frame(stream):
+    '''Read one frame written by :func:`pack_frame`.
+
+    :param stream: file-like object to read from
+    :return: tuple of ``(created, levelno, name, dbrec, body)``, or
+      :const:`None` at end of stream
+    :raise exceptions.ValueError: if the frame is truncated or has
+      an unknown version
+
+    '''
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError('truncated frame header')
+    (version, created, levelno,
+     name_len, rec_len, body_len) = FRAME_HEADER.unpack(header)
+    if version != FRAME_VERSION:
+        raise ValueError('unknown frame version {0}'.format(version))
+    parts = []
+    for length in (name_len, rec_len, body_len):
+        if length == _NONE:
+            parts.append(None)
+            continue
+        data = stream.read(length)
+        if len(data) < length:
+            raise ValueError('truncated frame')
+        parts.append(data)
+    name, dbrec, body = parts
+    return created, levelno, name, dbrec, body
+
+
+class CollectorHandler(SerializingHandler):
+    '''Log handler that sends records to :program:`dblogger-collector`.
+
+    This serializes records as :class:`dblogger.DatabaseLogHandler`
+    would and writes them to the collector's Unix socket, connecting
+    on the first record.  A process forked after that connects again
+    on its own first record, so the handler may be configured before
+    forking workers.
+
+    If the collector cannot be reached, the handler reconnects once;
+    if that fails too, the record is counted in :attr:`dropped` and
+    passed to :meth:`~logging.Handler.handleError`.  For the next
+    `retry_interval` seconds records are then counted as dropped
+    without trying the collector, so a missing or stalled collector
+    does not hold up every log call for the connect and send
+    timeouts.
+
+    .. automethod:: __init__
+
+    '''
+    def __init__(self, socket_path=DEFAULT_SOCKET, codec='compact',
+                 fields=None, timeout=5.0, retry_interval=5.0):
+        '''Create a new collector client handler.
+
+        :param str socket_path: collector's Unix socket
+        :param str codec: record encoding, ``pickle``, ``compact``, or
+          ``split``
+        :param list fields: names of record attributes to store, or
+          :const:`None` to store them all
+        :param float timeout: seconds to wait connecting or sending
+        :param float retry_interval: seconds to drop records without
+          trying the collector after it could not be reached
+
+        '''
+        super(CollectorHandler, self).__init__(codec=codec, fields=fields)
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        #: records that could not be sent
+        self.dropped = 0
+        self._sock = None
+        self._pid = None
+        #: time before which records are dropped, or :const:`None`
+        self._retry_at = None
+
+    def emit(self, record):
+        dbrec, body, failure = self._serialize(record)
+        if self._retry_at is not None and time.time() < self._retry_at:
+            self.dropped += 1
+        else:
+            frame = pack_frame(record.created, record.levelno,
+                               record.name, dbrec, body)
+            try:
+                self._send(frame)
+                self._retry_at = None
+            except Exception:
+                self._retry_at = time.time() + self.retry_interval
+                self.dropped += 1
+                self.handleError(record)
+        if failure:
+            # shutdown the process when logging fails
+            sys.exit(dbrec)
+
+    def _send(self, frame):
+        '''Send `frame`, reconnecting once if the connection failed.'''
+        for attempt in xrange(2):
+            if self._sock is None or self._pid != os.getpid():
+                self._disconnect()
+                self._connect()
+            try:
+                self._sock.sendall(frame)
+                return
+            except socket.error:
+                self._disconnect()
+                if attempt:
+                    raise
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self._sock = sock
+        self._pid = os.getpid()
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+        self._sock = None
+
+    def close(self):
+        self.acquire()
+        try:
+            self._disconnect()
+        finally:
+            self.release()
+        super(CollectorHandler, self).close()
+
+
+class _FrameHandler(SocketServer.StreamRequestHandler):
+    '''Store every frame read from one client connection.'''
+    def handle(self):
+        handler = self.server.handler
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except ValueError, exc:
+                logger.warning('closing collector client: %s', exc)
+                return
+            if frame is None:
+                return
+            created, levelno, name, dbrec, body = frame
+            handler.acquire()
+            try:
+                handler.store(created, levelno, name, dbrec, body)
+            except Exception:
+                logger.exception('failed to store a collected record')
+            finally:
+                handler.release()
+
+
+class CollectorServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    '''Unix socket server storing records from :class:`CollectorHandler`.
+
+    Each client connection is read by its own thread, and every
+    record goes to the single `handler`.  :meth:`server_close` also
+    removes the socket file.
+
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, handler, mode=0600):
+        '''Start listening on `socket_path`.
+
+        :param str socket_path: path of the Unix socket
+        :param handler: handler storing the records, which should
+          batch its writes
+        :type handler: :class:`dblogger.DatabaseLogHandler`
+        :param int mode: permissions of the socket file
+        :raise socket.error: if another collector is listening there
+
+        '''
+        self.handler = handler
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.unlink(socket_path)
+            else:
+                raise socket.error('a collector is already listening on {0}'
+                                   .format(socket_path))
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _FrameHandler)
+        os.chmod(socket_path, mode)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def _stop(signum, frame):
+    sys.exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='collect log records from local processes into kvlayer')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, metavar='PATH',
+                        help='Unix socket to listen on, default {0}'
+                        .format(DEFAULT_SOCKET))
+    parser.add_argument('--mode', default='600', metavar='OCTAL',
+                        help='permissions of the socket, default 600')
+    parser.add_argument('--table', default='log', metavar='NAME',
+                        help='log table to write to, default "log"')
+    parser.add_argument('--index', action='store_true', default=False,
+                        help='maintain level and logger name indexes')
+    parser.add_argument('--partition', choices=['hour', 'day'],
+                        help='write to a table per hour or day')
+    parser.add_argument('--segment-size', type=int, metavar='N',
+                        help='pack up to N records into each row')
+    parser.add_argument('--batch-count', type=int, default=1000,
+                        metavar='N',
+                        help='write once N records are buffered')
+    parser.add_argument('--batch-age', type=float, default=1.0,
+                        metavar='SECONDS',
+                        help='write once the oldest record is this old')
+    parser.add_argument('--queue-size', type=int, metavar='N',
+                        help='buffer at most N records')
+    args = yakonfig.parse_args(parser, [yakonfig, kvlayer, dblogger])
+
+    try:
+        mode = int(args.mode, 8)
+    except ValueError:
+        parser.error('--mode must be an octal number')
+
+    # the collector writes whatever codec its clients used, so it
+    # sets up body tables for split records
+    handler = DatabaseLogHandler(kvlayer.client(), table_name=args.table,
+                                 batch=True, batch_count=args.batch_count,
+                                 batch_age=args.batch_age,
+                                 queue_size=args.queue_size, codec='split',
+                                 segment_size=args.segment_size,
+                                 index=args.index, partition=args.partition)
+    server = CollectorServer(args.socket, handler, mode=mode)
+    signal.signal(signal.SIGTERM, _stop)
+    logger.info('collecting log records on %s', args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        handler.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+'''Collapse repeated records for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`Deduplicator` recognizes records that repeat the same
+message from the same place: the same logger name, level, source
+file, line number, and unformatted ``msg`` template.  The first
+record of a run is stored as usual.  The repeats that follow, each
+within `window` seconds of the one before, are held back and
+stored as one record, the first repeat, with these extra
+attributes:
+
+``repeat_count``
+    number of records it stands for
+
+``repeat_first``, ``repeat_last``
+    creation times of the first and last of them
+
+``repeat_args``
+    the ``args`` of the first few of them, as strings
+
+A run that is still going after `max_span` seconds is written out
+and starts over, so a flood that never pauses is still reported.
+Held records are also written by
+:meth:`~dblogger.DatabaseLogHandler.flush` and
+:meth:`~dblogger.DatabaseLogHandler.close`.
+:meth:`dblogger.DBLoggerQuery.repeat_count` reads the count back,
+as 1 for records that were not collapsed.
+
+.. autoclass:: Deduplicator
+
+'''
+from __future__ import absolute_import
+
+import logging
+
+
+def _text(value):
+    try:
+        return '%s' % (value,)
+    except Exception:
+        return repr(value)
+
+
+def sample_args(args):
+    '''Convert a record's ``args`` to strings for ``repeat_args``.'''
+    if isinstance(args, dict):
+        return dict((k, _text(v)) for k, v in args.iteritems())
+    if isinstance(args, tuple):
+        return tuple(_text(v) for v in args)
+    if args is None:
+        return None
+    return _text(args)
+
+
+class _Run(object):
+    '''Repeats of one record.'''
+    __slots__ = ('last', 'held', 'count', 'samples')
+
+    def __init__(self, created):
+        self.last = created
+        self.held = None
+        self.count = 0
+        self.samples = []
+
+
+class Deduplicator(object):
+    '''Hold back repeats of recent records.
+
+    This is not thread-safe; :class:`dblogger.DatabaseLogHandler`
+    calls it under the handler's lock.  Times are the records'
+    creation times.
+
+    '''
+    def __init__(self, window=1.0, max_span=60.0, samples=3,
+                 max_keys=10000):
+        '''Create a deduplicator.
+
+        :param float window: seconds after a record within which an
+          identical one is a repeat
+        :param float max_span: maximum seconds a run is held
+        :param int samples: number of repeats' ``args`` to keep
+        :param int max_keys: maximum distinct records tracked at once
+
+        '''
+        self.window = window
+        self.max_span = max_span
+        self.samples = samples
+        self.max_keys = max_keys
+        self._runs = {}
+        #: collapsed records ready to be stored
+        self.ready = []
+        self._next_sweep = None
+
+    def absorb(self, record):
+        '''Hold `record` back if it repeats a recent one.
+
+        Collapsed records of runs that this record ends are added to
+        :attr:`ready`.
+
+        :return: :const:`True` if the record was held back
+
+        '''
+        msg = record.msg
+        if not isinstance(msg, basestring):
+            return False
+        created = record.created
+        key = (record.name, record.levelno, record.pathname, record.lineno,
+               msg)
+        run = self._runs.get(key)
+        if run is not None and created - run.last > self.window:
+            self._finish(key, run)
+            run = None
+        if run is None:
+            if len(self._runs) >= self.max_keys:
+                self.sweep(None)
+            self._runs[key] = _Run(created)
+            return False
+
+        if (run.held is not None and
+                created - run.held.created >= self.max_span):
+            self._finish(key, run)
+            self._runs[key] = run = _Run(created)
+        if len(run.samples) < self.samples:
+            run.samples.append(sample_args(record.args))
+        if run.held is None:
+            self._prepare(record)
+            run.held = record
+        run.count += 1
+        run.last = created
+        return True
+
+    def _prepare(self, record):
+        '''Fix the text of a held record, which may outlive its args.'''
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging._defaultFormatter.formatException(
+                    record.exc_info)
+            record.exc_info = None
+
+    def _finish(self, key, run):
+        del self._runs[key]
+        if run.held is None:
+            return
+        record = run.held
+        record.repeat_count = run.count
+        record.repeat_first = record.created
+        record.repeat_last = run.last
+        record.repeat_args = run.samples
+        self.ready.append(record)
+
+    def sweep_due(self, now):
+        '''Decide whether :meth:`sweep` has runs to finish.'''
+        if self._next_sweep is None:
+            self._next_sweep = now + self.window
+            return False
+        return now >= self._next_sweep
+
+    def sweep(self, now):
+        '''Finish runs that have ended by `now`, or all of them.
+
+        :param float now: current time, or :const:`None` to finish
+          every run
+
+        '''
+        for key, run in self._runs.items():
+            if (now is None or now - run.last > self.window or
+                    (run.held is not None and
+                     now - run.held.created >= self.max_span)):
+                self._finish(key, run)
+        if now is not None:
+            self._next_sweep = now + self.window
+
+    def take_ready(self):
+        '''Get and clear the collapsed records ready to be stored.'''
+        ready = self.ready
+        self.ready = []
+        return ready
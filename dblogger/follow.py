@@ -0,0 +1,216 @@
+'''Resumable position for following a growing log table.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:meth:`dblogger.DBLoggerQuery.follow` keeps yielding records as they
+are written.  Rows do not always arrive in key order: a batching
+:class:`dblogger.DatabaseLogHandler` writes records some time after
+they were created, several processes may log to the same table, and
+a segment row is keyed by its first record.  So rather than a single
+last-seen key, a :class:`FollowCursor` remembers a key `after` which
+everything has been read, plus the rows already read after it and
+the newest of them, `high`.  Most polls scan only the keys after
+`high`.  Now and then a poll rescans the keys after `after`, reads
+only rows it has not seen, and then moves `after` up to `lookback`
+seconds behind the clock, forgetting the rows before it.
+
+A row stored more than `lookback` seconds after the time in its key,
+and after a rescan has moved `after` past it, is not read.  Spill
+replays (see :mod:`dblogger.spill`) and stalled batch writers store
+such rows.  So that they are not lost silently, the cursor keeps the
+number of rows it read in each stretch of keys it forgot, for another
+`lookback` seconds, and rescans count the keys there again.  Rows
+that turn up in those counts are added to :attr:`FollowCursor.late`
+and reported to the reader, though not read; rows later still cannot
+be told apart from rows already read.  The keys the cursor remembers
+grow with the rate records are written times `lookback`, so pick a
+`lookback` that covers the delays the writers actually have.
+
+The cursor is updated as each record is yielded, so it never
+re-yields a record, even one inside a partly read segment, and it
+can be saved with :meth:`FollowCursor.dumps` and restored with
+:meth:`FollowCursor.loads` at any point.
+
+.. autoclass:: FollowCursor
+
+'''
+from __future__ import absolute_import
+
+import bisect
+import json
+import time
+import uuid
+
+from dblogger.segment import MAX_SEGMENT_SPAN
+from dblogger.utils import tick_uuid, time_tick
+
+#: Default seconds a row may arrive behind the clock and still be read:
+#: a segment's span plus a few batching delays
+DEFAULT_LOOKBACK = MAX_SEGMENT_SPAN + 5.0
+
+
+class FollowCursor(object):
+    '''Position of a :meth:`dblogger.DBLoggerQuery.follow` reader.
+
+    .. attribute:: begin
+
+       Time of the earliest record to yield, or :const:`None`
+
+    .. attribute:: after
+
+       Key such that every row at or before it has been read
+
+    .. attribute:: seen
+
+       Set of keys of rows after :attr:`after` that have been read
+
+    .. attribute:: high
+
+       Key of the newest row that has been read, or :const:`None`
+
+    .. attribute:: partial
+
+       ``(row_key, count)`` if the first `count` records of a segment
+       row have been read but not the rest, or :const:`None`
+
+    .. attribute:: counts
+
+       List of ``(start, end, count)``, the number of rows read with
+       keys after `start` and up to `end`, for stretches of keys
+       before :attr:`after` that are still checked for late rows
+
+    .. attribute:: late
+
+       Number of rows found too late to be read
+
+    '''
+    def __init__(self, begin=None, after=None, seen=None, partial=None,
+                 high=None, counts=None, late=0):
+        '''Create a cursor.
+
+        :param float begin: only yield records at or after this time;
+          if :const:`None` and `after` is not given, start now
+        :param after: key at or before which everything has been read
+        :type after: :class:`uuid.UUID`
+        :param seen: keys of rows after `after` that have been read
+        :param tuple partial: partly read segment row
+        :param high: key of the newest row read
+        :type high: :class:`uuid.UUID`
+        :param list counts: rows read in stretches of keys before
+          `after`
+        :param int late: rows found too late to be read
+
+        '''
+        if begin is None and after is None:
+            begin = time.time()
+        self.begin = begin
+        if after is None:
+            # a segment holding records at `begin` is keyed up to
+            # MAX_SEGMENT_SPAN earlier
+            tick = time_tick(begin - MAX_SEGMENT_SPAN) - 1
+            if tick >= 0:
+                after = tick_uuid(tick, last=True)
+        self.after = after
+        self.seen = set(seen or ())
+        self.partial = partial
+        if high is None and self.seen:
+            high = max(self.seen)
+        self.high = high
+        self.counts = list(counts or ())
+        self.late = late
+
+    def advance(self, now, lookback=DEFAULT_LOOKBACK):
+        '''Treat every row more than `lookback` seconds before `now` as read.
+
+        This must only be called once every row that was stored when
+        `now` was taken has been read.  The number of rows read in
+        the keys this forgets is kept for another `lookback` seconds.
+
+        '''
+        after = tick_uuid(time_tick(now - lookback), last=True)
+        if self.after is not None and after <= self.after:
+            return
+        if self.after is not None:
+            self.counts.append((self.after, after,
+                                sum(1 for k in self.seen if k <= after)))
+        oldest = tick_uuid(time_tick(now - 2 * lookback), last=True)
+        self.counts = [c for c in self.counts if c[1] > oldest]
+        self.after = after
+        self.seen = set(k for k in self.seen if k > after)
+        if self.partial is not None and self.partial[0] <= after:
+            self.partial = None
+
+    @property
+    def checked(self):
+        '''Key after which rescans look for rows, late or not.'''
+        if self.counts:
+            return self.counts[0][0]
+        return self.after
+
+    def count_late(self, rows):
+        '''Find late rows among the keys before :attr:`after`.
+
+        :param rows: every stored key after :attr:`checked` and up to
+          :attr:`after`
+        :return: list of ``(start, end, count)`` of rows that were not
+          there when the keys after `start` and up to `end` were
+          forgotten
+
+        '''
+        rows = sorted(rows)
+        found = []
+        counts = []
+        for start, end, count in self.counts:
+            n = bisect.bisect_right(rows, end) - bisect.bisect_right(rows,
+                                                                     start)
+            if n > count:
+                found.append((start, end, n - count))
+                self.late += n - count
+                count = n
+            counts.append((start, end, count))
+        self.counts = counts
+        return found
+
+    def dumps(self):
+        '''Serialize the cursor to a string.'''
+        return json.dumps({
+            'begin': self.begin,
+            'after': self.after and self.after.hex,
+            'high': self.high and self.high.hex,
+            'seen': sorted(k.hex for k in self.seen),
+            'partial': self.partial and [self.partial[0].hex,
+                                         self.partial[1]],
+            'counts': [[start.hex, end.hex, count]
+                       for start, end, count in self.counts],
+            'late': self.late,
+        }, sort_keys=True)
+
+    @classmethod
+    def loads(cls, data):
+        '''Restore a cursor from :meth:`dumps` output.
+
+        :raise exceptions.ValueError: if `data` is not a saved cursor
+
+        '''
+        try:
+            d = json.loads(data)
+            after = d['after'] and uuid.UUID(hex=d['after'])
+            seen = [uuid.UUID(hex=k) for k in d['seen']]
+            partial = d['partial']
+            if partial:
+                partial = (uuid.UUID(hex=partial[0]), int(partial[1]))
+            # cursors saved before `high` and `counts` existed have
+            # neither
+            high = d.get('high') and uuid.UUID(hex=d['high'])
+            counts = [(uuid.UUID(hex=start), uuid.UUID(hex=end), int(count))
+                      for start, end, count in d.get('counts', ())]
+            return cls(begin=d['begin'], after=after, seen=seen,
+                       partial=partial, high=high, counts=counts,
+                       late=int(d.get('late', 0)))
+        except (KeyError, TypeError, ValueError), exc:
+            raise ValueError('invalid follow cursor: {0}'.format(exc))
+
+    def __repr__(self):
+        return ('FollowCursor(begin={0!r}, after={1!r}, {2} seen)'
+                .format(self.begin, self.after, len(self.seen)))
@@ -6,7 +6,7 @@
 '''
 
 import logging
-import sys
+import time
 
 class FixedWidthFormatter(logging.Formatter):
     '''Formats log messages in fixed columns.
@@ -17,23 +17,71 @@ class FixedWidthFormatter(logging.Formatter):
     ``%(fixed_width_levelname`` containing the log level padded out to
     an 8-character-wide field.
 
+    Both fields depend only on the call site and level, so they are
+    computed once and cached, keeping at most `cache_size` call
+    sites; a `cache_size` of 0 disables the caches.  The formatted
+    time is also reused for records in the same second, and whether
+    the format string uses the time is only checked once.  The rest
+    is :meth:`logging.Formatter.format`.
+
     '''
     filename_width = 17
     levelname_width = 8
 
+    def __init__(self, fmt=None, datefmt=None, cache_size=4096):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.cache_size = cache_size
+        self._uses_time = logging.Formatter.usesTime(self)
+        self._locations = {}
+        self._levelnames = {}
+        #: (second, datefmt, formatted time) of the last record
+        self._last_time = (None, None, None)
+
     def format(self, record):
-        max_filename_width = self.filename_width - 3 - len(str(record.lineno))
-        filename = record.filename
-        if len(record.filename) > max_filename_width:
-            filename = record.filename[:max_filename_width]
-        a = "%s:%s" % (filename, record.lineno)
-        record.fixed_width_filename_lineno = a.ljust(self.filename_width)
-        levelname = record.levelname
-        levelname_padding = ' ' * (self.levelname_width - len(levelname))
-        record.fixed_width_levelname = levelname + levelname_padding
-
-        if sys.hexversion > 0x02070000:
-            return super(FixedWidthFormatter, self).format(record)
-        else:
-            return logging.Formatter.format(self, record)
+        location = self._locations.get((record.filename, record.lineno))
+        if location is None:
+            location = self._location(record.filename, record.lineno)
+        record.fixed_width_filename_lineno = location
+        levelname = self._levelnames.get(record.levelname)
+        if levelname is None:
+            levelname = self._levelname(record.levelname)
+        record.fixed_width_levelname = levelname
+        return logging.Formatter.format(self, record)
+
+    def usesTime(self):
+        # the format string does not change, so check it only once
+        return self._uses_time
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        last_second, last_datefmt, formatted = self._last_time
+        if (second != last_second or datefmt != last_datefmt or
+                not self.cache_size):
+            ct = self.converter(record.created)
+            formatted = time.strftime(datefmt or '%Y-%m-%d %H:%M:%S', ct)
+            self._last_time = (second, datefmt, formatted)
+        if datefmt:
+            return formatted
+        return '%s,%03d' % (formatted, record.msecs)
+
+    def _location(self, filename, lineno):
+        '''Build and cache the fixed-width file name and line number.'''
+        max_filename_width = self.filename_width - 3 - len(str(lineno))
+        truncated = filename
+        if len(filename) > max_filename_width:
+            truncated = filename[:max_filename_width]
+        location = ('%s:%s' % (truncated, lineno)).ljust(self.filename_width)
+        if self.cache_size:
+            if len(self._locations) >= self.cache_size:
+                self._locations.clear()
+            self._locations[(filename, lineno)] = location
+        return location
 
+    def _levelname(self, levelname):
+        '''Build and cache the fixed-width level name.'''
+        padded = levelname + ' ' * (self.levelname_width - len(levelname))
+        if self.cache_size:
+            if len(self._levelnames) >= self.cache_size:
+                self._levelnames.clear()
+            self._levelnames[levelname] = padded
+        return padded
@@ -9,8 +9,11 @@ from __future__ import absolute_import
 import time
 import logging
 import cPickle as pickle
+import os
 import sys
+import threading
 import traceback
+import uuid
 
 try:
     from tblib import pickling_support
@@ -20,12 +23,143 @@ except Exception, exc:
     ## log something?
     pass
 
-from dblogger.utils import gen_uuid
+import dblogger.codec
+import dblogger.pool
+from dblogger.dedup import Deduplicator
+from dblogger.partition import PERIODS, REGISTRY_SUFFIX, partition_for, \
+    registry_table, registry_value
+from dblogger.ratelimit import RateLimiter
+from dblogger.spill import DEFAULT_MAX_BYTES, Spill
+from dblogger.stats import HandlerStats, flatten
+from dblogger.utils import gen_key, humantime
+from dblogger.writer import BatchWriter, DEFAULT_CLOSE_TIMEOUT
 import kvlayer
 import yakonfig
 
+#: Suffix of the name of the table indexing records by level
+LEVEL_INDEX_SUFFIX = '_level'
 
-class DatabaseLogHandler(logging.Handler):
+#: Suffix of the name of the table indexing records by logger name
+NAME_INDEX_SUFFIX = '_name'
+
+#: Suffix of the name of the table holding split record bodies
+BODY_SUFFIX = '_body'
+
+#: Suffix of the default name of the table holding periodic stats records
+STATS_SUFFIX = '_stats'
+
+#: Names of the supported record encodings
+CODECS = ('pickle', 'compact', 'split')
+
+#: Attributes stored even when not listed in a handler's `fields`
+REQUIRED_FIELDS = frozenset(['name', 'msg', 'message', 'levelname',
+                             'levelno', 'created', 'msecs'])
+
+
+def index_tables(table_name):
+    '''Get the kvlayer table definitions for the indexes on a log table.
+
+    :param str table_name: name of the log table
+    :return: dictionary suitable for
+      :meth:`kvlayer.AbstractStorage.setup_namespace`
+
+    '''
+    return {
+        table_name + LEVEL_INDEX_SUFFIX: (int, uuid.UUID),
+        table_name + NAME_INDEX_SUFFIX: (str, uuid.UUID),
+    }
+
+
+class SerializingHandler(logging.Handler):
+    '''Base for handlers that serialize records for storage.
+
+    This prepares and encodes records exactly as
+    :class:`DatabaseLogHandler` stores them, using the `codec` and
+    `fields` described there, for handlers that store them somewhere
+    else first, such as :class:`dblogger.collector.CollectorHandler`.
+
+    '''
+    def __init__(self, codec='pickle', fields=None):
+        '''Create a new serializing handler.
+
+        :param str codec: record encoding, ``pickle``, ``compact``, or
+          ``split``
+        :param list fields: names of record attributes to store, or
+          :const:`None` to store them all
+        :raise exceptions.ValueError: if `codec` is unknown
+
+        '''
+        logging.Handler.__init__(self)
+        if codec not in CODECS:
+            raise ValueError('unknown codec {0!r}'.format(codec))
+        self.codec = codec
+        self.fields = None
+        if fields is not None:
+            self.fields = frozenset(fields) | REQUIRED_FIELDS
+
+    def formatDBTime(self, record):
+        record.humantime = humantime(record.created)
+
+    def _serialize(self, record):
+        '''Format parts of `record` and serialize it for storage.
+
+        Returns a triple of the serialized record, the serialized
+        body for the ``split`` codec or :const:`None`, and a list of
+        failure messages.  If the list is not empty, the serialized
+        record is the joined failure messages instead.
+
+        '''
+        # every derived field is computed once: the message and
+        # traceback text are kept from a formatter that already made
+        # them, and are otherwise made here; as logging.Formatter
+        # does, a message that cannot be formatted raises
+        self.formatDBTime(record)
+        if self.formatter is not None:
+            self.format(record)
+            message = record.message
+        else:
+            message = record.getMessage()
+        # cannot serialize arbitrary args, because they might not be
+        # picklable, so keep the string instead
+        record.message = record.msg = message
+        record.args = None
+
+        failure = []
+        if record.exc_info:
+            if not record.exc_text:
+                formatter = self.formatter or logging._defaultFormatter
+                record.exc_text = formatter.formatException(record.exc_info)
+        else:
+            record.exc_text = ''
+
+        body = None
+        try:
+            if self.codec == 'split':
+                dbrec, body = dblogger.codec.encode_split(record,
+                                                          self.fields)
+            elif self.codec == 'compact':
+                dbrec = dblogger.codec.encode(record, self.fields)
+            else:
+                dbrec = pickle.dumps(
+                    dblogger.codec.project(record.__dict__, self.fields),
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception, exc:
+            failure.append('failed to dump log record, will shutdown')
+            failure.append(traceback.format_exc(exc))
+            failure.append('failed to pickle the __dict__ on: record=%r'
+                           % record)
+            failure.append('failed to pickle: record.__dict__=%r'
+                           % record.__dict__)
+            failure.append('logging failed so shutting down entire process')
+
+        if failure:
+            dbrec = '\n'.join(failure)
+            body = None
+
+        return dbrec, body, failure
+
+
+class DatabaseLogHandler(SerializingHandler):
     '''Log handler that stores log messages in a database.
 
     This uses :mod:`kvlayer` to store the actual log messages.
@@ -49,6 +183,14 @@ class DatabaseLogHandler(logging.Handler):
               class: dblogger.DatabaseLogHandler
               storage_config: *kvlayer
 
+    Handlers given the same `storage_config` share one client per
+    process, created and set up on first use, as described in
+    :mod:`dblogger.pool`.  A process forked from one that has used
+    the handler makes its own client and batch writer on its first
+    record, so the handler may be configured before starting a worker
+    pool.  A handler given a `storage_client` cannot make another,
+    and keeps using that one after a fork.
+
     Log messages are stored in a table with a single UUID key, where
     the high-order bits of the UUID are in order by time.  The actual
     table values are serialized JSON representations of the log
@@ -59,11 +201,159 @@ class DatabaseLogHandler(logging.Handler):
     formatted traceback from an exception.  These properties are also
     included in the JSON stored in the database..
 
+    Each record's message and traceback text are computed once: if a
+    formatter, this handler's or an earlier handler's, already set
+    ``exc_text``, it is stored as is, and the interpolated message
+    replaces ``msg`` and ``args``.  If `fields` is given, only those
+    record attributes, plus the time, level, logger name, and
+    message, are stored; for instance ``[exc_text, lineno,
+    funcName]`` leaves out ``pathname``, ``relativeCreated``, and the
+    ``exc_info`` traceback object.  Attributes that are left out read
+    back as :const:`None`, or as the :class:`logging.LogRecord`
+    default for pickled records.
+
+    .. code-block:: yaml
+
+        logging:
+          handlers:
+            db:
+              class: dblogger.DatabaseLogHandler
+              storage_config: *kvlayer
+              fields: [exc_text, lineno, funcName, process]
+
+    By default every record is written to the database before
+    :meth:`emit` returns.  Passing ``batch=True`` instead hands
+    records to a :class:`dblogger.writer.BatchWriter`, which writes
+    them from a background thread in multi-record batches; this
+    takes the database round trip off the logging thread at the cost
+    of possibly losing buffered records if the process is killed.
+    :meth:`flush` and :meth:`close` wait up to `flush_timeout`
+    seconds for buffered records to be written.
+
+    .. code-block:: yaml
+
+        logging:
+          handlers:
+            db:
+              class: dblogger.DatabaseLogHandler
+              storage_config: *kvlayer
+              batch: true
+              batch_age: 0.5
+
+    Setting `queue_size` also enables batching, and additionally
+    bounds the number of buffered records so that :meth:`emit` never
+    waits on a slow database.  `overflow` selects what happens to
+    records that do not fit, as described in :mod:`dblogger.writer`.
+    Dropped records are counted, and a synthetic ``WARNING`` record
+    from the ``dblogger`` logger reporting the count is written at
+    most every `drop_report_interval` seconds.
+
+    Records are stored as the pickled :attr:`~logging.LogRecord.__dict__`
+    unless `codec` is ``compact``, which stores only the persisted
+    fields in the smaller and faster format described in
+    :mod:`dblogger.codec`.  :meth:`deserialize` reads either format,
+    but readers older than the compact format cannot read it.
+
+    A `codec` of ``split`` also uses the compact format, but stores
+    only the time, level, logger name, and message in the main table,
+    and the traceback, source location, thread and process names, and
+    extra attributes in a table named `table_name` plus ``_body``,
+    under the same key.  :class:`dblogger.DBLoggerQuery` filters on
+    the small header rows, and then fetches bodies in bulk for only
+    the records that match.
+
+    Setting `segment_size` also enables batching, and packs up to that
+    many records from each batch into one compressed row, as
+    described in :mod:`dblogger.segment`.  This makes for fewer,
+    larger rows, which most backends write and store more cheaply.
+    :class:`dblogger.DBLoggerQuery` reads these rows transparently,
+    but older readers cannot.
+
+    If `index` is true, every record is also indexed by level in a
+    table named `table_name` plus ``_level``, keyed by level number
+    and UUID, and by logger name in a table named `table_name` plus
+    ``_name``, keyed by name and UUID.  The name index has an entry
+    for the record's logger and each of its ancestors, so that a
+    query can find a whole logger subtree with one range scan.
+    :meth:`dblogger.DBLoggerQuery.filter` uses these to answer
+    ``level`` and ``name`` queries without scanning every record.
+
+    If `partition` is ``hour`` or ``day``, records are instead written
+    to a table per UTC hour or day, such as ``log_2026_10_18``, as
+    described in :mod:`dblogger.partition`.  Read these with a
+    :class:`dblogger.DBLoggerQuery` created with ``partitioned=True``.
+
+    By default a write that fails raises from :meth:`emit`.  If
+    `spill_dir` is set, the handler instead spills rows it cannot
+    write to a file in that directory, and replays them in the
+    background once the database is back, as described in
+    :mod:`dblogger.spill`; writes that take longer than `put_budget`
+    seconds also divert records to the file for a while, so a slow
+    or failed database never stalls or kills the logging program.
+    In this mode a record that cannot be serialized is stored as the
+    error text without also exiting the process.
+
+    .. code-block:: yaml
+
+        logging:
+          handlers:
+            db:
+              class: dblogger.DatabaseLogHandler
+              storage_config: *kvlayer
+              spill_dir: /var/spool/dblogger
+              put_budget: 0.25
+
+    `rate_limits` caps how many records the handler stores from each
+    logger and level, by token bucket and by random sampling, as
+    described in :mod:`dblogger.ratelimit`, so that a log storm costs
+    a bounded number of writes per second.  Suppressed records are
+    counted, and a ``WARNING`` record from the ``dblogger`` logger
+    saying how many were suppressed from each logger is written at
+    most every `suppress_report_interval` seconds, and on
+    :meth:`close`.
+
+    If `dedup_window` is set, a record that repeats the message of
+    one from the same logger, level, and source line within that
+    many seconds is held back, and each run of repeats is stored as
+    a single record with a ``repeat_count``, as described in
+    :mod:`dblogger.dedup`.  Runs are written when they end, after at
+    most `dedup_max_span` seconds, and by :meth:`flush` and
+    :meth:`close`.  A background thread checks for ended runs every
+    `dedup_window` seconds, so a run is written soon after it ends
+    even if nothing else is logged.
+
+    :meth:`stats` reports what the handler has cost so far: records
+    emitted, failed, and dropped, rows and bytes written, the batch
+    queue depth, and histograms of formatting time and
+    :meth:`~kvlayer.AbstractStorage.put` latency, as described in
+    :mod:`dblogger.stats`.  If `stats_interval` is set, the handler
+    also writes these as an ``INFO`` record from the
+    ``dblogger.stats`` logger at most every `stats_interval` seconds,
+    with each counter as an attribute of the record, such as
+    ``bytes_written`` or ``put_p99``.  The record goes to
+    `stats_table`, by default `table_name` plus ``_stats``, or, if
+    `stats_logger` is set, is handled by that logger instead.
+
     .. automethod:: __init__
+    .. automethod:: stats
+    .. automethod:: store
+    .. automethod:: flush
+    .. automethod:: close
 
     '''
     def __init__(self, storage_client=None, table_name="log",
-                 storage_config=None):
+                 storage_config=None, batch=False, batch_count=1000,
+                 batch_bytes=1048576, batch_age=1.0,
+                 flush_timeout=DEFAULT_CLOSE_TIMEOUT, queue_size=None,
+                 overflow='drop_newest', overflow_level=logging.WARNING,
+                 block_timeout=0.1, drop_report_interval=60.0,
+                 codec='pickle', segment_size=None, index=False,
+                 partition=None, stats_interval=None, stats_table=None,
+                 stats_logger=None, fields=None, spill_dir=None,
+                 spill_max_bytes=DEFAULT_MAX_BYTES, put_budget=None,
+                 retry_interval=5.0, rate_limits=None,
+                 suppress_report_interval=60.0, dedup_window=None,
+                 dedup_max_span=60.0, dedup_samples=3):
         """Create a new database log handler.
 
         You must either pass in ``storage_client``, an actual kvlayer
@@ -71,33 +361,412 @@ class DatabaseLogHandler(logging.Handler):
         be passed to ``kvlayer.client()``.  Log messages
         will be stored in the table ``table_name``.
 
+        If `batch` is true, records are buffered and written by a
+        background thread once `batch_count` records or `batch_bytes`
+        bytes are buffered, or the oldest is `batch_age` seconds old.
+        If `queue_size` is set, batching is enabled and at most that
+        many records are buffered, with `overflow` deciding which
+        records to drop when the buffer is full.
+
         :param storage_client: existing storage client
         :type storage_client: :class:`kvlayer.AbstractStorage`
         :param str table_name: virtual table name
         :param dict storage_config: configuration for new storage client
+        :param bool batch: write from a background thread in batches
+        :param int batch_count: maximum records per batch
+        :param int batch_bytes: maximum serialized bytes per batch
+        :param float batch_age: maximum seconds a record is buffered
+        :param float flush_timeout: maximum seconds :meth:`flush` and
+          :meth:`close` wait for buffered records
+        :param int queue_size: maximum number of buffered records
+        :param str overflow: ``drop_newest``, ``drop_oldest``,
+          ``drop_below``, or ``block``
+        :param overflow_level: with ``drop_below``, records below
+          this level are dropped first
+        :type overflow_level: int or str
+        :param float block_timeout: with ``block``, maximum seconds
+          :meth:`emit` waits for room
+        :param float drop_report_interval: minimum seconds between
+          dropped-record summaries
+        :param str codec: record encoding, ``pickle``, ``compact``, or
+          ``split``
+        :param int segment_size: pack up to this many records into
+          each stored row
+        :param bool index: maintain level and logger name indexes
+        :param str partition: ``hour`` or ``day`` to write to a table
+          per period
+        :param float stats_interval: seconds between stats records,
+          or :const:`None` for none
+        :param str stats_table: table to write stats records to
+        :param str stats_logger: name of a logger to send stats
+          records to instead of `stats_table`
+        :param list fields: names of record attributes to store, or
+          :const:`None` to store them all
+        :param str spill_dir: directory to spill records to when
+          storage fails, or :const:`None` to raise instead
+        :param int spill_max_bytes: maximum bytes spilled per process
+        :param float put_budget: seconds a write may take before
+          records are spilled, or :const:`None` for no limit
+        :param float retry_interval: seconds between replays of
+          spilled records
+        :param list rate_limits: rules limiting the records stored,
+          as described in :mod:`dblogger.ratelimit`
+        :param float suppress_report_interval: minimum seconds between
+          suppressed-record summaries
+        :param float dedup_window: seconds within which a repeated
+          record is collapsed, or :const:`None` to store every record
+        :param float dedup_max_span: maximum seconds of repeats
+          collapsed into one record
+        :param int dedup_samples: number of repeats whose ``args``
+          are kept
 
         """
-        super(DatabaseLogHandler, self).__init__()
+        super(DatabaseLogHandler, self).__init__(codec=codec, fields=fields)
 
-        if storage_client is None:
-            if storage_config is None:
-                raise RuntimeError('must pass either storage_client or '
-                                   'storage_config')
-            with yakonfig.defaulted_config(
-                    [kvlayer], config=dict(kvlayer=storage_config)):
-                storage_client = kvlayer.client()
+        if partition is not None and partition not in PERIODS:
+            raise ValueError('unknown partition {0!r}, expected one of {1!r}'
+                             .format(partition, sorted(PERIODS)))
 
-        self.storage = storage_client
+        if storage_client is None and storage_config is None:
+            raise RuntimeError('must pass either storage_client or '
+                               'storage_config')
+
+        if storage_config is not None:
+            storage_config = dblogger.pool.copy_config(storage_config)
+        self.storage_config = storage_config
         self.table_name = table_name
-        storage_client.setup_namespace({table_name: 1})
-        self.sequence_number = 0
+        self.index = index
+        self.partition = partition
+        #: tables set up on every storage client the handler uses
+        self._tables = {}
+        if partition is None:
+            self._tables.update(self._table_defs(table_name))
+        else:
+            self._tables.update(registry_table(table_name))
+
+        self.stats_interval = stats_interval
+        self.stats_logger = stats_logger
+        self.stats_table = None
+        self._next_stats = None
+        if stats_interval is not None:
+            self._next_stats = time.time() + stats_interval
+            if stats_logger is None:
+                self.stats_table = stats_table or table_name + STATS_SUFFIX
+                self._tables[self.stats_table] = 1
+                if codec == 'split':
+                    self._tables[self.stats_table + BODY_SUFFIX] = 1
+
+        self.flush_timeout = flush_timeout
+        self._writer_options = None
+        if batch or queue_size is not None or segment_size:
+            if not isinstance(overflow_level, (int, long)):
+                overflow_level = logging.getLevelName(overflow_level)
+                if not isinstance(overflow_level, int):
+                    raise ValueError('unknown overflow_level {0!r}'
+                                     .format(overflow_level))
+            self._writer_options = dict(
+                max_count=batch_count, max_bytes=batch_bytes,
+                max_age=batch_age, close_timeout=flush_timeout,
+                max_queue=queue_size, overflow=overflow,
+                overflow_level=overflow_level, block_timeout=block_timeout,
+                report_interval=drop_report_interval,
+                segment_size=segment_size)
+
+        self._limiter = None
+        if rate_limits:
+            self._limiter = RateLimiter(
+                dblogger.pool.copy_config(rate_limits),
+                report_interval=suppress_report_interval)
+
+        self._dedup = None
+        if dedup_window is not None:
+            self._dedup = Deduplicator(dedup_window, max_span=dedup_max_span,
+                                       samples=dedup_samples)
+
+        self._spill_options = None
+        if spill_dir is not None:
+            self._spill_options = dict(
+                directory=spill_dir, prefix=table_name,
+                max_bytes=spill_max_bytes, put_budget=put_budget,
+                retry_interval=retry_interval)
+
+        #: process the storage client and writer belong to
+        self._pid = None
+        self._storage = storage_client
+        self._writer = None
+        self._spill = None
+        self._sweep_stop = None
+        self._sweeper = None
+        self._stats = HandlerStats()
+        if storage_client is not None:
+            self._connect()
+
+    @property
+    def storage(self):
+        '''Storage client for this process, connecting if needed.'''
+        if self._pid != os.getpid():
+            self._connect()
+        return self._storage
+
+    @property
+    def writer(self):
+        '''Batch writer for this process, or :const:`None`.'''
+        if self._pid != os.getpid():
+            self._connect()
+        return self._writer
+
+    def _connect(self):
+        '''Set up storage and the batch writer for this process.
+
+        This runs on first use, and again on first use in a process
+        forked after that, which inherits neither the parent's
+        writer thread nor a safe share of its connection.  The new
+        process counts its own :meth:`stats`.
 
-    def formatDBTime(self, record):
-        record.humantime = time.strftime('%Y-%m-%dT%H:%M:%S-%Z',
-                                         time.localtime(record.created))
+        '''
+        self.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            if self.storage_config is not None:
+                self._storage = dblogger.pool.client(self.storage_config)
+            dblogger.pool.setup_namespace(self._storage, self._tables)
+            #: (table name, start, end) of the last partition written to
+            self._partition = None
+            self._partitions = set()
+            self._partition_lock = threading.Lock()
+            if self._pid is not None:
+                self._stats = HandlerStats()
+            if self._spill_options is not None:
+                self._spill = Spill(self._storage, **self._spill_options)
+            if self._writer_options is not None:
+                # the parent's buffered records are the parent's to write
+                self._writer = BatchWriter(
+                    self._storage, report_callback=self._dropped_summary,
+                    segment_tables=(self.table_name,), stats=self._stats,
+                    spill=self._spill, close_callback=self._store_held,
+                    **self._writer_options)
+            if self._dedup is not None:
+                self._start_sweeper()
+            self._pid = os.getpid()
+        finally:
+            self.release()
+
+    def _start_sweeper(self):
+        '''Start the thread that stores ended runs of repeats.'''
+        self._sweep_stop = stop = threading.Event()
+        sweeper = threading.Thread(target=self._sweep_loop, args=(stop,),
+                                   name='dblogger-dedup')
+        sweeper.daemon = True
+        sweeper.start()
+        self._sweeper = sweeper
+
+    def _sweep_loop(self, stop):
+        interval = max(self._dedup.window, 0.01)
+        while not stop.wait(interval):
+            self.acquire()
+            try:
+                self._dedup.sweep(time.time())
+                self._store_repeats()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.release()
+
+    def _table_defs(self, table_name):
+        '''Get the definitions of a log table and its companions.'''
+        tables = {table_name: 1}
+        if self.index:
+            tables.update(index_tables(table_name))
+        if self.codec == 'split':
+            tables[table_name + BODY_SUFFIX] = 1
+        return tables
+
+    def _table_for(self, created):
+        '''Get the table to write a record created at `created` to.
+
+        With `partition`, this sets up and registers each partition
+        the first time it is used.  This may be called from the
+        writer thread as well as from :meth:`emit`.
+
+        '''
+        if self.partition is None:
+            return self.table_name
+        current = self._partition
+        if current is not None and current[1] <= created < current[2]:
+            return current[0]
+        name, start, end = partition_for(self.table_name, self.partition,
+                                         created)
+        with self._partition_lock:
+            if name not in self._partitions:
+                dblogger.pool.setup_namespace(self._storage,
+                                              self._table_defs(name))
+                self._put(self.table_name + REGISTRY_SUFFIX,
+                          ((name,), registry_value(start, end)))
+                if self._writer is not None:
+                    self._writer.segment_tables.add(name)
+                self._partitions.add(name)
+            self._partition = (name, start, end)
+        return name
+
+    def flush(self):
+        '''Wait for buffered records to be written.
+
+        This stores any repeats held back by `dedup_window`.  If the
+        handler was created with ``batch=True``, it then waits at most
+        `flush_timeout` seconds for buffered records.
+
+        '''
+        if self._dedup is not None:
+            self.acquire()
+            try:
+                self._dedup.sweep(None)
+                self._store_repeats()
+            finally:
+                self.release()
+        writer = self._own_writer()
+        if writer is not None:
+            writer.flush(self.flush_timeout)
+
+    def close(self):
+        '''Write out buffered records and release the handler.
+
+        If the handler was created with ``batch=True``, this stops
+        the background writer, waiting at most `flush_timeout`
+        seconds for buffered records.
+
+        '''
+        self._store_held()
+        writer = self._own_writer()
+        if writer is not None:
+            writer.close(self.flush_timeout)
+        if self._pid == os.getpid() and self._spill is not None:
+            self._spill.close()
+        super(DatabaseLogHandler, self).close()
+
+    def _store_held(self):
+        '''Store held repeats and summaries of suppressed records.
+
+        This stores every record held back by `dedup_window` and the
+        pending summaries of records `rate_limits` suppressed, after
+        stopping the thread that stores ended runs of repeats.  It
+        runs from :meth:`close`, and from the batch writer's
+        :mod:`atexit` hook before that closes the writer, since
+        :func:`logging.shutdown` only closes handlers afterwards.
+
+        '''
+        if self._sweep_stop is not None:
+            # a daemon thread still waiting when the interpreter
+            # exits fails noisily, so wait for it to stop
+            self._sweep_stop.set()
+            self._sweeper.join(self.flush_timeout)
+        self.acquire()
+        try:
+            if self._dedup is not None:
+                self._dedup.sweep(None)
+                self._store_repeats()
+            if self._limiter is not None and self._limiter.suppressed:
+                self._emit_suppressed()
+        finally:
+            self.release()
+
+    def stats(self):
+        '''Get the handler's metrics.
+
+        :return: dictionary described in :mod:`dblogger.stats`
+
+        '''
+        writer = self._own_writer()
+        if writer is None:
+            snapshot = self._stats.snapshot()
+        else:
+            snapshot = self._stats.snapshot(
+                dropped=writer.dropped_total, queue_depth=writer.depth,
+                max_queue_depth=writer.max_depth)
+        if self._pid == os.getpid() and self._spill is not None:
+            snapshot.update(self._spill.counters())
+        if self._limiter is not None:
+            snapshot['suppressed'] = self._limiter.suppressed_total
+        return snapshot
+
+    def _own_writer(self):
+        '''Get this process's batch writer without connecting.'''
+        if self._pid != os.getpid():
+            return None
+        return self._writer
+
+    def _emit_stats(self):
+        '''Write or log a record of the current :meth:`stats`.'''
+        snapshot = self.stats()
+        fields = flatten(snapshot)
+        fields.update(
+            name='dblogger.stats', levelno=logging.INFO, levelname='INFO',
+            msg='%d records emitted, %d failed, %d dropped, %d bytes '
+            'written, put p99 %s seconds',
+            args=(snapshot['emitted'], snapshot['failures'],
+                  snapshot['dropped'], snapshot['bytes_written'],
+                  snapshot['put']['p99']))
+        record = logging.makeLogRecord(fields)
+        if self.stats_logger is not None:
+            logging.getLogger(self.stats_logger).handle(record)
+            return
+        dbrec, body, failure = self._serialize(record)
+        key = (gen_key(record.created),)
+        rows = []
+        if body is not None:
+            rows.append((self.stats_table + BODY_SUFFIX, key, body))
+        if self.writer is not None:
+            self.writer.put(self.stats_table, key, dbrec, record.levelno,
+                            rows)
+            return
+        self._put(self.stats_table, (key, dbrec))
+        for table, key, value in rows:
+            self._put(table, (key, value))
+
+    def _put(self, table_name, *keys_and_values):
+        '''Write rows to storage now, counting them in :meth:`stats`.
+
+        With `spill_dir`, rows that cannot be written, or that arrive
+        while the spill file is diverting, are spilled instead.
+
+        '''
+        storage = self.storage
+        spill = self._spill
+        if spill is not None and spill.diverting():
+            spill.append([(table_name, k, v) for k, v in keys_and_values])
+            return
+        start = time.time()
+        try:
+            storage.put(table_name, *keys_and_values)
+        except Exception:
+            self._stats.record_put(time.time() - start, len(keys_and_values),
+                                   0, failed=True)
+            if spill is None:
+                raise
+            spill.spill_failed(sys.exc_info(),
+                               [(table_name, k, v)
+                                for k, v in keys_and_values])
+            return
+        elapsed = time.time() - start
+        self._stats.record_put(elapsed, len(keys_and_values),
+                               sum(len(v) for k, v in keys_and_values))
+        if spill is not None:
+            spill.observe(elapsed)
 
     @classmethod
     def deserialize(cls, rec_pickle):
+        '''Convert a stored value back to a :class:`logging.LogRecord`.
+
+        This reads both compact records and legacy pickled records.
+
+        '''
+        if dblogger.codec.is_encoded(rec_pickle):
+            try:
+                return dblogger.codec.decode(rec_pickle)
+            except Exception:
+                return logging.makeLogRecord(
+                    {'msg': 'warning!!!! failed to decode: %r' % rec_pickle})
+
         try:
             xdict = pickle.loads(rec_pickle)
 
@@ -106,59 +775,149 @@ class DatabaseLogHandler(logging.Handler):
 
         return logging.makeLogRecord(xdict)
 
+    def _emit_suppressed(self):
+        '''Store a record for each logger with suppressed records.'''
+        for name, count in self._limiter.take_report():
+            record = logging.makeLogRecord(dict(
+                name='dblogger', levelno=logging.WARNING,
+                levelname='WARNING',
+                msg='%d records suppressed from %s', args=(count, name),
+                suppressed=count, suppressed_logger=name))
+            self._store_record(record)
+
+    def _store_repeats(self):
+        '''Store the records collapsed by the deduplicator.'''
+        for record in self._dedup.take_ready():
+            self._store_record(record)
+
+    def _store_record(self, record):
+        '''Serialize and store a record the handler made itself.'''
+        dbrec, body, failure = self._serialize(record)
+        self.store(record.created, record.levelno, record.name, dbrec, body)
+
+    def _dropped_summary(self, dropped):
+        '''Build a record reporting records dropped by the writer.
+
+        This is the writer's `report_callback`; it returns a list of
+        ``(table_name, key, value)`` triples.
+
+        '''
+        record = logging.makeLogRecord(dict(
+            name='dblogger', levelno=logging.WARNING, levelname='WARNING',
+            msg='dropped %d log records because the log queue was full',
+            args=(dropped,), dropped=dropped))
+        dbrec, body, failure = self._serialize(record)
+        new_uuid = gen_key(record.created)
+        table = self._table_for(record.created)
+        triples = [(table, (new_uuid,), dbrec)]
+        triples.extend(self._secondary_rows(table, record.levelno,
+                                            record.name, new_uuid, body))
+        return triples
+
+    def _secondary_rows(self, table_name, levelno, name, new_uuid, body):
+        '''Get ``(table_name, key, value)`` rows other than the record's.'''
+        rows = []
+        if body is not None:
+            rows.append((table_name + BODY_SUFFIX, (new_uuid,), body))
+        rows.extend((table, key, '') for (table, key)
+                    in self._index_keys(table_name, levelno, name, new_uuid))
+        return rows
+
+    def _index_keys(self, table_name, levelno, name, new_uuid):
+        '''Get ``(table_name, key)`` index entries for a record.'''
+        if not self.index:
+            return []
+        keys = []
+        if isinstance(levelno, (int, long)):
+            keys.append((table_name + LEVEL_INDEX_SUFFIX,
+                         (levelno, new_uuid)))
+        if isinstance(name, basestring):
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            parts = name.split('.')
+            for i in xrange(len(parts)):
+                keys.append((table_name + NAME_INDEX_SUFFIX,
+                             ('.'.join(parts[:i + 1]), new_uuid)))
+        return keys
+
     def emit(self, record):
         '''
         handle a record by formatting parts of it, and pushing it into
         storage.
         '''
-        self.format(record)
-        self.formatDBTime(record)
-
-        failure = []
-        if record.args:
-            try:
-                # cannot serialize arbitrary args, because they might not be
-                # picklable, so do the string now
-                record.msg = record.msg % record.args
-                record.args = None
-            except Exception, exc:
-                failure.append('failed to run string formatting on '
-                               'provided args')
-                failure.append(traceback.format_exc(exc))
-                failure.append('record.msg = %r' % record.msg)
-                failure.append('record.args = %r' % (record.args,))
-                failure.append('logging failed so shutting down entire '
-                               'process')
-
-        if record.exc_info:
-            record.exc_text = logging._defaultFormatter.formatException(
-                record.exc_info)
-        else:
-            record.exc_text = ''
+        dedup = self._dedup
+        if dedup is not None:
+            if dedup.sweep_due(record.created):
+                dedup.sweep(record.created)
+            held = dedup.absorb(record)
+            if dedup.ready:
+                self._store_repeats()
+            if held:
+                return
+
+        limiter = self._limiter
+        if limiter is not None:
+            if limiter.report_due():
+                self._emit_suppressed()
+            if not limiter.allow(record.name, record.levelno):
+                return
+
+        start = time.time()
+        dbrec, body, failure = self._serialize(record)
+        format_seconds = time.time() - start
+
+        if not failure:
+            self.store(record.created, record.levelno, record.name, dbrec,
+                       body, format_seconds)
+            return
 
-        # NB: This is safe because emit() is called from handler() under
-        # self.lock
-        new_uuid = gen_uuid(record.created, self.sequence_number)
-        self.sequence_number += 1
+        # send it to the DB... especially if it is a failure
+        if self.writer is not None:
+            self.writer.flush(self.flush_timeout)
+        self._stats.record_emit(format_seconds, emitted=False, failed=True)
+        self._put(self._table_for(record.created),
+                  ((gen_key(record.created),), dbrec))
+        # shutdown the process when logging fails, unless asked to
+        # keep going whatever happens to the logs
+        if self._spill_options is None:
+            sys.exit(dbrec)
 
-        try:
-            dbrec = pickle.dumps(record.__dict__,
-                                 protocol=pickle.HIGHEST_PROTOCOL)
-        except Exception, exc:
-            failure.append('failed to dump log record, will shutdown')
-            failure.append(traceback.format_exc(exc))
-            failure.append('failed to pickle the __dict__ on: record=%r'
-                           % record)
-            failure.append('failed to pickle: record.__dict__=%r'
-                           % record.__dict__)
-            failure.append('logging failed so shutting down entire process')
+    def store(self, created, levelno, name, dbrec, body=None,
+              format_seconds=None):
+        '''Store a record that is already serialized.
 
-        if failure:
-            dbrec = '\n'.join(failure)
+        This does everything :meth:`emit` does after serializing a
+        record: it keys, indexes, and writes or buffers the record,
+        and counts it in :meth:`stats`.  Callers on other threads must
+        hold the handler's lock, as :meth:`emit` does.
 
-        # send it to the DB... especially if it is a failure
-        self.storage.put(self.table_name, ((new_uuid,), dbrec))
+        :param float created: record creation time
+        :param int levelno: record level
+        :param str name: logger name
+        :param str dbrec: serialized record
+        :param str body: serialized body for the ``split`` codec
+        :param float format_seconds: time spent serializing, if known
+        :return: :const:`False` if the batch writer dropped the record
 
-        if failure:
-            # shutdown the process when logging fails
-            sys.exit(dbrec)
+        '''
+        writer = self.writer
+        if self._next_stats is not None and created >= self._next_stats:
+            self._next_stats = created + self.stats_interval
+            self._emit_stats()
+
+        new_uuid = gen_key(created)
+        table_name = self._table_for(created)
+        if writer is not None:
+            emitted = writer.put(
+                table_name, (new_uuid,), dbrec, levelno,
+                self._secondary_rows(table_name, levelno, name, new_uuid,
+                                     body))
+            self._stats.record_emit(format_seconds, emitted=emitted)
+            return emitted
+
+        self._put(table_name, ((new_uuid,), dbrec))
+        self._stats.record_emit(format_seconds)
+        for table, key, value in self._secondary_rows(
+                table_name, levelno, name, new_uuid, body):
+            self._put(table, (key, value))
+        return True
@@ -0,0 +1,239 @@
+'''Write retrieved log records in several output formats.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:program:`dblogger` uses :class:`RecordWriter` to print the records
+a query returns.  The formats are:
+
+``fixed``
+    one line per record from a :class:`logging.Formatter`, by
+    default the configured console formatter
+
+``jsonl``
+    one JSON object per line
+
+``json``
+    a single JSON array of objects
+
+``tsv``
+    one line per record of tab-separated values, with tabs,
+    newlines, and backslashes escaped as ``\\t``, ``\\n``, and
+    ``\\\\``
+
+The structured formats write only the record fields named in
+`fields`, so records read with ``lazy=True`` never decode the rest.
+Output is written in chunks rather than a line at a time, except
+when following new records.
+
+.. autoclass:: RecordWriter
+
+'''
+from __future__ import absolute_import
+
+import json
+import logging
+
+from dblogger.codec import FIELDS
+from dblogger.format import FixedWidthFormatter
+
+#: Names of the formats :class:`RecordWriter` supports
+OUTPUT_FORMATS = ('fixed', 'json', 'jsonl', 'tsv')
+
+#: Fields written by the ``tsv`` format if none are given
+DEFAULT_TSV_FIELDS = ('created', 'levelname', 'name', 'filename', 'lineno',
+                      'message')
+
+#: Format used by ``fixed`` output without a configured console handler
+DEFAULT_FIXED_FORMAT = ('%(asctime)-23s pid=%(process)-5d '
+                        '%(fixed_width_filename_lineno)s '
+                        '%(fixed_width_levelname)s %(message)s')
+
+_REPEAT_FIELDS = ('repeat_count', 'repeat_first', 'repeat_last')
+_TSV_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def console_formatter():
+    '''Get the formatter of the root logger's console handler.
+
+    If the root logger has no :class:`logging.StreamHandler` with a
+    formatter, this returns a :class:`dblogger.FixedWidthFormatter`
+    with the default ``fixed`` format.
+
+    '''
+    formatter = None
+    for handler in logging.getLogger().handlers:
+        if (isinstance(handler, logging.StreamHandler) and
+                handler.formatter is not None):
+            formatter = handler.formatter
+    if formatter is None:
+        formatter = FixedWidthFormatter(DEFAULT_FIXED_FORMAT)
+    return formatter
+
+
+def record_field(record, field):
+    '''Get one field of a record, or :const:`None` if it is missing.
+
+    ``message`` is the formatted message, computed if the record
+    does not already have it.
+
+    '''
+    if field == 'message':
+        message = getattr(record, 'message', None)
+        if message is None:
+            message = record.getMessage()
+        return message
+    return getattr(record, field, None)
+
+
+def repeat_suffix(record):
+    '''Describe how often a collapsed record repeated, if it did.'''
+    count = getattr(record, 'repeat_count', None)
+    if count is None or count <= 1:
+        return ''
+    return ' [repeated {0} times over {1:.1f} seconds]'.format(
+        count, record.repeat_last - record.repeat_first)
+
+
+def _as_text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_as_text(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _as_text(v)) for k, v in value.iteritems())
+    return value
+
+
+class RecordWriter(object):
+    '''Write records to a file in one of :data:`OUTPUT_FORMATS`.
+
+    Lines are collected and written `chunk_size` at a time; call
+    :meth:`close` to write the rest and finish the output.  With
+    `flush` set, every record is written and flushed as it arrives.
+
+    '''
+    def __init__(self, out, output_format='fixed', fields=None,
+                 formatter=None, chunk_size=1000, flush=False):
+        '''Create a writer.
+
+        :param file out: file to write to
+        :param str output_format: one of :data:`OUTPUT_FORMATS`
+        :param list fields: record fields for the structured formats;
+          by default all of :data:`dblogger.codec.FIELDS` that are set
+          for ``json`` and ``jsonl``, and :data:`DEFAULT_TSV_FIELDS`
+          for ``tsv``
+        :param formatter: :class:`logging.Formatter` for ``fixed``,
+          by default :func:`console_formatter`
+        :param int chunk_size: lines to collect before writing
+        :param bool flush: write and flush each record immediately
+        :raise exceptions.ValueError: if `output_format` is unknown
+
+        '''
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format {0!r}'
+                             .format(output_format))
+        self.out = out
+        self.output_format = output_format
+        if fields is None and output_format == 'tsv':
+            fields = DEFAULT_TSV_FIELDS
+        self.fields = fields and tuple(fields)
+        if output_format == 'fixed' and formatter is None:
+            formatter = console_formatter()
+        self.formatter = formatter
+        self.chunk_size = 1 if flush else chunk_size
+        self.flush = flush
+        #: number of records written
+        self.count = 0
+        self._lines = []
+        self._format = getattr(self, '_format_' + output_format)
+        if output_format == 'json':
+            self._lines.append('[')
+
+    def write(self, record):
+        '''Write one record.'''
+        line = self._format(record)
+        if self.output_format != 'json':
+            self._lines.append(line + '\n')
+        else:
+            self._lines.append((',\n' if self.count else '\n') + line)
+        self.count += 1
+        if len(self._lines) >= self.chunk_size:
+            self._write_lines()
+
+    def write_all(self, records, limit=None):
+        '''Write records from an iterable, at most `limit` of them.
+
+        :return: number of records written
+
+        '''
+        count = self.count
+        write = self.write
+        for record in records:
+            if limit is not None and self.count - count >= limit:
+                break
+            write(record)
+        return self.count - count
+
+    def close(self):
+        '''Write any collected lines and finish the output.'''
+        if self.output_format == 'json':
+            self._lines.append('\n]\n' if self.count else ']\n')
+        self._write_lines()
+
+    def _write_lines(self):
+        if self._lines:
+            self.out.write(''.join(self._lines))
+            self._lines = []
+        if self.flush:
+            self.out.flush()
+
+    def _format_fixed(self, record):
+        if not isinstance(record, logging.LogRecord):
+            record = record.to_record()
+        return self.formatter.format(record) + repeat_suffix(record)
+
+    def _values(self, record):
+        '''Get the fields of `record` to write as a dictionary.'''
+        if self.fields is not None:
+            return dict((field, record_field(record, field))
+                        for field in self.fields)
+        values = {}
+        for field in FIELDS:
+            value = record_field(record, field)
+            if value is not None:
+                values[field] = value
+        if getattr(record, 'repeat_count', None) is not None:
+            for field in _REPEAT_FIELDS:
+                values[field] = getattr(record, field)
+        return values
+
+    def _dumps(self, values):
+        try:
+            return json.dumps(values, sort_keys=True, default=repr)
+        except UnicodeDecodeError:
+            return json.dumps(_as_text(values), sort_keys=True,
+                              default=repr)
+
+    def _format_jsonl(self, record):
+        return self._dumps(self._values(record))
+
+    _format_json = _format_jsonl
+
+    def _format_tsv(self, record):
+        cells = []
+        for field in self.fields:
+            value = record_field(record, field)
+            if value is None:
+                cells.append('')
+                continue
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif not isinstance(value, str):
+                value = repr(value) if isinstance(value, float) \
+                    else str(value)
+            for char, escape in _TSV_ESCAPES:
+                if char in value:
+                    value = value.replace(char, escape)
+            cells.append(value)
+        return '\t'.join(cells)
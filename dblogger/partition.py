@@ -0,0 +1,107 @@
+'''Time partitioning of log tables.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`dblogger.DatabaseLogHandler` created with `partition` set
+to ``hour`` or ``day`` writes each record to a table for the UTC hour
+or day it was created in, named after the base table and the period,
+such as ``log_2026_10_18`` or ``log_2026_10_18_14``.  Index and body
+tables for split records are per partition as well, such as
+``log_2026_10_18_level``.
+
+Every partition is recorded in a registry table, named after the
+base table plus ``_partitions``, keyed by partition table name with
+the period's start and end times as the value.  A
+:class:`dblogger.DBLoggerQuery` created with ``partitioned=True``
+reads the registry to scan only the partitions that overlap a query,
+and deletes whole partitions by clearing their tables.
+
+.. autofunction:: partition_for
+.. autofunction:: registry_table
+.. autofunction:: registered
+.. autofunction:: registry_value
+
+'''
+from __future__ import absolute_import
+
+import time
+
+#: Length in seconds of each supported partition period
+PERIODS = {
+    'hour': 3600,
+    'day': 86400,
+}
+
+#: Suffix of the name of the partition registry table
+REGISTRY_SUFFIX = '_partitions'
+
+_FORMATS = {
+    'hour': '%Y_%m_%d_%H',
+    'day': '%Y_%m_%d',
+}
+
+
+def partition_for(table_name, period, timestamp):
+    '''Get the partition holding records created at some time.
+
+    :param str table_name: name of the base log table
+    :param str period: ``hour`` or ``day``
+    :param float timestamp: record creation time
+    :return: triple of partition table name, start time, and end time
+    :raise exceptions.ValueError: if `period` is unknown
+
+    '''
+    length = PERIODS.get(period)
+    if length is None:
+        raise ValueError('unknown partition period {0!r}, expected one '
+                         'of {1!r}'.format(period, sorted(PERIODS)))
+    start = int(timestamp // length) * length
+    name = '{0}_{1}'.format(table_name,
+                            time.strftime(_FORMATS[period],
+                                          time.gmtime(start)))
+    return name, start, start + length
+
+
+def registry_table(table_name):
+    '''Get the kvlayer table definition for a partition registry.
+
+    :param str table_name: name of the base log table
+    :return: dictionary suitable for
+      :meth:`kvlayer.AbstractStorage.setup_namespace`
+
+    '''
+    return {table_name + REGISTRY_SUFFIX: (str,)}
+
+
+def registry_value(start, end):
+    '''Encode a partition's period for the registry.'''
+    return '{0} {1}'.format(start, end)
+
+
+def registered(storage, table_name, begin=None, end=None):
+    '''List the partitions that overlap a time range.
+
+    The registry table must already be set up.
+
+    :param storage: storage client
+    :type storage: :class:`kvlayer.AbstractStorage`
+    :param str table_name: name of the base log table
+    :param float begin: earliest time of interest, or :const:`None`
+    :param float end: latest time of interest, or :const:`None`
+    :return: list of (start, end, partition table name), in order
+
+    '''
+    partitions = []
+    for key, value in storage.scan(table_name + REGISTRY_SUFFIX):
+        try:
+            start, stop = [int(v) for v in value.split()]
+        except ValueError:
+            continue
+        if begin is not None and stop <= begin:
+            continue
+        if end is not None and start > end:
+            continue
+        partitions.append((start, stop, key[0]))
+    partitions.sort()
+    return partitions
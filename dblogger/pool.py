@@ -0,0 +1,137 @@
+'''Shared :mod:`kvlayer` clients for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+Every handler configured with the same `storage_config` in one
+process shares one storage client from :func:`client`, so a program
+with many loggers, or a worker pool forking many children, sets up a
+client once per process rather than once per handler.  Clients are
+never shared across a :func:`os.fork`: the first call in a new
+process discards the parent's clients and makes its own.
+
+:func:`setup_namespace` remembers which tables each client has
+already set up, so that handlers sharing a client, and handlers
+writing to a new partition or reconnecting after a fork, only make
+the :meth:`~kvlayer.AbstractStorage.setup_namespace` round trip for
+tables the client has not seen.  Tables are assumed to exist for as
+long as the client does; call :func:`clear` after deleting a
+namespace out from under a pooled client.
+
+.. autofunction:: client
+.. autofunction:: setup_namespace
+.. autofunction:: table_spec
+.. autofunction:: clear
+.. autofunction:: copy_config
+
+'''
+from __future__ import absolute_import
+
+import os
+import threading
+import weakref
+
+import kvlayer
+import yakonfig
+
+_lock = threading.Lock()
+#: process that owns :data:`_clients`
+_pid = os.getpid()
+_clients = {}
+#: storage client to dictionary of table name to key spec
+_known_tables = weakref.WeakKeyDictionary()
+
+
+def copy_config(config):
+    '''Copy a configuration into plain dictionaries and lists.
+
+    A handler created by :mod:`logging.config` gets its
+    `storage_config` as a converting dictionary tied to the whole
+    logging configuration; this keeps only the values.
+
+    '''
+    if isinstance(config, dict):
+        return dict((k, copy_config(v)) for k, v in config.iteritems())
+    if isinstance(config, (list, tuple)):
+        return [copy_config(v) for v in config]
+    return config
+
+
+def _freeze(config):
+    '''Make a hashable pool key from a configuration dictionary.'''
+    if isinstance(config, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in config.iteritems()))
+    if isinstance(config, (list, tuple)):
+        return tuple(_freeze(v) for v in config)
+    return config
+
+
+def _check_pid():
+    '''Forget the clients of the process this one was forked from.'''
+    global _lock, _pid, _clients
+    if _pid != os.getpid():
+        # the parent's lock may have been held at the fork
+        _lock = threading.Lock()
+        _clients = {}
+        _pid = os.getpid()
+
+
+def client(storage_config):
+    '''Get the shared storage client for a configuration.
+
+    :param dict storage_config: :mod:`kvlayer` configuration
+    :return: storage client for this process
+    :rtype: :class:`kvlayer.AbstractStorage`
+
+    '''
+    key = _freeze(storage_config)
+    _check_pid()
+    with _lock:
+        storage = _clients.get(key)
+        if storage is None:
+            with yakonfig.defaulted_config(
+                    [kvlayer], config=dict(kvlayer=storage_config)):
+                storage = kvlayer.client()
+            _clients[key] = storage
+        return storage
+
+
+def setup_namespace(storage, tables):
+    '''Set up the tables `storage` has not already set up.
+
+    :param storage: storage client
+    :type storage: :class:`kvlayer.AbstractStorage`
+    :param dict tables: table name to key spec, as for
+      :meth:`kvlayer.AbstractStorage.setup_namespace`
+
+    '''
+    _check_pid()
+    with _lock:
+        known = _known_tables.setdefault(storage, {})
+        missing = dict((name, spec) for name, spec in tables.iteritems()
+                       if known.get(name) != spec)
+        if not missing:
+            return
+        storage.setup_namespace(missing)
+        known.update(missing)
+
+
+def table_spec(storage, table_name):
+    '''Get the key spec a table was set up with through this module.
+
+    :return: the key spec, or :const:`None` if the table is unknown
+
+    '''
+    known = _known_tables.get(storage)
+    if known is None:
+        return None
+    return known.get(table_name)
+
+
+def clear():
+    '''Forget every pooled client and every table set up.'''
+    global _clients
+    _check_pid()
+    with _lock:
+        _clients = {}
+        _known_tables.clear()
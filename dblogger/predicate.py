@@ -0,0 +1,305 @@
+'''Structured filters on stored log record fields.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:meth:`dblogger.DBLoggerQuery.filter` accepts a `where` argument
+describing conditions on log record fields.  This may be a
+dictionary, mapping a field name to a value that must be equal, a
+list, tuple, or set of acceptable values, or a compiled regular
+expression that must match somewhere in the field.  It may also be
+a list of condition strings of the form ``FIELD OP VALUE``, as
+accepted by :option:`dblogger --where`, where ``OP`` is one of:
+
+``=`` or ``==``, ``!=``
+    equal or not equal to `VALUE`
+
+``<``, ``<=``, ``>``, ``>=``
+    compare with `VALUE`, numerically if the field is a number
+
+``=~``
+    the regular expression `VALUE` matches somewhere in the field
+
+``in``
+    equal to one of the comma-separated values in `VALUE`
+
+Any stored field can be named, including custom attributes passed
+through a logging call's ``extra`` parameter.  ``level`` is an alias
+for ``levelno``, and comparisons against it also accept level names,
+so ``level>=WARNING`` works.  A record that does not have the field
+at all never matches.
+
+Conditions are checked cheapest first.  For records in the compact
+format of :mod:`dblogger.codec`, conditions on stored fields are
+checked before the record is fully decoded, and records that fail
+them are never turned into :class:`logging.LogRecord` objects.
+
+.. autofunction:: compile_where
+.. autofunction:: parse_condition
+.. autoclass:: Condition
+.. autoclass:: Where
+
+'''
+from __future__ import absolute_import
+
+import logging
+import re
+
+from dblogger import codec
+
+#: Numeric fields, cheapest to compare
+NUMERIC_FIELDS = frozenset(['created', 'levelno', 'lineno', 'process',
+                            'thread', 'msecs', 'relativeCreated'])
+
+#: Fields that may hold long text, most expensive to compare
+TEXT_FIELDS = frozenset(['message', 'msg', 'exc_text'])
+
+_ALIASES = {'level': 'levelno'}
+
+_condition_re = re.compile(r'^\s*(?P<field>\w+)\s*'
+                           r'(?P<op>==|=~|!=|<=|>=|=|<|>|\s+in\s+)\s*'
+                           r'(?P<value>.*?)\s*$')
+
+_missing = object()
+
+# fields that dblogger.codec.decode_fields() returns as-is
+_STORED = codec.FIELDS - frozenset(['extras'])
+
+
+class Condition(object):
+    '''One condition on one log record field.
+
+    Calling the condition with the field's value returns whether the
+    condition holds.
+
+    '''
+    def __init__(self, field, op, value):
+        '''Create a new condition.
+
+        :param str field: name of the log record field
+        :param str op: one of ``==``, ``!=``, ``<``, ``<=``, ``>``,
+          ``>=``, ``=~``, ``in``, ``match``, which is like ``=~`` but
+          anchored at the start of the field, or ``logger``, which
+          matches a logger name and its descendants
+        :param value: value to compare against; a collection for
+          ``in``, and a string or compiled pattern for ``=~`` and
+          ``match``
+        :raise exceptions.ValueError: if `op` is unknown
+
+        '''
+        field = _ALIASES.get(field, field)
+        self.field = field
+        self.op = op
+        self.value = value
+        self.number = _to_number(field, value)
+        if op in ('=~', 'match'):
+            if isinstance(value, basestring):
+                value = re.compile(value)
+            find = value.search if op == '=~' else value.match
+            self.test = lambda actual: (isinstance(actual, basestring) and
+                                        find(actual) is not None)
+        elif op == 'in':
+            self.values = set(value)
+            self.numbers = set(_to_number(field, v) for v in value)
+            self.numbers.discard(None)
+            self.test = self._test_in
+        elif op == 'logger':
+            prefix = value + '.'
+            self.test = lambda actual: (actual == value or
+                                        (isinstance(actual, basestring) and
+                                         actual.startswith(prefix)))
+        elif op in _COMPARE:
+            compare = _COMPARE[op]
+            self.test = lambda actual: compare(actual, self._literal(actual))
+        else:
+            raise ValueError('unknown operator {0!r}'.format(op))
+
+        self.cost = 1
+        if field in NUMERIC_FIELDS:
+            self.cost = 0
+        elif field in TEXT_FIELDS:
+            self.cost = 2
+        if op in ('=~', 'match'):
+            self.cost += 2
+
+    def __call__(self, actual):
+        if actual is _missing:
+            return False
+        return self.test(actual)
+
+    def __repr__(self):
+        return 'Condition({0!r}, {1!r}, {2!r})'.format(self.field, self.op,
+                                                       self.value)
+
+    def _literal(self, actual):
+        if (self.number is not None and not isinstance(actual, basestring)
+                and isinstance(actual, (int, long, float))):
+            return self.number
+        return self.value
+
+    def _test_in(self, actual):
+        if isinstance(actual, (int, long, float)) and \
+                not isinstance(actual, bool):
+            return actual in self.numbers or actual in self.values
+        return actual in self.values
+
+
+_COMPARE = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+}
+
+
+def _to_number(field, value):
+    '''Interpret `value` as a number for numeric comparisons.'''
+    if isinstance(value, (int, long, float)):
+        return value
+    if not isinstance(value, basestring):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if field == 'levelno':
+        level = logging.getLevelName(value.upper())
+        if isinstance(level, int):
+            return level
+    return None
+
+
+def parse_condition(expr):
+    '''Parse a ``FIELD OP VALUE`` condition string.
+
+    :param str expr: condition string
+    :return: parsed condition
+    :rtype: :class:`Condition`
+    :raise exceptions.ValueError: if `expr` cannot be parsed
+
+    '''
+    match = _condition_re.match(expr)
+    if not match:
+        raise ValueError('cannot parse condition {0!r}, expected '
+                         'FIELD OP VALUE'.format(expr))
+    op = match.group('op').strip()
+    value = match.group('value')
+    if op == '=':
+        op = '=='
+    elif op == 'in':
+        value = [v.strip() for v in value.split(',')]
+    return Condition(match.group('field'), op, value)
+
+
+class Where(object):
+    '''A compiled conjunction of :class:`Condition` objects.'''
+    def __init__(self, conditions):
+        self.conditions = sorted(conditions, key=lambda c: c.cost)
+        #: conditions that can be checked by :meth:`match_fields`
+        self.stored = [c for c in self.conditions if c.field in _STORED]
+        #: conditions that need a full record
+        self.deferred = [c for c in self.conditions
+                         if c.field not in _STORED]
+        #: conditions that can be checked on a split record's header
+        self.header = [c for c in self.stored
+                       if c.field in codec.HEADER_FIELDS]
+        #: conditions that need a split record's body
+        self.body = [c for c in self.conditions
+                     if c.field not in codec.HEADER_FIELDS]
+
+    def match_fields(self, fields):
+        '''Check conditions on :func:`dblogger.codec.decode_fields` output.
+
+        `fields` may also be a :class:`dblogger.codec.LazyRecord`.
+
+        Only conditions on stored fields are checked; if this returns
+        :const:`True`, :meth:`match` must still be called with
+        ``deferred_only=True`` on the decoded record.
+
+        '''
+        for condition in self.stored:
+            if not condition(fields.get(condition.field, _missing)):
+                return False
+        return True
+
+    def match_header(self, fields):
+        '''Check conditions on the fields of a split record's header.
+
+        This is like :meth:`match_fields`, but only checks conditions
+        on :data:`dblogger.codec.HEADER_FIELDS`; if this returns
+        :const:`True`, :meth:`match` must still be called with
+        ``body_only=True`` on the record with its body.
+
+        '''
+        for condition in self.header:
+            if not condition(fields.get(condition.field, _missing)):
+                return False
+        return True
+
+    def match(self, record, deferred_only=False, body_only=False):
+        '''Check conditions on a :class:`logging.LogRecord`.
+
+        :param record: record to check
+        :param bool deferred_only: only check conditions that
+          :meth:`match_fields` could not
+        :param bool body_only: only check conditions that
+          :meth:`match_header` could not
+        :return: whether every condition holds
+
+        '''
+        conditions = self.conditions
+        if deferred_only:
+            conditions = self.deferred
+        elif body_only:
+            conditions = self.body
+        d = record.__dict__
+        for condition in conditions:
+            if not condition(d.get(condition.field, _missing)):
+                return False
+        return True
+
+
+def compile_where(where=None, level=None, name=None, message_re=None):
+    '''Compile query conditions into a :class:`Where`.
+
+    :param where: dictionary or list of condition strings, as
+      described in the module documentation, or a :class:`Where`
+    :param int level: minimum level number
+    :param str name: logger name, also matching its descendants
+    :param message_re: pattern that must match at the start of the
+      message
+    :return: compiled conditions, or :const:`None` if there are none
+
+    '''
+    conditions = []
+    if isinstance(where, Where):
+        conditions.extend(where.conditions)
+    elif isinstance(where, dict):
+        for field, value in where.iteritems():
+            if isinstance(value, (list, tuple, set, frozenset)):
+                conditions.append(Condition(field, 'in', value))
+            elif hasattr(value, 'search'):
+                conditions.append(Condition(field, '=~', value))
+            else:
+                conditions.append(Condition(field, '==', value))
+    elif where:
+        for expr in where:
+            if isinstance(expr, Condition):
+                conditions.append(expr)
+            else:
+                conditions.append(parse_condition(expr))
+    if level is not None:
+        conditions.append(Condition('levelno', '>=', level))
+    if name is not None:
+        conditions.append(Condition('name', 'logger', name))
+    if message_re is not None:
+        conditions.append(Condition('message', 'match', message_re))
+    if not conditions:
+        return None
+    return Where(conditions)
@@ -24,28 +24,171 @@ This supports the standard :option:`--config <yakonfig --config>`,
 
     Only show messages at or before `time`.
 
+.. option:: --where <condition>
+
+    Only show messages matching `condition`, which has the form
+    ``FIELD OP VALUE``, such as ``levelname=ERROR``,
+    ``process>=1000``, ``funcName in run,stop``, or
+    ``message=~timed out``.  See :mod:`dblogger.predicate` for the
+    full syntax.  This may be given multiple times, and all of the
+    conditions must match.
+
+.. option:: --follow, -f
+
+    After showing the messages so far, keep waiting for and showing
+    new messages until interrupted.  :option:`--end` is ignored.
+
+.. option:: --cursor <file>
+
+    With :option:`--follow`, resume from the position saved in
+    `file`, if it exists, and save the position there on exit.
+
+.. option:: --lookback <seconds>
+
+    With :option:`--follow`, read messages stored up to `seconds`
+    after the time they were logged.  Messages stored later than
+    that, such as those replayed from a spill file, are not shown;
+    those found within twice `seconds` are counted on standard
+    error with their time range, to look up with :option:`--begin`
+    and :option:`--end`.  See :mod:`dblogger.follow`.
+
+.. option:: --last <n>, -n <n>
+
+    Show the `n` most recent messages, oldest first, like
+    :command:`tail -n`.  These are found by reading backwards from
+    :option:`--end`, or now, so this is fast however much is stored.
+    :option:`--past` is ignored, but :option:`--begin` still limits
+    how far back to look.  See :meth:`DBLoggerQuery.newest`.  If the
+    ``logging`` configuration has :class:`~dblogger.DatabaseLogHandler`
+    handlers for the table and none of them sets ``segment_size``,
+    the table is taken to hold no segments, which saves reading
+    :data:`~dblogger.segment.MAX_SEGMENT_SPAN` seconds further back.
+
+.. option:: --clear
+
+    Delete the messages between the beginning and end times, after
+    confirming the namespace, rather than showing them.  This
+    deletes whole stored rows without reading them; see
+    :meth:`DBLoggerQuery.delete_range`.  :program:`dblogger-retention`
+    deletes everything older than a cutoff.
+
+.. option:: --indexed
+
+    With :option:`--clear`, also delete the level and logger name
+    index entries of deleted messages, for tables written with
+    ``index: true``.
+
+.. option:: --partitioned
+
+    Read the hourly or daily tables written by handlers with
+    ``partition`` set, as described in :mod:`dblogger.partition`.
+
+.. option:: --parallel <n>
+
+    Scan the time range as `n` shards concurrently.  Messages are
+    still shown in order.  This requires both a beginning and an end
+    time, possibly implied by :option:`--past`.
+
+.. option:: --format <format>
+
+    Write messages as ``fixed`` width text, the default, using the
+    configured console formatter; as a ``json`` array; as ``jsonl``,
+    one JSON object per line; or as ``tsv``, tab-separated values.
+    See :mod:`dblogger.output`.  With a format other than ``fixed``,
+    the closing count of messages goes to standard error.
+
+.. option:: --fields <field,...>
+
+    With a :option:`--format` other than ``fixed``, write only these
+    record fields, such as ``created,levelname,message``.  Records
+    stored in the compact format only decode the fields written.
+
+.. option:: --limit <n>
+
+    Stop after showing `n` messages.
+
+.. option:: --count-only
+
+    Print only the number of matching messages.
+
 '''
 from __future__ import absolute_import
 import argparse
+import heapq
+import itertools
 import logging
+import operator
+import os
+import Queue
 import re
 import sys
+import threading
 import time
 
 import dblogger
-from dblogger.format import FixedWidthFormatter
-from dblogger.logger import DatabaseLogHandler
-from dblogger.utils import gen_uuid
+from dblogger.codec import LazyRecord, decode_fields, has_body, \
+    is_encoded, make_record, merge_body
+from dblogger.follow import DEFAULT_LOOKBACK, FollowCursor
+from dblogger.logger import DatabaseLogHandler, BODY_SUFFIX, \
+    LEVEL_INDEX_SUFFIX, NAME_INDEX_SUFFIX, index_tables
+from dblogger.output import OUTPUT_FORMATS, RecordWriter
+from dblogger.partition import REGISTRY_SUFFIX, registered, registry_table
+from dblogger.pool import table_spec
+from dblogger.predicate import compile_where
+from dblogger.segment import MAX_SEGMENT_SPAN, is_segment, \
+    unpack as unpack_segment
+from dblogger.utils import gen_uuid, tick_uuid, time_tick, uuid_time
 import kvlayer
 import streamcorpus
 import yakonfig
 
 class DBLoggerQuery(object):
-    def __init__(self, storage_client, table_name="log"):
+    '''Read log records stored by :class:`dblogger.DatabaseLogHandler`.
+
+    If `indexed` is true, the level and logger name indexes the
+    handler maintains with ``index=True`` are used to answer
+    :meth:`filter` queries with `level` or `name`.  Records written
+    by handlers without indexing are not found by those queries.
+
+    If `partitioned` is true, records written by handlers with
+    `partition` set are read from the partitions listed in the
+    registry described in :mod:`dblogger.partition`, as well as from
+    `table_name` itself.  Only the partitions that overlap a query's
+    time range are scanned.
+
+    If `segmented` is false, the table is taken to hold no segments
+    (see :mod:`dblogger.segment`), as when no handler writing it has
+    `segment_size` set.  Only :meth:`newest` depends on this.
+
+    '''
+    #: Number of primary rows fetched per :meth:`get` for index queries
+    fetch_batch = 1000
+
+    def __init__(self, storage_client, table_name="log", indexed=False,
+                 partitioned=False, segmented=True):
         self.storage = storage_client
         self.table_name = table_name
-        self.last_uuid = None
+        self.indexed = indexed
+        self.partitioned = partitioned
+        self.segmented = segmented
+        self._body_ready = False
+        self._partition_queries = {}
         storage_client.setup_namespace({ table_name : 1 })
+        if indexed:
+            storage_client.setup_namespace(index_tables(table_name))
+        if partitioned:
+            storage_client.setup_namespace(registry_table(table_name))
+
+    def _partition(self, table_name):
+        '''Get a query over one partition table.'''
+        query = self._partition_queries.get(table_name)
+        if query is None:
+            query = type(self)(self.storage, table_name,
+                               indexed=self.indexed,
+                               segmented=self.segmented)
+            query.fetch_batch = self.fetch_batch
+            self._partition_queries[table_name] = query
+        return query
 
     def build_key_range(self, uuid_start=None, uuid_end=None):
         key_start = tuple()
@@ -59,46 +202,887 @@ class DBLoggerQuery(object):
 
         return (key_start, key_end)
 
+    @staticmethod
+    def repeat_count(record):
+        '''Get the number of records a stored record stands for.
+
+        This is the ``repeat_count`` of a record that collapsed
+        repeats, as described in :mod:`dblogger.dedup`, and 1 for any
+        other record.
+
+        '''
+        count = getattr(record, 'repeat_count', None)
+        if count is None:
+            return 1
+        return count
 
-    def filter(self, begin=None, end=None, filter_str=None, tail=False):
+
+    def filter(self, begin=None, end=None, filter_str=None, tail=False,
+               level=None, name=None, where=None, parallel=None,
+               readahead=1000, lazy=False):
         """Get log record from the database.
 
         begin and end must be timestamp as returned by time.time().
 
-        filter_str() -- An dict of filters that will match agaist log record
-        fields. Not Implemented yet.
+        filter_str() -- A regular expression that must match at the
+        start of the record's message.
+
+        `where` gives conditions on any record fields, as described
+        in :mod:`dblogger.predicate`; for example,
+        ``where={'threadName': 'worker-1', 'lineno': [10, 20]}`` or
+        ``where=['process>=100', 'funcName in run,stop']``.  For
+        records in the compact format, these and the other conditions
+        are checked before the record is fully decoded.
+
+        If `level` is given, only records at that level or above are
+        returned.  If `name` is given, only records from that logger
+        or its descendants are returned.  When the query is `indexed`
+        and not a `tail` query, these scan the smaller index tables
+        and then fetch only the matching records; otherwise they are
+        checked against every scanned record.
+
+        If `tail` is true, this never stops, and instead keeps
+        yielding records as they are written, as :meth:`follow` does;
+        `end` and `parallel` are then ignored.
+
+        If `lazy` is true, records stored in the compact format of
+        :mod:`dblogger.codec` are yielded as
+        :class:`dblogger.codec.LazyRecord` views, which decode most
+        fields only when they are read.  Legacy pickled records are
+        still yielded as :class:`logging.LogRecord`.  Pass a view's
+        :meth:`~dblogger.codec.LazyRecord.to_record` to
+        :meth:`logging.Formatter.format`.
+
+        Rows holding segments of several records (see
+        :mod:`dblogger.segment`) are unpacked, and each record is
+        yielded with its own key, in key order.  Records written with
+        the ``split`` codec are filtered on their header fields
+        first, and the bodies of the matching records are then
+        fetched in bulk; these are never lazy.
+
+        If `parallel` is more than 1 and both `begin` and `end` are
+        given, the time range is split into that many equal shards,
+        which are scanned, filtered, and decoded concurrently on
+        separate threads.  Each shard reads at most `readahead`
+        records ahead of the caller, and the shards are merged so
+        that records are still yielded in key order.  This helps
+        most on backends where a single scan is bound by round-trip
+        latency rather than throughput.  The storage client must be
+        safe to use from several threads.
 
         """
 
-        uuid_begin = uuid_end = None
+        if tail:
+            for item in self.follow(begin=begin, filter_str=filter_str,
+                                    level=level, name=name, where=where,
+                                    lazy=lazy):
+                yield item
+            return
+
+        args = (begin, end, filter_str, level, name, where, parallel,
+                readahead, lazy)
+        if not self.partitioned:
+            for item in self._filter_table(*args):
+                yield item
+            return
+
+        # partitions cover disjoint periods, in order, but records
+        # written without partitioning can be at any time
+        partitions = itertools.chain.from_iterable(
+            self._partition(table)._filter_table(*args)
+            for start, stop, table in registered(self.storage,
+                                                 self.table_name,
+                                                 begin, end))
+        for item in heapq.merge(self._filter_table(*args), partitions):
+            yield item
+
+    def _filter_table(self, begin, end, filter_str, level, name, where,
+                      parallel, readahead, lazy):
+        '''Implement :meth:`filter` on this query's own table.'''
+        uuid_begin = uuid_end = scan_begin = None
         if begin:
             uuid_begin = gen_uuid(begin)
+            # a segment is keyed by its first record, so one holding
+            # records at `begin` can start up to MAX_SEGMENT_SPAN earlier
+            scan_begin = gen_uuid(begin - MAX_SEGMENT_SPAN)
         if end:
             uuid_end = gen_uuid(end)
-        key_range = self.build_key_range(uuid_begin, uuid_end)
+        key_range = self.build_key_range(scan_begin, uuid_end)
+
+        level = _level_number(level)
+        accept = compile_where(where, level=level, name=name,
+                               message_re=filter_str or None)
+
+        if self.indexed and (level is not None or name is not None):
+            uuids = self._index_scan(uuid_begin, uuid_end, level, name)
+            items = (self._decode(item, uuid_begin, uuid_end, accept, lazy)
+                     for item in self._fetch(uuids))
+            for item in self._attach_bodies(itertools.ifilter(None, items),
+                                            accept):
+                yield item
+            return
+
+        if parallel > 1 and begin and end:
+            shards = self._shard_ranges(begin - MAX_SEGMENT_SPAN, end,
+                                        parallel)
+            for item in self._parallel_scan(shards, uuid_begin, uuid_end,
+                                            accept, lazy, readahead):
+                yield item
+            return
+
+        for item in self._scan_range(key_range, uuid_begin, uuid_end,
+                                     accept, lazy):
+            yield item
+
+    def follow(self, cursor=None, begin=None, filter_str=None, level=None,
+               name=None, where=None, lookback=DEFAULT_LOOKBACK,
+               min_interval=0.01, max_interval=2.0, idle_timeout=None,
+               lazy=False, rescan_interval=1.0, late_callback=None):
+        """Yield log records as they are written.
+
+        This polls the table for rows written since the last poll.
+        The poll interval starts at `min_interval` seconds, doubles
+        after every poll that finds nothing, up to `max_interval`,
+        and drops back as soon as anything arrives, so an idle table
+        costs one cheap key scan every `max_interval` seconds.
+
+        Most polls only scan keys after the newest row read so far,
+        so they cost as much as the new rows they find.  Rows that
+        arrive late, keyed before that, are found by rescanning the
+        last `lookback` seconds of keys at most every
+        `rescan_interval` seconds.
+
+        Progress is kept in `cursor`, a
+        :class:`dblogger.follow.FollowCursor`, which is updated as
+        each record is yielded.  It can be saved at any point and
+        passed back in to resume where it left off, with no record
+        yielded twice or skipped.  Rows are read in key order within
+        each poll.
+
+        A row stored more than `lookback` seconds behind the time in
+        its key, after a rescan has passed it, is not read.  Such
+        rows found within another `lookback` seconds are counted in
+        the cursor's :attr:`~dblogger.follow.FollowCursor.late` and
+        passed to `late_callback` as ``late_callback(count, begin,
+        end)``, where `begin` and `end` bound the rows' keys, so a
+        reader can fetch them with :meth:`filter`; see
+        :mod:`dblogger.follow`.
+
+        `filter_str`, `level`, `name`, and `where` select records,
+        and `lazy` chooses the kind of record, as in :meth:`filter`.
+
+        :param cursor: position to resume from
+        :type cursor: :class:`dblogger.follow.FollowCursor`
+        :param float begin: if there is no `cursor`, start at this
+          time rather than now
+        :param float lookback: seconds a row may arrive late
+        :param float min_interval: shortest seconds between polls
+        :param float max_interval: longest seconds between polls
+        :param float idle_timeout: stop once nothing new has arrived
+          for this many seconds, or :const:`None` to never stop
+        :param float rescan_interval: shortest seconds between scans
+          for late rows
+        :param late_callback: called for rows found too late to read
+        :return: iterator of ``(key, record)``
+
+        """
+        if cursor is None:
+            cursor = FollowCursor(begin=begin)
+        accept = compile_where(where, level=_level_number(level), name=name,
+                               message_re=filter_str or None)
+        uuid_begin = None
+        if cursor.begin:
+            uuid_begin = tick_uuid(time_tick(cursor.begin))
 
-        if filter_str:
-            filter_re = re.compile(filter_str)
+        interval = min_interval
+        last_new = time.time()
+        last_rescan = None
+        while True:
+            now = time.time()
+            after = cursor.after
+            rescan = (cursor.high is None or last_rescan is None or
+                      now - last_rescan >= rescan_interval)
+            if rescan:
+                last_rescan = now
+            elif after is None or cursor.high > after:
+                after = cursor.high
+            start = cursor.checked if rescan else after
+            keys = []
+            forgotten = []
+            for source in self._follow_sources(start):
+                for key in self.storage.scan_keys(
+                        source.table_name, self.build_key_range(start)):
+                    if after is not None and key[0] <= after:
+                        forgotten.append(key[0])
+                    elif key[0] not in cursor.seen:
+                        keys.append((key[0], source))
+            keys.sort(key=operator.itemgetter(0))
+            if rescan and cursor.counts:
+                for begin, end, count in cursor.count_late(forgotten):
+                    if late_callback is not None:
+                        late_callback(count, uuid_time(begin),
+                                      uuid_time(end))
+            for item in self._follow_rows(cursor, keys, uuid_begin, accept,
+                                          lazy):
+                yield item
+            if rescan:
+                # only a rescan has read every row stored by `now`
+                cursor.advance(now, lookback)
+
+            if keys:
+                interval = min_interval
+                last_new = time.time()
+                continue
+            if (idle_timeout is not None and
+                    time.time() - last_new >= idle_timeout):
+                return
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def _follow_sources(self, after):
+        '''Get queries over every table that may have rows after `after`.'''
+        sources = [self]
+        if self.partitioned:
+            since = after and uuid_time(after)
+            sources.extend(self._partition(table) for start, stop, table
+                           in registered(self.storage, self.table_name,
+                                         since))
+        return sources
+
+    def _follow_rows(self, cursor, keys, uuid_begin, accept, lazy):
+        '''Yield wanted records from rows, marking them read in `cursor`.
 
+        `keys` is a list of pairs of row key and the query whose
+        table holds the row.
+
+        '''
+        keys = iter(keys)
         while True:
-            for key, rec_pickle in self.storage.scan(self.table_name, key_range):
+            chunk = list(itertools.islice(keys, self.fetch_batch))
+            if not chunk:
+                break
+            by_source = {}
+            for row, source in chunk:
+                by_source.setdefault(source, []).append((row,))
+            values = {}
+            for source, rows in by_source.iteritems():
+                values.update((key[0], value) for key, value in
+                              self.storage.get(source.table_name, *rows))
+            for row, source in chunk:
+                value = values.get(row)
+                records = []
+                if value is not None:
+                    records = self._row_records(row, value)
+                start = 0
+                if cursor.partial is not None and cursor.partial[0] == row:
+                    start = cursor.partial[1]
+                for index in xrange(start, len(records)):
+                    # mark before yielding, since the caller may stop
+                    # (and save the cursor) at any record
+                    cursor.partial = (row, index + 1)
+                    item = self._decode(records[index], uuid_begin, None,
+                                        accept, lazy)
+                    if item is not None:
+                        for item in source._attach_bodies([item], accept):
+                            yield item
+                cursor.seen.add(row)
+                if cursor.high is None or row > cursor.high:
+                    cursor.high = row
+                cursor.partial = None
+
+    def newest(self, begin=None, end=None, filter_str=None, level=None,
+               name=None, where=None, lazy=False, window=0.1):
+        """Yield log records newest first.
+
+        This reads backwards from `end`, by default now, in windows
+        of stored keys that start `window` seconds wide and double in
+        width each time, so finding the most recent records costs
+        about the same however much older data there is.  It stops
+        at `begin`, or at the oldest stored row.
+
+        A stored segment (see :mod:`dblogger.segment`) is keyed by
+        its first record, so a record is only yielded after every row
+        that could hold a newer one has been read, which is
+        :data:`~dblogger.segment.MAX_SEGMENT_SPAN` seconds of rows
+        further back.  If the query is not `segmented`, rows are
+        taken to hold only their own record until a segment is
+        found, so the query costs no more than the rows actually
+        yielded.  Records are only decoded as they are yielded.
+
+        `filter_str`, `level`, `name`, and `where` select records,
+        and `lazy` chooses the kind of record, as in :meth:`filter`.
+        The level and name indexes are not used.  The kvlayer
+        storage API only scans forwards, so each window is scanned
+        in key order and then reversed.
+
+        :param float begin: earliest time to yield records from
+        :param float end: latest time to yield records from
+        :param float window: width in seconds of the first window
+        :return: iterator of ``(key, record)``, in decreasing key order
+
+        """
+        accept = compile_where(where, level=_level_number(level), name=name,
+                               message_re=filter_str or None)
+        if end is None:
+            end = time.time()
+        uuid_end = tick_uuid(time_tick(end), last=True)
+        span = time_tick(MAX_SEGMENT_SPAN)
+        uuid_begin = None
+        if begin is not None:
+            uuid_begin = tick_uuid(time_tick(begin))
+            # rows older than this cannot hold records after `begin`
+            floor = time_tick(begin) - span
+        else:
+            floor = self._oldest_tick()
+            if floor is None:
+                return
+
+        # (negated key, key, stored record, query) of records not
+        # yet known to be the newest left
+        pending = []
+        margin = span if self.segmented else 0
+        hi = time_tick(end)
+        size = max(1, time_tick(window))
+        while True:
+            lo = max(hi - size + 1, floor)
+            key_range = ((tick_uuid(lo),), (tick_uuid(hi, last=True),))
+            for source in self._newest_sources(lo, hi):
+                for key, value in self.storage.scan(source.table_name,
+                                                    key_range):
+                    if is_segment(value):
+                        margin = span
+                    for rec_uuid, rec_value in source._row_records(key[0],
+                                                                   value):
+                        if uuid_begin is not None and rec_uuid < uuid_begin:
+                            continue
+                        if rec_uuid > uuid_end:
+                            continue
+                        heapq.heappush(pending, (-rec_uuid.int, rec_uuid,
+                                                 rec_value, source))
+            done = lo <= floor
+            # rows before `lo` only hold records before `lo + margin`
+            safe = tick_uuid(lo + margin).int
+            ready = []
+            while pending and (done or -pending[0][0] >= safe):
+                ready.append(heapq.heappop(pending)[1:])
+            for source, items in itertools.groupby(
+                    ready, key=operator.itemgetter(2)):
+                decoded = (source._decode((rec_uuid, rec_value), None, None,
+                                          accept, lazy)
+                           for rec_uuid, rec_value, _ in items)
+                for item in source._attach_bodies(
+                        itertools.ifilter(None, decoded), accept):
+                    yield item
+            if done:
+                return
+            hi = lo - 1
+            size *= 2
+
+    def last(self, count, begin=None, end=None, filter_str=None, level=None,
+             name=None, where=None, lazy=False):
+        """Get the last `count` log records, like :command:`tail -n`.
 
-                ## what is the purpose of these three lines?
-                if key[0] == self.last_uuid:
-                    break
-                self.last_uuid = key[0]
-                ##  ^^^^^ why? ^^^^^^^^
+        The records are found with :meth:`newest`, and the arguments
+        are the same.
 
-                record = DatabaseLogHandler.deserialize(rec_pickle)
-                if filter_str and not filter_re.match(record.message):
+        :param int count: number of records to get
+        :return: list of up to `count` ``(key, record)``, oldest first
+
+        """
+        if count <= 0:
+            return []
+        records = list(itertools.islice(
+            self.newest(begin=begin, end=end, filter_str=filter_str,
+                        level=level, name=name, where=where, lazy=lazy),
+            count))
+        records.reverse()
+        return records
+
+    def _oldest_tick(self):
+        '''Get the time tick of the oldest stored row, if there is one.'''
+        ticks = []
+        for key in self.storage.scan_keys(self.table_name):
+            ticks.append(time_tick(uuid_time(key[0])))
+            break
+        if self.partitioned:
+            partitions = registered(self.storage, self.table_name)
+            if partitions:
+                ticks.append(time_tick(partitions[0][0]))
+        if not ticks:
+            return None
+        return min(ticks)
+
+    def _newest_sources(self, lo, hi):
+        '''Get the queries over every table that may have rows in a window.'''
+        sources = [self]
+        if self.partitioned:
+            sources.extend(self._partition(table) for start, stop, table
+                           in registered(self.storage, self.table_name,
+                                         lo / 1024.0, (hi + 1) / 1024.0))
+        return sources
+
+    def _scan_range(self, key_range, uuid_begin, uuid_end, accept, lazy):
+        '''Scan one key range, yielding wanted ``(key, record)`` in order.'''
+        return self._attach_bodies(
+            self._scan_rows(key_range, uuid_begin, uuid_end, accept, lazy),
+            accept)
+
+    def _scan_rows(self, key_range, uuid_begin, uuid_end, accept, lazy):
+        pending = []
+        for key, value in self.storage.scan(self.table_name, key_range):
+            self._push_row(pending, key[0], value)
+            while pending and pending[0][0] <= key[0]:
+                item = self._decode(heapq.heappop(pending), uuid_begin,
+                                    uuid_end, accept, lazy)
+                if item is not None:
+                    yield item
+        while pending:
+            item = self._decode(heapq.heappop(pending), uuid_begin,
+                                uuid_end, accept, lazy)
+            if item is not None:
+                yield item
+
+    def _shard_ranges(self, begin, end, shards):
+        '''Split the keys between two times into `shards` key ranges.'''
+        tick_begin = time_tick(begin)
+        tick_end = time_tick(end)
+        shards = max(1, min(shards, tick_end - tick_begin + 1))
+        step = float(tick_end - tick_begin + 1) / shards
+        starts = [tick_begin + int(i * step) for i in xrange(shards)]
+        ends = [s - 1 for s in starts[1:]] + [tick_end]
+        return [((tick_uuid(lo),), (tick_uuid(hi, last=True),))
+                for lo, hi in zip(starts, ends)]
+
+    def _parallel_scan(self, key_ranges, uuid_begin, uuid_end, accept, lazy,
+                       readahead):
+        '''Scan key ranges on threads, merging the results in key order.'''
+        stop = threading.Event()
+        queues = []
+        for key_range in key_ranges:
+            out = Queue.Queue(maxsize=readahead)
+            worker = threading.Thread(
+                target=self._shard_worker, name='dblogger-shard',
+                args=(key_range, uuid_begin, uuid_end, accept, lazy, out,
+                      stop))
+            worker.daemon = True
+            worker.start()
+            queues.append(out)
+        try:
+            for item in heapq.merge(*[_drain(q) for q in queues]):
+                yield item
+        finally:
+            # releases workers still waiting for room if the caller
+            # stopped early
+            stop.set()
+
+    def _shard_worker(self, key_range, uuid_begin, uuid_end, accept, lazy,
+                      out, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        try:
+            for item in self._scan_range(key_range, uuid_begin, uuid_end,
+                                         accept, lazy):
+                if not put((_RECORD, item)):
+                    return
+            put((_DONE, None))
+        except Exception:
+            put((_ERROR, sys.exc_info()))
+
+    def _row_records(self, row_uuid, value):
+        '''Get the ``(UUID, stored record)`` pairs in one stored row.'''
+        if is_segment(value):
+            try:
+                return unpack_segment(value)
+            except Exception:
+                pass
+        return [(row_uuid, value)]
+
+    def _push_row(self, pending, row_uuid, value):
+        '''Push the records in one stored row onto the `pending` heap.'''
+        for item in self._row_records(row_uuid, value):
+            heapq.heappush(pending, item)
+
+    def _decode(self, item, uuid_begin, uuid_end, accept, lazy=False):
+        '''Get ``(key, record)``, or :const:`None` if it is not wanted.
+
+        `accept` is a :class:`dblogger.predicate.Where` or
+        :const:`None`.  Cheap checks run first: the key against the
+        time range, then, for compact records, conditions on the
+        stored fields, and only then is the record fully decoded.
+        If `lazy` is true, compact records that pass are returned as
+        :class:`dblogger.codec.LazyRecord` views, and only decoded
+        if a condition needs the full record.  Split headers that
+        pass conditions on their own fields are returned as
+        placeholders for :meth:`_attach_bodies` to complete.
+
+        '''
+        rec_uuid, rec_value = item
+        if uuid_begin is not None and rec_uuid < uuid_begin:
+            return None
+        if uuid_end is not None and rec_uuid > uuid_end:
+            return None
+        if has_body(rec_value):
+            try:
+                fields = decode_fields(rec_value)
+            except Exception:
+                fields = None
+            if fields is not None:
+                if accept is not None and not accept.match_header(fields):
+                    return None
+                return (rec_uuid,), _Header(fields)
+        if is_encoded(rec_value) and (lazy or accept is not None):
+            try:
+                if lazy:
+                    fields = LazyRecord(rec_value)
+                else:
+                    fields = decode_fields(rec_value)
+            except Exception:
+                fields = None
+            if fields is not None:
+                if accept is not None and not accept.match_fields(fields):
+                    return None
+                if lazy:
+                    record = fields
+                    if accept is not None and accept.deferred and \
+                            not accept.match(record.to_record(),
+                                             deferred_only=True):
+                        return None
+                    return (rec_uuid,), record
+                record = make_record(fields)
+                if not accept.match(record, deferred_only=True):
+                    return None
+                return (rec_uuid,), record
+        record = DatabaseLogHandler.deserialize(rec_value)
+        if accept is not None and not accept.match(record):
+            return None
+        return (rec_uuid,), record
+
+    def _attach_bodies(self, items, accept):
+        '''Complete split records from :meth:`_decode` with their bodies.
+
+        Items are passed through in order.  Bodies are fetched
+        :attr:`fetch_batch` at a time, so a run of split records
+        costs one round trip per batch.
+
+        '''
+        pending = []
+        wanted = []
+        for item in items:
+            is_header = isinstance(item[1], _Header)
+            if not is_header and not pending:
+                yield item
+                continue
+            pending.append(item)
+            if is_header:
+                wanted.append(item[0])
+                if len(wanted) >= self.fetch_batch:
+                    for item in self._with_bodies(pending, wanted, accept):
+                        yield item
+                    pending = []
+                    wanted = []
+        if pending:
+            for item in self._with_bodies(pending, wanted, accept):
+                yield item
+
+    def _uses_bodies(self, key_range):
+        '''Decide whether the split body table may have rows to delete.
+
+        This avoids setting up a body table for a log table that
+        never used the ``split`` codec.  Unless the table is already
+        set up in this process, this reads the first row in
+        `key_range` and checks it for ``split`` records.
+
+        '''
+        body_table = self.table_name + BODY_SUFFIX
+        if (self._body_ready or
+                table_spec(self.storage, body_table) is not None):
+            return True
+        for key, value in self.storage.scan(self.table_name, key_range):
+            return any(has_body(stored) for u, stored
+                       in self._row_records(key[0], value))
+        return False
+
+    def _body_table(self):
+        '''Get the name of the split body table, setting it up once.'''
+        body_table = self.table_name + BODY_SUFFIX
+        if not self._body_ready:
+            self.storage.setup_namespace({body_table: 1})
+            self._body_ready = True
+        return body_table
+
+    def _with_bodies(self, pending, wanted, accept):
+        bodies = dict(self.storage.get(self._body_table(), *wanted))
+        for key, record in pending:
+            if isinstance(record, _Header):
+                record = record.complete(bodies.get(key), accept)
+                if record is None:
                     continue
-                yield key, record
+            yield key, record
+
+    def delete_range(self, begin=None, end=None, batch_size=1000,
+                     progress=None, pause=0.0):
+        '''Delete every record created from `begin` up to `end`.
+
+        Nothing is decoded: this scans only keys, and deletes them
+        `batch_size` at a time with one multi-key
+        :meth:`~kvlayer.AbstractStorage.delete` per batch, which
+        backends that support it run as a single round trip.  Tables
+        that are entirely in range are instead emptied with
+        :meth:`~kvlayer.AbstractStorage.clear_table`: this is every
+        table if neither `begin` nor `end` is given, and otherwise
+        each partition whose period is within the range, if the query
+        is `partitioned`; such partitions are also removed from the
+        registry.  Bodies of ``split`` records are deleted too, if the
+        body table is already set up in this process or the first row
+        in range holds a ``split`` record, as are index entries if the
+        query is `indexed`.
+
+        A row holding a segment (see :mod:`dblogger.segment`) is
+        deleted whole if its first record is in range, so records up
+        to :data:`~dblogger.segment.MAX_SEGMENT_SPAN` seconds after
+        `end` may also be deleted, and as many seconds before `begin`
+        may be kept.
+
+        :param float begin: earliest creation time to delete, or
+          :const:`None` to delete from the start
+        :param float end: creation time to delete up to but not
+          including, or :const:`None` to delete through the end
+        :param int batch_size: maximum keys per delete call
+        :param progress: called as ``progress(table_name, count)``
+          after each batch, with the rows deleted from that table so
+          far, and with a `count` of :const:`None` after a table is
+          emptied
+        :param float pause: seconds to sleep between batches, to
+          leave room for live writers
+        :return: number of rows deleted from log tables one by one,
+          not counting tables emptied whole
+
+        '''
+        args = (batch_size, progress, pause)
+        deleted = self._delete_table_range(begin, end, *args)
+        if not self.partitioned:
+            return deleted
+        for start, stop, table in registered(self.storage, self.table_name,
+                                             begin, end):
+            query = self._partition(table)
+            if ((begin is None or begin <= start) and
+                    (end is None or stop <= end)):
+                query._delete_table_range(None, None, *args)
+                self.storage.delete(self.table_name + REGISTRY_SUFFIX,
+                                    (table,))
+            else:
+                deleted += query._delete_table_range(begin, end, *args)
+        return deleted
+
+    def _delete_table_range(self, begin, end, batch_size, progress, pause):
+        '''Implement :meth:`delete_range` on this query's own tables.'''
+        lo = hi = ()
+        if begin is not None:
+            lo = (tick_uuid(time_tick(begin)),)
+        if end is not None:
+            tick = time_tick(end) - 1
+            if tick < 0 or (begin is not None and
+                            tick < time_tick(begin)):
+                return 0
+            hi = (tick_uuid(tick, last=True),)
+
+        tables = [self.table_name]
+        if self._uses_bodies((lo, hi)):
+            tables.append(self._body_table())
+        index = []
+        if self.indexed:
+            index = sorted(index_tables(self.table_name))
+
+        if begin is None and end is None:
+            for table in tables + index:
+                self.storage.clear_table(table)
+                if progress is not None:
+                    progress(table, None)
+            return 0
+
+        deleted = 0
+        for table in tables:
+            count = self._delete_keys(
+                table, self.storage.scan_keys(table, (lo, hi)),
+                batch_size, progress, pause)
+            if table == self.table_name:
+                deleted = count
+        for table in index:
+            keys = itertools.chain.from_iterable(
+                self.storage.scan_keys(table, ((p,) + lo, (p,) + hi))
+                for p in self._key_prefixes(table))
+            self._delete_keys(table, keys, batch_size, progress, pause)
+        return deleted
+
+    def _delete_keys(self, table, keys, batch_size, progress, pause):
+        '''Delete `keys` from `table` in batches, returning the count.'''
+        count = 0
+        keys = iter(keys)
+        while True:
+            # materialize each batch before deleting, since deleting
+            # underneath a live scan is not safe on every backend
+            chunk = list(itertools.islice(keys, batch_size))
+            if not chunk:
+                break
+            self.storage.delete(table, *chunk)
+            count += len(chunk)
+            if progress is not None:
+                progress(table, count)
+            if pause:
+                time.sleep(pause)
+        return count
+
+    def _key_prefixes(self, table, start=()):
+        '''Iterate over the distinct first key parts of an index table.
+
+        This skips from one prefix to the next, so it reads one key
+        per distinct level or logger name rather than the whole table.
+        If `start` is given, only prefixes from that key on are found.
+
+        '''
+        while True:
+            first = next(iter(self.storage.scan_keys(table, (start, ()))),
+                         None)
+            if first is None:
+                return
+            prefix = first[0]
+            yield prefix
+            if isinstance(prefix, (int, long)):
+                start = (prefix + 1,)
+            else:
+                start = (prefix + '\x00',)
+
+    def _index_scan(self, uuid_begin, uuid_end, level, name):
+        '''Iterate over the UUIDs of matching records, in order.
+
+        This uses the name index if `name` is given, and otherwise
+        the level index.  Since the level index is ordered by level
+        first, this scans one time range per level at or above
+        `level` that appears in the index, whether or not it is
+        registered with :func:`logging.addLevelName`.
+
+        '''
+        lo = uuid_begin and (uuid_begin,) or ()
+        hi = uuid_end and (uuid_end,) or ()
+        if name is not None:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            table = self.table_name + NAME_INDEX_SUFFIX
+            prefixes = [name]
+        else:
+            table = self.table_name + LEVEL_INDEX_SUFFIX
+            prefixes = list(self._key_prefixes(table, (level,)))
+        scans = [itertools.imap(operator.itemgetter(1),
+                                self.storage.scan_keys(
+                                    table, ((p,) + lo, (p,) + hi)))
+                 for p in prefixes]
+        return heapq.merge(*scans)
 
-            if not tail:
+    def _fetch(self, uuids):
+        '''Get (UUID, stored record) pairs for record UUIDs.
+
+        `uuids` must be in order, and the pairs are produced in the
+        same order.  Records stored in their own rows are fetched
+        directly in batches; records inside segments are found by
+        scanning the few seconds before each.
+
+        '''
+        uuids = iter(uuids)
+        while True:
+            chunk = list(itertools.islice(uuids, self.fetch_batch))
+            if not chunk:
                 break
+            found = {}
+            missing = []
+            for key, value in self.storage.get(self.table_name,
+                                               *[(u,) for u in chunk]):
+                if value is None:
+                    missing.append(key[0])
+                elif is_segment(value):
+                    pending = []
+                    self._push_row(pending, key[0], value)
+                    found.update(pending)
+                else:
+                    found[key[0]] = value
+            if missing:
+                found.update(self._scan_segments(missing))
+            for u in chunk:
+                if u in found:
+                    yield u, found[u]
+
+    def _scan_segments(self, uuids):
+        '''Find records in segments by scanning before each UUID.'''
+        ranges = []
+        for u in sorted(uuids):
+            lo = gen_uuid(uuid_time(u) - MAX_SEGMENT_SPAN)
+            if ranges and lo <= ranges[-1][1]:
+                ranges[-1][1] = u
+            else:
+                ranges.append([lo, u])
+        wanted = set(uuids)
+        found = {}
+        for lo, hi in ranges:
+            for key, value in self.storage.scan(self.table_name,
+                                                ((lo,), (hi,))):
+                pending = []
+                self._push_row(pending, key[0], value)
+                for u, v in pending:
+                    if u in wanted:
+                        found[u] = v
+        return found
+
 
-            time.sleep(1)
-            key_range = self.build_key_range(uuid_begin=self.last_uuid)
+class _Header(object):
+    '''Fields of a split record waiting for its body.'''
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def complete(self, body, accept):
+        '''Get the whole record, or :const:`None` if it is not wanted.'''
+        fields = self.fields
+        if body is not None:
+            try:
+                merge_body(fields, body)
+            except Exception:
+                pass
+        record = make_record(fields)
+        if accept is not None and not accept.match(record, body_only=True):
+            return None
+        return record
+
+
+def _level_number(level):
+    '''Convert a level name to a number, passing numbers and None.'''
+    if level is None or isinstance(level, (int, long)):
+        return level
+    levelno = logging.getLevelName(level)
+    if not isinstance(levelno, int):
+        raise ValueError('unknown level {0!r}'.format(level))
+    return levelno
+
+
+_RECORD, _DONE, _ERROR = range(3)
+
+
+def _drain(out):
+    '''Yield records a shard worker puts on `out` until it finishes.'''
+    while True:
+        kind, item = out.get()
+        if kind == _RECORD:
+            yield item
+        elif kind == _DONE:
+            return
+        else:
+            raise item[0], item[1], item[2]
 
 
 zulu_timestamp_re = re.compile('(?P<year>\d{4})?-?(?P<month>\d{0,2})?-?(?P<day>\d{0,2})?T?(?P<hour>\d{0,2})?:?(?P<minute>\d{0,2})?:?(?P<second>\d{0,2})?.?(?P<microsecond>\d{0,6})?Z?')
@@ -128,6 +1112,40 @@ def main():
                         help='show the most recent N seconds of logs, default N=60. '
                         'If negative, then scan from earliest moment *upto* '
                         'N seconds ago.')
+    parser.add_argument('--where', action='append', default=[],
+                        metavar='CONDITION',
+                        help='only show records where CONDITION, like '
+                        '"levelname=ERROR" or "process>=100", holds; '
+                        'may be repeated')
+    parser.add_argument('-f', '--follow', action='store_true', default=False,
+                        help='keep showing new messages as they arrive')
+    parser.add_argument('--cursor', metavar='FILE',
+                        help='with --follow, resume from and save the '
+                        'position in FILE')
+    parser.add_argument('--lookback', type=float, default=DEFAULT_LOOKBACK,
+                        metavar='SECONDS',
+                        help='with --follow, read messages stored up to '
+                        'SECONDS late (default %(default)s)')
+    parser.add_argument('--parallel', type=int, default=None, metavar='N',
+                        help='scan the time range as N concurrent shards')
+    parser.add_argument('--partitioned', action='store_true', default=False,
+                        help='also read hourly or daily partition tables')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='with --clear, also delete level and logger '
+                        'name index entries')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='fixed',
+                        help='write records as fixed-width text (default), '
+                        'a JSON array, JSON lines, or tab-separated values')
+    parser.add_argument('--fields', metavar='FIELD,...',
+                        help='with a structured --format, write only '
+                        'these record fields')
+    parser.add_argument('-n', '--last', type=int, default=None, metavar='N',
+                        help='show the N most recent messages, reading '
+                        'backwards, rather than the last --past seconds')
+    parser.add_argument('--limit', type=int, default=None, metavar='N',
+                        help='stop after N records')
+    parser.add_argument('--count-only', action='store_true', default=False,
+                        help='only print the number of matching records')
     parser.add_argument('--clear', action='store_true', default=False,
                         help='delete all messages in scan')
     parser.add_argument('-y', '--yes', default=False, action='store_true',
@@ -136,10 +1154,15 @@ def main():
                         'confirmation questions.')
     args = yakonfig.parse_args(parser, [yakonfig, kvlayer, dblogger])
 
+    try:
+        where = compile_where(args.where)
+    except ValueError, exc:
+        parser.error(str(exc))
+
     if args.begin:
         args.begin = streamcorpus.make_stream_time(
             complete_zulu_timestamp(args.begin)).epoch_ticks
-    elif args.past > 0:
+    elif args.past > 0 and args.last is None:
         args.begin = time.time() - args.past
     else:
         args.begin = None
@@ -149,9 +1172,26 @@ def main():
             complete_zulu_timestamp(args.end)).epoch_ticks
     elif args.past < 0:
         args.end = time.time() + args.past
+    elif args.parallel > 1:
+        args.end = time.time()
     else:
         args.end = None
 
+    if args.follow and args.clear:
+        parser.error('--follow cannot be used with --clear')
+    if args.limit is not None and args.limit < 0:
+        parser.error('--limit must not be negative')
+    if args.last is not None and args.follow:
+        parser.error('--last cannot be used with --follow')
+    if args.last is not None and args.last < 0:
+        parser.error('--last must not be negative')
+    if args.count_only and args.follow:
+        parser.error('--count-only cannot be used with --follow')
+    if args.fields and args.format == 'fixed':
+        parser.error('--fields requires --format json, jsonl, or tsv')
+    if where is not None and args.clear:
+        parser.error('--where cannot be used with --clear')
+
     if args.clear:
         namespace = yakonfig.get_global_config('kvlayer')['namespace']
         if not args.assume_yes:
@@ -164,29 +1204,109 @@ def main():
                           .format(args.begin, args.end, namespace))
 
     client = kvlayer.client()
-    query = DBLoggerQuery(client)
-
-    ## rather than specify the format string in a second place, we get
-    ## the configured StreamHandler and use its `format` method
-    logger = logging.getLogger()
-    ch = None
-    for handler in logger.handlers:
-        if isinstance(handler, logging.StreamHandler):
-            ch = handler
-    assert ch, 'must have a StreamHandler configured in order to use dblogger command-line'
-
-    count = 0
-    for key, record in query.filter(args.begin, args.end):
-        print ch.format(record)
-        if args.clear:
-            client.delete(query.table_name, key)
-        count += 1
+    query = DBLoggerQuery(client, indexed=args.indexed,
+                          partitioned=args.partitioned,
+                          segmented=configured_segments(
+                              yakonfig.get_global_config('logging')))
+
+    if args.clear:
+        query.delete_range(args.begin, args.end, progress=print_progress)
+        return
+
+    output_options = dict(output_format=args.format,
+                          fields=args.fields and args.fields.split(','))
+
+    if args.follow:
+        follow(query, args.begin, where, args.cursor, output_options,
+               args.lookback)
+        return
+
+    if args.last is not None:
+        items = query.last(args.last, args.begin, args.end, where=where,
+                           lazy=True)
+    else:
+        items = query.filter(args.begin, args.end, where=where,
+                             parallel=args.parallel, lazy=True)
+    records = (record for key, record in items)
+    if args.limit is not None:
+        records = itertools.islice(records, args.limit)
+    if args.count_only:
+        sys.stdout.write('{0}\n'.format(sum(1 for record in records)))
+        return
+
+    writer = RecordWriter(sys.stdout, **output_options)
+    count = writer.write_all(records)
+    writer.close()
+    ## keep structured output clean for other programs
+    summary = sys.stdout if args.format == 'fixed' else sys.stderr
     if count == 0:
-        print 'no log records found'
+        summary.write('no log records found\n')
     else:
-        print 'returned %d log records' % count
-        if args.clear:
-            print 'and deleted all of them.'
+        summary.write('returned %d log records\n' % count)
+
+
+def configured_segments(config, table_name='log'):
+    '''Decide whether configured handlers may write segments.
+
+    :param dict config: :mod:`logging` configuration dictionary
+    :param str table_name: table the query reads
+    :return: :const:`False` if `config` has
+      :class:`~dblogger.DatabaseLogHandler` handlers writing
+      `table_name` and none of them sets ``segment_size``
+
+    '''
+    handlers = [handler for handler
+                in (config.get('handlers') or {}).itervalues()
+                if str(handler.get('class') or handler.get('()')).endswith(
+                    'DatabaseLogHandler') and
+                handler.get('table_name', 'log') == table_name]
+    if not handlers:
+        return True
+    return any(handler.get('segment_size') for handler in handlers)
+
+
+def print_progress(table_name, count):
+    '''Report :meth:`DBLoggerQuery.delete_range` progress on stdout.'''
+    if count is None:
+        sys.stdout.write('{0}: cleared\n'.format(table_name))
+    else:
+        sys.stdout.write('{0}: deleted {1} keys\n'.format(table_name, count))
+    sys.stdout.flush()
+
+
+def print_late(count, begin, end):
+    '''Report rows :meth:`DBLoggerQuery.follow` found too late.'''
+    sys.stderr.write('dblogger: {0} rows logged between {1} and {2} '
+                     'were stored too late to follow\n'.format(
+                         count,
+                         streamcorpus.make_stream_time(
+                             epoch_ticks=begin).zulu_timestamp,
+                         streamcorpus.make_stream_time(
+                             epoch_ticks=end).zulu_timestamp))
+
+
+def follow(query, begin, where, cursor_path, output_options,
+           lookback=DEFAULT_LOOKBACK):
+    '''Print records as they arrive until interrupted.'''
+    cursor = None
+    if cursor_path and os.path.exists(cursor_path):
+        with open(cursor_path) as f:
+            cursor = FollowCursor.loads(f.read())
+    if cursor is None:
+        cursor = FollowCursor(begin=begin)
+    writer = RecordWriter(sys.stdout, flush=True, **output_options)
+    try:
+        for key, record in query.follow(cursor, where=where, lazy=True,
+                                        lookback=lookback,
+                                        late_callback=print_late):
+            writer.write(record)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        if cursor_path:
+            with open(cursor_path, 'w') as f:
+                f.write(cursor.dumps())
 
 if __name__ == '__main__':
     main()
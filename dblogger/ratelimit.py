@@ -0,0 +1,184 @@
+'''Rate limits and sampling for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`RateLimiter` decides which records a handler stores, so
+that a program stuck logging in a tight loop costs a bounded number
+of database writes per second.  It is configured with a list of
+rules, each a dictionary with these keys:
+
+``logger``
+    name of the logger the rule applies to, along with its
+    descendants; the default, an empty string, matches every logger
+
+``max_level``
+    highest level the rule applies to, as a number or name; the
+    default applies the rule to every level, but setting this to
+    ``WARNING``, for instance, never limits errors
+
+``rate``
+    records per second to keep, or :const:`None` for no limit
+
+``burst``
+    records that may be kept at once after a quiet period, by
+    default the same as `rate`
+
+``sample``
+    fraction of records to keep before applying `rate`, default 1
+
+A record is checked against the rule with the longest matching
+`logger` that covers its level.  Each logger name and level gets its
+own token bucket under a rule, so one noisy logger does not starve
+its siblings.  Records the rule rejects are counted per logger, and
+the handler writes a summary record such as "120 records suppressed
+from worker.fetch" at most every `report_interval` seconds.
+
+.. code-block:: yaml
+
+    logging:
+      handlers:
+        db:
+          class: dblogger.DatabaseLogHandler
+          storage_config: *kvlayer
+          rate_limits:
+            - rate: 100
+              burst: 1000
+              max_level: WARNING
+            - logger: worker.fetch
+              sample: 0.01
+              max_level: INFO
+
+.. autoclass:: RateLimiter
+
+'''
+from __future__ import absolute_import
+
+import logging
+import random
+import time
+
+
+class _Rule(object):
+    '''One rate limit rule, normalized.'''
+    def __init__(self, logger='', max_level=logging.CRITICAL, rate=None,
+                 burst=None, sample=1.0):
+        if not isinstance(max_level, (int, long)):
+            level = logging.getLevelName(max_level)
+            if not isinstance(level, int):
+                raise ValueError('unknown max_level {0!r}'.format(max_level))
+            max_level = level
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if not 0 <= sample <= 1:
+            raise ValueError('sample must be between 0 and 1')
+        self.logger = logger
+        self.max_level = max_level
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.sample = sample
+
+    def matches(self, name, levelno):
+        if levelno > self.max_level:
+            return False
+        return (not self.logger or name == self.logger or
+                name.startswith(self.logger + '.'))
+
+
+class RateLimiter(object):
+    '''Token-bucket rate limits and sampling by logger and level.
+
+    This is not thread-safe; :class:`dblogger.DatabaseLogHandler`
+    calls it from :meth:`~dblogger.DatabaseLogHandler.emit`, under
+    the handler's lock.
+
+    '''
+    def __init__(self, rules, report_interval=60.0, rand=random.random):
+        '''Create a rate limiter.
+
+        :param list rules: rule dictionaries described in
+          :mod:`dblogger.ratelimit`
+        :param float report_interval: minimum seconds between
+          suppression summaries
+        :param rand: function returning a random number in [0, 1)
+        :raise exceptions.ValueError: if a rule is not valid
+
+        '''
+        rules = [_Rule(**rule) for rule in rules]
+        # most specific first, keeping the configured order for ties
+        self.rules = sorted(rules, key=lambda rule: -len(rule.logger))
+        self.report_interval = report_interval
+        self.rand = rand
+        #: (name, levelno) to (rule, bucket), where a bucket is a
+        #: list of [tokens, last refill time]
+        self._buckets = {}
+        #: logger name to records suppressed since the last summary
+        self.suppressed = {}
+        #: records suppressed over the life of the limiter
+        self.suppressed_total = 0
+        self._last_report = time.time()
+
+    def allow(self, name, levelno, now=None):
+        '''Decide whether to keep a record.
+
+        :param str name: logger name
+        :param int levelno: record level
+        :param float now: current time, by default :func:`time.time`
+        :return: :const:`False` if the record should be suppressed
+
+        '''
+        key = (name, levelno)
+        entry = self._buckets.get(key)
+        if entry is None:
+            entry = self._buckets[key] = self._entry(name, levelno)
+        rule, bucket = entry
+        if rule is None:
+            return True
+        if rule.sample < 1 and self.rand() >= rule.sample:
+            return self._suppress(name)
+        if rule.rate is None:
+            return True
+        if now is None:
+            now = time.time()
+        if bucket[1] is None:
+            bucket[1] = now
+        tokens = min(rule.burst,
+                     bucket[0] + max(0.0, now - bucket[1]) * rule.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return self._suppress(name)
+        bucket[0] = tokens - 1
+        return True
+
+    def _entry(self, name, levelno):
+        if not isinstance(name, basestring):
+            name = ''
+        for rule in self.rules:
+            if rule.matches(name, levelno):
+                return rule, [rule.burst, None]
+        return None, None
+
+    def _suppress(self, name):
+        self.suppressed[name] = self.suppressed.get(name, 0) + 1
+        self.suppressed_total += 1
+        return False
+
+    def report_due(self, now=None):
+        '''Decide whether a suppression summary should be written.'''
+        if not self.suppressed:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self._last_report >= self.report_interval
+
+    def take_report(self):
+        '''Get and reset the suppressed counts.
+
+        :return: sorted list of ``(logger_name, count)``
+
+        '''
+        report = sorted(self.suppressed.iteritems())
+        self.suppressed = {}
+        self._last_report = time.time()
+        return report
@@ -0,0 +1,106 @@
+'''Delete old :class:`dblogger.DatabaseLogHandler` records.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+:program:`dblogger-retention` deletes every log record older than a
+cutoff, using :meth:`dblogger.DBLoggerQuery.delete_range`, so it
+never reads or decodes the records themselves.  It is meant to be
+run periodically, for instance from :program:`cron`, to keep a fixed
+number of days of logs.
+
+This supports the standard :option:`--config <yakonfig --config>`,
+:option:`--dump-config <yakonfig --dump-config>`,
+:option:`--verbose <dblogger --verbose>`,
+:option:`--quiet <dblogger --quiet>`, and
+:option:`--debug <dblogger --debug>` options.
+
+.. program:: dblogger-retention
+
+.. option:: --keep-days <n>
+
+    Delete records more than `n` days old.  This is required, and
+    may be fractional.
+
+.. option:: --table <name>
+
+    Delete from the log table `name`, default ``log``.
+
+.. option:: --indexed
+
+    Also delete the level and logger name index entries of deleted
+    records, for tables written with ``index: true``.
+
+.. option:: --partitioned
+
+    Also delete from the hourly or daily tables written by handlers
+    with ``partition`` set.  Partitions that are entirely older than
+    the cutoff are emptied whole, which is much cheaper than deleting
+    their records one by one.
+
+.. option:: --batch-size <n>
+
+    Delete at most `n` keys per database call, default 1000.
+
+.. option:: --pause <seconds>
+
+    Sleep this long between batches, to leave the database room for
+    live writers.
+
+'''
+from __future__ import absolute_import
+import argparse
+import sys
+import time
+
+import dblogger
+from dblogger.query import DBLoggerQuery, print_progress
+import kvlayer
+import yakonfig
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='delete old log messages from kvlayer')
+    parser.add_argument('--keep-days', type=float, required=True,
+                        metavar='N',
+                        help='delete log messages more than N days old')
+    parser.add_argument('--table', default='log', metavar='NAME',
+                        help='log table to delete from, default "log"')
+    parser.add_argument('--indexed', action='store_true', default=False,
+                        help='also delete level and logger name index '
+                        'entries')
+    parser.add_argument('--partitioned', action='store_true', default=False,
+                        help='also delete from hourly or daily partition '
+                        'tables')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        metavar='N',
+                        help='delete at most N keys per call')
+    parser.add_argument('--pause', type=float, default=0.0,
+                        metavar='SECONDS',
+                        help='sleep between batches')
+    args = yakonfig.parse_args(parser, [yakonfig, kvlayer, dblogger])
+
+    if args.keep_days < 0:
+        parser.error('--keep-days must not be negative')
+    if args.batch_size < 1:
+        parser.error('--batch-size must be positive')
+
+    cutoff = time.time() - args.keep_days * 86400
+    sys.stdout.write('deleting log messages before {0} from {1!r}\n'
+                     .format(time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           time.gmtime(cutoff)),
+                             args.table))
+    client = kvlayer.client()
+    query = DBLoggerQuery(client, table_name=args.table,
+                          indexed=args.indexed,
+                          partitioned=args.partitioned)
+    start = time.time()
+    count = query.delete_range(end=cutoff, batch_size=args.batch_size,
+                               progress=print_progress, pause=args.pause)
+    sys.stdout.write('deleted {0} rows in {1:.1f} seconds\n'
+                     .format(count, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
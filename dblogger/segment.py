@@ -0,0 +1,121 @@
+'''Segments packing several stored log records into one value.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+Each log record normally occupies its own :mod:`kvlayer` row, and for
+short messages the per-row overhead of the backend dominates.  A
+:class:`dblogger.DatabaseLogHandler` created with `segment_size`
+instead packs consecutive records into a compressed segment, stored
+in the same table under the key of its first record.  A segment
+value is :data:`MAGIC`, a version byte, and then a :mod:`zlib`
+compressed sequence of records, each a 16-byte key, a 4-byte length,
+and the serialized record.
+
+Records in a segment are in key order and span at most
+:data:`MAX_SEGMENT_SPAN` seconds, so a reader looking for records at
+or after some time only needs to start scanning that long before it.
+:class:`dblogger.DBLoggerQuery` does this, and reads tables holding
+any mix of segments and single-record rows.
+
+.. autofunction:: pack
+.. autofunction:: unpack
+.. autofunction:: is_segment
+
+'''
+from __future__ import absolute_import
+
+import struct
+import uuid
+import zlib
+
+from dblogger.utils import uuid_time
+
+#: Prefix of every segment value
+MAGIC = '\xdbS'
+
+#: Current segment version
+VERSION = 1
+
+#: Maximum seconds between the first and last record in a segment
+MAX_SEGMENT_SPAN = 10.0
+
+#: :mod:`zlib` compression level; favors write speed
+COMPRESS_LEVEL = 1
+
+_PREFIX = MAGIC + chr(VERSION)
+_ENTRY = struct.Struct('>16sI')
+
+
+def is_segment(value):
+    '''Determine whether a stored value is a segment.'''
+    return value[:len(MAGIC)] == MAGIC
+
+
+def pack(pairs, segment_size):
+    '''Pack (key, value) pairs into segments.
+
+    `pairs` are kvlayer (key, value) pairs for a table with a single
+    UUID key.  They are sorted, and then split into groups of at most
+    `segment_size` records spanning at most :data:`MAX_SEGMENT_SPAN`
+    seconds.  Groups of one record are returned unchanged.
+
+    :param list pairs: (key, value) pairs to pack
+    :param int segment_size: maximum records per segment
+    :return: list of (key, value) pairs of segments and single rows
+
+    '''
+    pairs = sorted(pairs)
+    packed = []
+    group = []
+    group_start = None
+    for key, value in pairs:
+        start = uuid_time(key[0])
+        if group and (len(group) >= segment_size or
+                      start - group_start > MAX_SEGMENT_SPAN):
+            packed.append(_pack_group(group))
+            group = []
+        if not group:
+            group_start = start
+        group.append((key, value))
+    if group:
+        packed.append(_pack_group(group))
+    return packed
+
+
+def _pack_group(group):
+    if len(group) == 1:
+        return group[0]
+    parts = []
+    for key, value in group:
+        parts.append(_ENTRY.pack(key[0].bytes, len(value)))
+        parts.append(value)
+    body = zlib.compress(''.join(parts), COMPRESS_LEVEL)
+    return (group[0][0], _PREFIX + body)
+
+
+def unpack(value):
+    '''Unpack a segment.
+
+    :param str value: segment value
+    :return: list of (:class:`uuid.UUID`, serialized record) pairs,
+      in key order
+    :raise exceptions.ValueError: if `value` is not a segment or has
+      an unknown version
+
+    '''
+    if not is_segment(value):
+        raise ValueError('not a log segment')
+    version = ord(value[len(MAGIC)])
+    if version != VERSION:
+        raise ValueError('unknown log segment version {0}'.format(version))
+    body = zlib.decompress(value[len(_PREFIX):])
+    records = []
+    pos = 0
+    size = _ENTRY.size
+    while pos < len(body):
+        key_bytes, length = _ENTRY.unpack_from(body, pos)
+        pos += size
+        records.append((uuid.UUID(bytes=key_bytes), body[pos:pos + length]))
+        pos += length
+    return records
@@ -0,0 +1,317 @@
+'''Local spill files for records the database could not take.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`dblogger.DatabaseLogHandler` with a `spill_dir` never lets
+a database failure reach the program that is logging.  Rows whose
+:meth:`~kvlayer.AbstractStorage.put` raises are appended to a local
+:class:`Spill` file instead, and for `retry_interval` seconds after
+a failure, or after a put slower than `put_budget`, new rows go
+straight to the file without waiting on the database.
+
+Every `retry_interval` seconds a background thread replays spilled
+rows into :mod:`kvlayer` in bulk, in the order they were spilled.
+Rows keep the keys they were given when they were logged, so a
+replay that is interrupted and repeated writes the same rows again
+rather than duplicating them.  A successful replay also ends the
+diversion, so logging goes back to the database directly.
+
+Each process appends to its own file, named for the log table and
+process ID, and sequentially written: every entry is a
+:data:`ENTRY_HEADER` with the length and CRC-32 of a pickled
+``(table_name, key_spec, key, value)`` tuple, so a torn final write
+is detected and skipped.  Before replaying, the thread renames the
+file aside and starts a new one, so appending never waits on a
+replay.  The files of a process that died before replaying them are
+claimed and replayed by the next process spilling to the same
+directory and table.  A process keeps at most `max_bytes` of
+spilled rows on disk, and counts rows beyond that as dropped.
+
+.. autoclass:: Spill
+
+'''
+from __future__ import absolute_import
+
+import cPickle as pickle
+import errno
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+import dblogger.pool
+
+#: Default maximum bytes of spilled rows kept on disk per process
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+#: Entry header: length and CRC-32 of the pickled row
+ENTRY_HEADER = struct.Struct('>Ii')
+
+#: Default maximum rows per replayed put
+REPLAY_ROWS = 1000
+
+
+def _alive(pid):
+    '''Decide whether process `pid` is still running.'''
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+def read_entries(path):
+    '''Read the ``(table_name, key_spec, key, value)`` rows of a file.
+
+    Reading stops quietly at a truncated or corrupt entry.
+
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(ENTRY_HEADER.size)
+            if len(header) < ENTRY_HEADER.size:
+                return
+            length, crc = ENTRY_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                return
+            yield pickle.loads(data)
+
+
+class Spill(object):
+    '''Append-only local spill file with a background replayer.
+
+    :meth:`append` and :meth:`spill_failed` may be called from any
+    thread.  :meth:`spill_failed` has the signature of a
+    :class:`dblogger.writer.BatchWriter` `error_callback`.
+
+    '''
+    def __init__(self, storage, directory, prefix='log',
+                 max_bytes=DEFAULT_MAX_BYTES, put_budget=None,
+                 retry_interval=5.0, replay_rows=REPLAY_ROWS):
+        '''Create a spill file and start its replayer.
+
+        :param storage: storage client to replay into
+        :type storage: :class:`kvlayer.AbstractStorage`
+        :param str directory: existing directory for spill files
+        :param str prefix: file name prefix, normally the log table
+        :param int max_bytes: maximum bytes kept on disk
+        :param float put_budget: seconds a put may take before new
+          rows are diverted, or :const:`None` for no limit
+        :param float retry_interval: seconds to divert rows after a
+          failure, and between replays
+        :param int replay_rows: maximum rows per replayed put
+
+        '''
+        self.storage = storage
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.put_budget = put_budget
+        self.retry_interval = retry_interval
+        self.replay_rows = replay_rows
+        self.pid = os.getpid()
+        self.path = self._name('spill')
+
+        #: rows appended to the spill file
+        self.spilled = 0
+        #: rows not spilled because the file was full
+        self.spill_dropped = 0
+        #: rows written back to storage
+        self.replayed = 0
+        #: bytes of this process's spilled rows on disk
+        self.spill_bytes = 0
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._retry_at = 0.0
+        self._serial = 0
+        self._stop = threading.Event()
+        for path in self._replay_files():
+            self.spill_bytes += os.path.getsize(path)
+        self._thread = threading.Thread(target=self._run,
+                                        name='dblogger-replay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _name(self, kind, pid=None, serial=None):
+        parts = [self.prefix, str(self.pid if pid is None else pid)]
+        if serial is not None:
+            parts.append('%020d' % serial)
+        parts.append(kind)
+        return os.path.join(self.directory, '.'.join(parts))
+
+    def diverting(self):
+        '''Decide whether new rows should go straight to the file.'''
+        return time.time() < self._retry_at
+
+    def trip(self):
+        '''Divert new rows to the file for `retry_interval` seconds.'''
+        self._retry_at = time.time() + self.retry_interval
+
+    def observe(self, seconds):
+        '''Note a successful put, diverting rows if it was too slow.'''
+        if self.put_budget is not None and seconds > self.put_budget:
+            self.trip()
+
+    def append(self, triples):
+        '''Spill ``(table_name, key, value)`` rows.
+
+        :return: number of rows written to the file
+
+        '''
+        entries = []
+        for table_name, key, value in triples:
+            spec = dblogger.pool.table_spec(self.storage, table_name)
+            data = pickle.dumps((table_name, spec, key, value),
+                                pickle.HIGHEST_PROTOCOL)
+            entries.append(ENTRY_HEADER.pack(len(data), zlib.crc32(data)) +
+                           data)
+        with self._lock:
+            written = 0
+            for entry in entries:
+                if self.spill_bytes + len(entry) > self.max_bytes:
+                    self.spill_dropped += len(entries) - written
+                    break
+                if self._file is None:
+                    self._file = open(self.path, 'ab')
+                self._file.write(entry)
+                self.spill_bytes += len(entry)
+                written += 1
+            if self._file is not None:
+                self._file.flush()
+            self.spilled += written
+            return written
+
+    def spill_failed(self, exc_info, triples):
+        '''Spill rows whose write raised, and divert new rows.'''
+        self.trip()
+        self.append(triples)
+
+    def counters(self):
+        '''Get the spill counters for :meth:`HandlerStats.snapshot`.'''
+        return {
+            'spilled': self.spilled,
+            'spill_dropped': self.spill_dropped,
+            'replayed': self.replayed,
+            'spill_bytes': self.spill_bytes,
+        }
+
+    def replay(self):
+        '''Write spilled rows back to storage now.
+
+        This stops at the first failed put, leaving the rest for the
+        next attempt.
+
+        :return: :const:`True` if nothing is left to replay
+
+        '''
+        self._rotate()
+        self._claim_orphans()
+        for path in self._replay_files():
+            size = os.path.getsize(path)
+            try:
+                self._replay_file(path)
+            except Exception:
+                self.trip()
+                return False
+            os.unlink(path)
+            with self._lock:
+                self.spill_bytes -= size
+        self._retry_at = 0.0
+        return True
+
+    def _rotate(self):
+        '''Rename the active file aside for replaying.'''
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            self._serial += 1
+            os.rename(self.path, self._name('replay', serial=self._next()))
+
+    def _next(self):
+        # time-based, so that files claimed from other processes and
+        # this one's own sort in the order they were written
+        return int(time.time() * 1e6) * 1000 + self._serial % 1000
+
+    def _replay_files(self):
+        return sorted(glob.glob(self._name('*.replay')))
+
+    def _claim_orphans(self):
+        '''Take over the files of dead processes with the same prefix.'''
+        pattern = os.path.join(self.directory, self.prefix + '.*')
+        for path in sorted(glob.glob(pattern)):
+            parts = os.path.basename(path)[len(self.prefix) + 1:].split('.')
+            if (len(parts) not in (2, 3) or not parts[0].isdigit() or
+                    parts[-1] not in ('spill', 'replay')):
+                continue
+            pid = int(parts[0])
+            if pid == self.pid or _alive(pid):
+                continue
+            serial = int(parts[1]) if len(parts) == 3 else self._next()
+            target = self._name('replay', serial=serial)
+            try:
+                os.rename(path, target)
+            except OSError:
+                # another process claimed it first
+                continue
+            with self._lock:
+                self.spill_bytes += os.path.getsize(target)
+
+    def _replay_file(self, path):
+        batch = []
+        for table_name, spec, key, value in read_entries(path):
+            if batch and (batch[0][0] != table_name or
+                          len(batch) >= self.replay_rows):
+                self._put(batch)
+                batch = []
+            batch.append((table_name, spec, key, value))
+        if batch:
+            self._put(batch)
+
+    def _put(self, batch):
+        table_name, spec = batch[0][:2]
+        if spec is not None:
+            dblogger.pool.setup_namespace(self.storage, {table_name: spec})
+        self.storage.put(table_name, *[(key, value)
+                                       for _, _, key, value in batch])
+        self.replayed += len(batch)
+
+    def _run(self):
+        try:
+            self._claim_orphans()
+        except Exception:
+            traceback.print_exc()
+        while not self._stop.wait(self.retry_interval):
+            if not self.spill_bytes:
+                continue
+            try:
+                self.replay()
+            except Exception:
+                # this must not log through logging, which could
+                # feed back into the handler spilling here
+                sys.stderr.write('dblogger: failed to replay spilled '
+                                 'records\n')
+                traceback.print_exc()
+
+    def close(self):
+        '''Stop the replayer and close the file.
+
+        Rows not yet replayed stay on disk, for this process's
+        successor to replay.
+
+        '''
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
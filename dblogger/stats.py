@@ -0,0 +1,211 @@
+'''Cost metrics for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+Every :class:`dblogger.DatabaseLogHandler` keeps a
+:class:`HandlerStats` counting what it has done, and returns a
+snapshot of it from :meth:`~dblogger.DatabaseLogHandler.stats`.
+Latencies go into a :class:`Histogram` with power-of-two bucket
+bounds, so recording one costs a few comparisons and the histogram
+stays the same size however long the process runs.
+
+A snapshot is a dictionary with these keys:
+
+``emitted``
+    records accepted for writing
+``failures``
+    records that could not be formatted or serialized
+``dropped``
+    records discarded because the batch queue was full
+``rows_written``, ``bytes_written``
+    rows and value bytes handed to :mod:`kvlayer`, counting
+    segments, bodies, and index entries as written
+``put_errors``
+    :meth:`~kvlayer.AbstractStorage.put` calls that raised
+``queue_depth``, ``max_queue_depth``
+    records currently buffered by the batch writer, and the most
+    ever buffered at once
+``spilled``, ``spill_dropped``, ``replayed``, ``spill_bytes``
+    with a `spill_dir`, rows spilled to disk, rows lost because the
+    spill file was full, rows replayed from it, and spilled bytes
+    still on disk, as described in :mod:`dblogger.spill`
+``suppressed``
+    with `rate_limits`, records the rate limits suppressed, as
+    described in :mod:`dblogger.ratelimit`
+``format``
+    :class:`Histogram` snapshot of seconds spent formatting and
+    serializing each record
+``put``
+    :class:`Histogram` snapshot of seconds spent in each
+    :meth:`~kvlayer.AbstractStorage.put` call
+
+.. autoclass:: HandlerStats
+.. autoclass:: Histogram
+.. autofunction:: flatten
+
+'''
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+#: Upper bounds in seconds of :class:`Histogram` buckets, 1us to 64s
+BUCKET_BOUNDS = tuple(2.0 ** e for e in xrange(-20, 7))
+
+_bisect = bisect.bisect_left
+
+
+class Histogram(object):
+    '''Distribution of durations in power-of-two buckets.
+
+    This is not thread-safe; callers serialize :meth:`add`.
+
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # one more bucket for anything beyond the last bound
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def add(self, seconds):
+        '''Record one duration.'''
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[_bisect(BUCKET_BOUNDS, seconds)] += 1
+
+    def percentile(self, fraction):
+        '''Estimate a percentile as the upper bound of its bucket.
+
+        :param float fraction: percentile between 0 and 1
+        :return: seconds, or :const:`None` if nothing was recorded
+
+        '''
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        '''Get the histogram as a dictionary.
+
+        This has the ``count``, ``total``, and ``max`` of the
+        recorded durations, estimated ``p50``, ``p90``, and
+        ``p99``, and ``buckets``, a list of ``[upper_bound, count]``
+        for the non-empty buckets, where the last bound may be
+        :const:`None` for durations beyond every bound.
+
+        '''
+        bounds = BUCKET_BOUNDS + (None,)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count]
+                        for bound, count in zip(bounds, self.buckets)
+                        if count],
+        }
+
+
+class HandlerStats(object):
+    '''Counters for one :class:`dblogger.DatabaseLogHandler`.
+
+    :meth:`record_put` may be called from any thread.  Callers must
+    serialize :meth:`record_emit`, as
+    :meth:`~dblogger.DatabaseLogHandler.emit` does by running under
+    the handler's lock, so that the common path takes no lock of its
+    own.
+
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.emitted = 0
+        self.failures = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.put_errors = 0
+        self.format = Histogram()
+        self.put = Histogram()
+
+    def record_emit(self, format_seconds, emitted=True, failed=False):
+        '''Record handling one record.
+
+        :param float format_seconds: time spent formatting and
+          serializing it, or :const:`None` if it was serialized
+          elsewhere
+        :param bool emitted: whether it was accepted for writing
+        :param bool failed: whether it could not be serialized
+
+        '''
+        if format_seconds is not None:
+            self.format.add(format_seconds)
+        if emitted:
+            self.emitted += 1
+        if failed:
+            self.failures += 1
+
+    def record_put(self, seconds, rows, nbytes, failed=False):
+        '''Record one :meth:`~kvlayer.AbstractStorage.put` call.
+
+        :param float seconds: time the call took
+        :param int rows: number of rows in the call
+        :param int nbytes: total bytes of the values
+        :param bool failed: whether the call raised
+
+        '''
+        with self._lock:
+            self.put.add(seconds)
+            if failed:
+                self.put_errors += 1
+            else:
+                self.rows_written += rows
+                self.bytes_written += nbytes
+
+    def snapshot(self, dropped=0, queue_depth=0, max_queue_depth=0):
+        '''Get every counter as a dictionary.
+
+        The handler supplies the counters its batch writer keeps.
+
+        '''
+        with self._lock:
+            return {
+                'emitted': self.emitted,
+                'failures': self.failures,
+                'dropped': dropped,
+                'rows_written': self.rows_written,
+                'bytes_written': self.bytes_written,
+                'put_errors': self.put_errors,
+                'queue_depth': queue_depth,
+                'max_queue_depth': max_queue_depth,
+                'format': self.format.snapshot(),
+                'put': self.put.snapshot(),
+            }
+
+
+def flatten(snapshot):
+    '''Flatten a :meth:`HandlerStats.snapshot` into scalar values.
+
+    Histograms become ``<name>_count``, ``<name>_total``,
+    ``<name>_p50``, ``<name>_p90``, ``<name>_p99``, and
+    ``<name>_max``; their buckets are left out.
+
+    '''
+    flat = {}
+    for key, value in snapshot.iteritems():
+        if isinstance(value, dict):
+            for part in ('count', 'total', 'p50', 'p90', 'p99', 'max'):
+                flat[key + '_' + part] = value[part]
+        else:
+            flat[key] = value
+    return flat
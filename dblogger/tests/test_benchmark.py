@@ -0,0 +1,97 @@
+"""tests for dblogger.benchmark"""
+from __future__ import absolute_import
+import json
+import sys
+
+import pytest
+
+from dblogger import benchmark
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_run_emit(processes):
+    result = benchmark.run_emit(records=40, size=100, threads=2,
+                                processes=processes, exceptions=True,
+                                handler_options={'codec': 'split',
+                                                 'index': True})
+    assert result['records'] == 40
+    assert result['records_per_sec'] > 0
+    assert (result['latency_p50'] <= result['latency_p99'] <=
+            result['latency_p999'])
+    ## message, traceback, and row keys
+    assert result['bytes_per_record'] > 100
+    ## a main row, a body row, a level index row, and a name index
+    ## row for each of the three parts of the logger name
+    assert result['rows_per_record'] == 6
+
+
+def test_percentiles():
+    p = benchmark.percentiles(range(1000, 0, -1))
+    assert p == {'p50': 501, 'p99': 991, 'p999': 1000}
+    assert benchmark.percentiles([]) == {'p50': None, 'p99': None,
+                                         'p999': None}
+
+
+def test_emit_cli(tmpdir, monkeypatch, capsys):
+    output = str(tmpdir.join('emit.json'))
+    monkeypatch.setattr(sys, 'argv', [
+        'dblogger-benchmark', 'emit', '--records', '10', '--sizes', '10,20',
+        '--threads', '1', '--storage-type', 'filestorage',
+        '--directory', str(tmpdir), '--output', output])
+    benchmark.main()
+    with open(output) as f:
+        document = json.load(f)
+    assert document['benchmark'] == 'emit'
+    assert [(r['size'], r['exceptions']) for r in document['results']] == \
+        [(10, False), (10, True), (20, False), (20, True)]
+    assert 'size=20' in capsys.readouterr()[0]
+    ## storage files are cleaned up
+    assert tmpdir.listdir() == [tmpdir.join('emit.json')]
+
+
+def test_memory_storage():
+    storage = benchmark.storage_client()
+    storage.setup_namespace({'t': (int,)})
+    storage.put('t', *[((i,), str(i)) for i in xrange(20, 0, -1)])
+    assert [k for k, v in storage.scan('t', ((5,), (8,)))] == \
+        [(5,), (6,), (7,), (8,)]
+    storage.delete('t', (6,))
+    storage.put('t', ((100,), '100'))
+    assert [v for k, v in storage.scan('t', ((5,), (8,)), ((99,), ()))] == \
+        ['5', '7', '8', '100']
+    assert len(list(storage.scan_keys('t'))) == 20
+    storage.delete_namespace()
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_run_query(index):
+    storage = benchmark.storage_client()
+    begin, end, elapsed = benchmark.fill(
+        storage, 2000, span=100, tracebacks=0.5,
+        handler_options={'codec': 'compact', 'index': index})
+    assert end - begin == 100
+    results = dict(
+        (scenario, benchmark.run_query(storage, scenario, begin, end, 2000,
+                                       indexed=index, windows=10))
+        for scenario in benchmark.QUERY_SCENARIOS)
+    for scenario in ('scan', 'scan-lazy', 'format', 'regex-1', 'tail'):
+        assert results[scenario]['rows'] == 2000
+    assert 0 < results['regex-0.1']['rows'] < 400
+    assert results['regex-0.01']['rows'] < results['regex-0.1']['rows']
+    assert 0 < results['level']['rows'] < 400
+    assert 0 < results['window']['rows'] < 1000
+    assert results['window']['queries'] == 10
+    assert results['window']['scanned_per_sec'] is None
+    ## every record is deleted, but only in the child
+    assert results['clear']['rows'] == 2000
+    assert len(list(storage.scan_keys('log'))) == 2000
+    storage.delete_namespace()
+
+
+def test_run_format():
+    for scenario in benchmark.FORMAT_SCENARIOS:
+        result = benchmark.run_format(scenario, records=500, sites=10)
+        assert result['records'] == 500
+        assert result['records_per_sec'] > 0
+    with pytest.raises(ValueError):
+        benchmark.run_format('nonesuch')
@@ -0,0 +1,162 @@
+"""tests for dblogger.codec"""
+from __future__ import absolute_import
+import cPickle as pickle
+import logging
+import time
+
+import pytest
+
+from dblogger import DatabaseLogHandler
+from dblogger import codec
+
+
+def make_record(msg='a message: %d', args=(1,), **extra):
+    record = logging.LogRecord('dblogger.test', logging.WARNING,
+                               '/src/dblogger/tests/test_codec.py', 42,
+                               msg, args, None, 'make_record')
+    record.__dict__.update(extra)
+    record.message = record.getMessage()
+    record.msg = record.message
+    record.args = None
+    record.exc_text = ''
+    return record
+
+
+def test_roundtrip():
+    record = make_record()
+    decoded = codec.decode(codec.encode(record))
+    for attr in ('name', 'levelno', 'levelname', 'pathname', 'filename',
+                 'module', 'lineno', 'funcName', 'process', 'processName',
+                 'thread', 'threadName', 'message', 'msg', 'exc_text'):
+        assert getattr(decoded, attr) == getattr(record, attr), attr
+    assert abs(decoded.created - record.created) < 1e-6
+    assert decoded.args is None
+    assert decoded.getMessage() == 'a message: 1'
+    assert decoded.humantime
+
+
+def test_unicode_extras_and_none():
+    record = make_record(msg=u'caf\xe9 %s', args=(u'\u2603',),
+                         job_id=17, tags=['a', 'b'])
+    record.funcName = None
+    record.process = None
+    record.levelno = None
+    decoded = codec.decode(codec.encode(record))
+    assert decoded.message == u'caf\xe9 \u2603'
+    assert isinstance(decoded.message, unicode)
+    assert isinstance(decoded.name, str)
+    assert decoded.job_id == 17
+    assert decoded.tags == ['a', 'b']
+    assert decoded.funcName is None
+    assert decoded.process is None
+    assert decoded.levelno is None
+
+
+def test_formatter():
+    record = make_record()
+    record.exc_text = 'Traceback: boom'
+    decoded = codec.decode(codec.encode(record))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    assert formatter.format(decoded).endswith(
+        'WARNING a message: 1\nTraceback: boom')
+
+
+def test_deserialize_both_formats():
+    record = make_record()
+    legacy = pickle.dumps(record.__dict__, protocol=pickle.HIGHEST_PROTOCOL)
+    assert not codec.is_encoded(legacy)
+    assert DatabaseLogHandler.deserialize(legacy).message == 'a message: 1'
+    compact = codec.encode(record)
+    assert codec.is_encoded(compact)
+    assert DatabaseLogHandler.deserialize(compact).message == 'a message: 1'
+    assert len(compact) < len(legacy)
+
+
+def test_unknown_version():
+    value = codec.encode(make_record())
+    value = codec.MAGIC + chr(codec.VERSION + 1) + value[len(codec.MAGIC)+1:]
+    with pytest.raises(ValueError):
+        codec.decode(value)
+    assert 'failed to decode' in DatabaseLogHandler.deserialize(value).msg
+
+
+def test_lazy_record():
+    record = make_record(msg=u'caf\xe9 %d', job_id=17)
+    record.exc_text = 'Traceback: boom'
+    record.threadName = None
+    value = codec.encode(record)
+    lazy = codec.LazyRecord(value)
+    assert lazy.message == u'caf\xe9 1'
+    assert lazy.getMessage() == lazy.msg == lazy.message
+    assert lazy.levelno == logging.WARNING
+    assert lazy.name == 'dblogger.test'
+    assert lazy.exc_text == 'Traceback: boom'
+    assert lazy.threadName is None
+    assert lazy.get('pathname') == record.pathname
+    assert lazy.get('extras') is not None
+    assert lazy.get('no_such_field', 'x') == 'x'
+    ## nothing has needed the full record yet
+    assert lazy._record is None
+    assert lazy.job_id == 17
+    assert lazy.module == 'test_codec'
+    assert lazy._record is not None
+    with pytest.raises(AttributeError):
+        lazy.no_such_attribute
+    formatter = logging.Formatter('%(levelname)s %(message)s')
+    assert formatter.format(lazy.to_record()) == \
+        u'WARNING caf\xe9 1\nTraceback: boom'
+    with pytest.raises(ValueError):
+        codec.LazyRecord('not encoded')
+
+
+def test_split():
+    record = make_record(msg=u'caf\xe9 %d', job_id=17)
+    record.exc_text = 'Traceback: boom'
+    header, body = codec.encode_split(record)
+    assert codec.has_body(header)
+    assert not codec.has_body(body)
+    assert not codec.has_body(codec.encode(record))
+    assert len(header) < len(codec.encode(record))
+
+    fields = codec.decode_fields(header)
+    assert fields['message'] == u'caf\xe9 1'
+    assert fields['levelno'] == logging.WARNING
+    assert fields['pathname'] is None
+    assert fields['extras'] is None
+
+    decoded = codec.make_record(codec.merge_body(fields, body))
+    assert decoded.message == u'caf\xe9 1'
+    assert decoded.exc_text == 'Traceback: boom'
+    assert decoded.pathname == record.pathname
+    assert decoded.funcName == 'make_record'
+    assert decoded.job_id == 17
+
+
+@pytest.mark.performance
+def test_codec_throughput():
+    num_records = 20000
+    records = [make_record(job_id=i) for i in xrange(num_records)]
+
+    def rate(fn, items):
+        start = time.time()
+        for item in items:
+            fn(item)
+        return len(items) / (time.time() - start)
+
+    pickle_dump = lambda r: pickle.dumps(r.__dict__,
+                                         protocol=pickle.HIGHEST_PROTOCOL)
+    pickled = [pickle_dump(r) for r in records]
+    encoded = [codec.encode(r) for r in records]
+    legacy_load = lambda v: logging.makeLogRecord(pickle.loads(v))
+
+    results = dict(
+        pickle_bytes=sum(map(len, pickled)) / float(num_records),
+        compact_bytes=sum(map(len, encoded)) / float(num_records),
+        pickle_encode=rate(pickle_dump, records),
+        compact_encode=rate(codec.encode, records),
+        pickle_decode=rate(legacy_load, pickled),
+        compact_decode=rate(codec.decode, encoded),
+    )
+    for k in sorted(results):
+        print '%-15s %12.1f' % (k, results[k])
+    assert results['compact_bytes'] < results['pickle_bytes']
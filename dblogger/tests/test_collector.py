@@ -0,0 +1,142 @@
+"""tests for dblogger.collector"""
+from __future__ import absolute_import
+import logging
+import os
+import socket
+import StringIO
+import threading
+import time
+
+import pytest
+
+from dblogger import DatabaseLogHandler, DBLoggerQuery
+from dblogger.benchmark import storage_client
+from dblogger.collector import CollectorHandler, CollectorServer, \
+    pack_frame, read_frame
+
+
+def test_frame_roundtrip():
+    frames = [(1.5, logging.INFO, 'a.b', 'record', None),
+              (2.25, logging.ERROR, None, '', 'body'),
+              (3.0, logging.DEBUG, u'\xe9', 'x' * 100000, '')]
+    stream = StringIO.StringIO(''.join(pack_frame(*f) for f in frames))
+    assert read_frame(stream) == frames[0]
+    assert read_frame(stream) == frames[1]
+    assert read_frame(stream) == (3.0, logging.DEBUG, '\xc3\xa9',
+                                  'x' * 100000, '')
+    assert read_frame(stream) is None
+
+    with pytest.raises(ValueError):
+        read_frame(StringIO.StringIO(pack_frame(*frames[0])[:-1]))
+
+
+@pytest.fixture
+def collector(request, tmpdir):
+    storage = storage_client()
+    handler = DatabaseLogHandler(storage, batch=True, batch_age=0.05,
+                                 codec='split', index=True)
+    server = CollectorServer(str(tmpdir.join('collector.sock')), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def cleanup():
+        server.shutdown()
+        server.server_close()
+        handler.close()
+        storage.delete_namespace()
+    request.addfinalizer(cleanup)
+    return server
+
+
+def wait_for(handler, emitted):
+    deadline = time.time() + 10
+    while handler.stats()['emitted'] < emitted and time.time() < deadline:
+        time.sleep(0.01)
+    assert handler.writer.flush(10)
+
+
+@pytest.mark.parametrize('codec', ['compact', 'split'])
+def test_collector(collector, codec):
+    path = collector.server_address
+    assert os.stat(path).st_mode & 0777 == 0600
+
+    logger = logging.getLogger('test_collector.' + codec)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    client = CollectorHandler(path, codec=codec)
+    logger.addHandler(client)
+    try:
+        logger.info('parent %d', 1)
+        pids = []
+        for child in xrange(2):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for i in xrange(5):
+                        logger.warning('child %d %d', child, i)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.error('parent %d', 2, exc_info=True)
+    finally:
+        logger.removeHandler(client)
+        client.close()
+    assert client.dropped == 0
+
+    wait_for(collector.handler, 12)
+    query = DBLoggerQuery(collector.handler.storage, indexed=True)
+    records = [r for k, r in query.filter()]
+    assert sorted(r.message for r in records) == sorted(
+        ['parent 1', 'parent 2'] +
+        ['child %d %d' % (c, i) for c in xrange(2) for i in xrange(5)])
+    assert all(r.name == 'test_collector.' + codec for r in records)
+    parent = [r for r in records if r.message == 'parent 2'][0]
+    assert 'ZeroDivisionError' in parent.exc_text
+    warnings = [r for k, r in query.filter(level='WARNING')]
+    ## warnings and above
+    assert len(warnings) == 11
+
+
+def test_collector_unavailable(tmpdir):
+    client = CollectorHandler(str(tmpdir.join('missing.sock')))
+    record = logging.makeLogRecord({'msg': 'lost', 'name': 'test'})
+    raise_exceptions = logging.raiseExceptions
+    logging.raiseExceptions = False
+    try:
+        client.handle(record)
+    finally:
+        logging.raiseExceptions = raise_exceptions
+    assert client.dropped == 1
+
+
+def test_collector_backoff(tmpdir, monkeypatch):
+    client = CollectorHandler(str(tmpdir.join('missing.sock')),
+                              retry_interval=0.05)
+    connects = []
+    connect = client._connect
+    def counting_connect():
+        connects.append(time.time())
+        connect()
+    monkeypatch.setattr(client, '_connect', counting_connect)
+    monkeypatch.setattr(logging, 'raiseExceptions', False)
+    record = logging.makeLogRecord({'msg': 'lost', 'name': 'test'})
+    for i in xrange(5):
+        client.handle(record)
+    ## only the first record waits on the collector
+    assert len(connects) == 1
+    assert client.dropped == 5
+    time.sleep(0.1)
+    client.handle(record)
+    assert len(connects) == 2
+    assert client.dropped == 6
+
+
+def test_collector_in_use(collector):
+    with pytest.raises(socket.error):
+        CollectorServer(collector.server_address, collector.handler)
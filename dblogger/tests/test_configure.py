@@ -79,3 +79,69 @@ def test_inline_config(capsys):
     (out,err) = capsys.readouterr()
     print out
     assert err == 'inline CRITICAL test\n'
+
+def test_database_queue_config():
+    config = """
+    logging:
+        version: 1
+        handlers:
+            db:
+                class: dblogger.DatabaseLogHandler
+                storage_config:
+                    storage_type: local
+                    app_name: dbltest
+                    namespace: test_database_queue_config
+                queue_size: 10
+                overflow: drop_below
+                overflow_level: ERROR
+        loggers:
+            dblogger.test_queue:
+                handlers: [db]
+    """
+    config = yaml.load(StringIO(config))
+    configure_logging(config)
+    logger = logging.getLogger('dblogger.test_queue')
+    (handler,) = logger.handlers
+    try:
+        assert handler.writer.max_queue == 10
+        assert handler.writer.overflow == 'drop_below'
+        assert handler.writer.overflow_level == logging.ERROR
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+def test_database_rate_limit_config():
+    config = """
+    logging:
+        version: 1
+        handlers:
+            db:
+                class: dblogger.DatabaseLogHandler
+                storage_config:
+                    storage_type: local
+                    app_name: dbltest
+                    namespace: test_database_rate_limit_config
+                rate_limits:
+                    - rate: 10
+                      max_level: WARNING
+                    - logger: dblogger.test_rate.noisy
+                      sample: 0.5
+                suppress_report_interval: 5
+        loggers:
+            dblogger.test_rate:
+                handlers: [db]
+    """
+    config = yaml.load(StringIO(config))
+    configure_logging(config)
+    logger = logging.getLogger('dblogger.test_rate')
+    (handler,) = logger.handlers
+    try:
+        limiter = handler._limiter
+        assert limiter.report_interval == 5
+        assert [(r.logger, r.rate, r.sample, r.max_level)
+                for r in limiter.rules] == [
+            ('dblogger.test_rate.noisy', None, 0.5, logging.CRITICAL),
+            ('', 10, 1.0, logging.WARNING)]
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
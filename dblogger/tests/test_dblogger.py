@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import json
 import os
 import yaml
 import time
@@ -13,8 +14,12 @@ import sys
 import kvlayer
 import yakonfig
 
+import dblogger.pool
 from dblogger import DatabaseLogHandler, DBLoggerQuery
-from dblogger.query import complete_zulu_timestamp
+from dblogger.codec import LazyRecord
+from dblogger.follow import FollowCursor
+from dblogger.partition import partition_for
+from dblogger.query import complete_zulu_timestamp, configured_segments
 
 config_path = os.path.join(os.path.dirname(__file__))
 
@@ -40,6 +45,60 @@ def client(request, namespace_string, redis_address):
 
     return client
 
+def run_cli(client, module, *args):
+    '''Run a command-line tool against `client`'s namespace.
+
+    :return: tuple of exit status, standard output, and standard error
+
+    '''
+    child = subprocess.Popen(
+        [sys.executable, '-m', module,
+         '--app-name', 'dbltest',
+         '--namespace', client._config['namespace'],
+         '--storage-type', client._config['storage_type'],
+         '--storage-address', client._config['storage_addresses'][0],
+        ] + list(args),
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    out, err = child.communicate()
+    return child.returncode, out, err
+
+EXIT_CHILD = '''
+import json, logging, sys
+import kvlayer
+from dblogger import DatabaseLogHandler
+client = kvlayer.client(config={'filename': sys.argv[1]},
+                        storage_type='filestorage', app_name='dbltest',
+                        namespace='exit')
+handler = DatabaseLogHandler(client, **json.loads(sys.argv[2]))
+logger = logging.getLogger('flood')
+logger.addHandler(handler)
+for i in xrange(50):
+    logger.warning('flood %d', i)
+'''
+
+def run_exit_child(tmpdir, **handler_options):
+    '''Log a flood of records in a child process that exits normally.
+
+    :return: tuple of the query over what the child stored, and its
+      standard error
+
+    '''
+    filename = str(tmpdir.join('exit.db'))
+    child = subprocess.Popen(
+        [sys.executable, '-c', EXIT_CHILD, filename,
+         json.dumps(handler_options)],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    out, err = child.communicate()
+    assert child.returncode == 0, err
+    client = kvlayer.client(config={'filename': filename},
+                            storage_type='filestorage', app_name='dbltest',
+                            namespace='exit')
+    return DBLoggerQuery(client), err
+
 def test_basic(client):
     logger = logging.getLogger('test_logger')
     logger.setLevel(logging.DEBUG)
@@ -74,6 +133,77 @@ def test_log_exception_info(client):
     finally:
         logger.removeHandler(dbhandler)
 
+def test_format_once(client):
+    class Counted(object):
+        count = 0
+        def __str__(self):
+            Counted.count += 1
+            return 'counted'
+
+    class Formatter(logging.Formatter):
+        exceptions = 0
+        def formatException(self, exc_info):
+            Formatter.exceptions += 1
+            return 'formatted once'
+
+    logger = logging.getLogger('test_format_once')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handlers = [DatabaseLogHandler(client), DatabaseLogHandler(client)]
+    handlers[0].setFormatter(Formatter())
+    for handler in handlers:
+        logger.addHandler(handler)
+    try:
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('value %s', Counted())
+    finally:
+        for handler in handlers:
+            logger.removeHandler(handler)
+
+    assert Counted.count == 1
+    assert Formatter.exceptions == 1
+    records = [r for k, r in DBLoggerQuery(client).filter()]
+    assert len(records) == 2
+    for record in records:
+        assert record.getMessage() == 'value counted'
+        assert record.exc_text == 'formatted once'
+
+@pytest.mark.parametrize('codec', ['pickle', 'compact', 'split'])
+def test_fields(client, codec):
+    dbhandler = DatabaseLogHandler(client, codec=codec,
+                                   fields=['exc_text', 'lineno', 'color'])
+    full = DatabaseLogHandler(client, table_name='full', codec=codec)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        exc_info = sys.exc_info()
+    for handler in (dbhandler, full):
+        record = logging.LogRecord('test.fields', logging.ERROR,
+                                   '/src/some/module.py', 42, 'test %d',
+                                   (1,), exc_info, 'test_fields')
+        record.color = 'red'
+        record.shape = 'round'
+        handler.emit(record)
+
+    (key, record), = DBLoggerQuery(client).filter()
+    assert record.getMessage() == 'test 1'
+    assert record.levelname == 'ERROR'
+    assert record.name == 'test.fields'
+    assert record.lineno == 42
+    assert 'ValueError: boom' in record.exc_text
+    assert record.color == 'red'
+    assert not getattr(record, 'shape', None)
+    assert not record.exc_info
+    assert record.pathname != '/src/some/module.py'
+    assert not record.funcName
+
+    if codec != 'split':
+        (key, stored), = client.scan('log')
+        (key, stored_full), = client.scan('full')
+        assert len(stored) < len(stored_full)
+
 def test_configuration(client):
     """create the logger from the configuration, not the client object"""
     logger = logging.getLogger('test_logger')
@@ -190,22 +320,8 @@ def test_queries_cli(client):
         record = logging.makeLogRecord(xdict)
         dbhandler.emit(record)
 
-    child = subprocess.Popen(
-        [sys.executable, '-m', 'dblogger.query',
-         '--app-name', 'dbltest',
-         '--namespace', client._config['namespace'],
-         '--storage-type', client._config['storage_type'],
-         '--storage-address', client._config['storage_addresses'][0],
-        ],
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-    )
-    child.wait()
-
-    out = child.stdout.read()
-    err = child.stderr.read()
-
-    assert child.returncode == 0
+    returncode, out, err = run_cli(client, 'dblogger.query')
+    assert returncode == 0
     assert out
 
 def test_complete_zulu_timestamp():
@@ -222,21 +338,924 @@ def test_queries_cli2(client):
         record = logging.makeLogRecord(xdict)
         dbhandler.emit(record)
 
-    child = subprocess.Popen(
-        [sys.executable, '-m', 'dblogger.query',
-         '--app-name', 'dbltest',
-         '--namespace', client._config['namespace'],
-         '--storage-type', client._config['storage_type'],
-         '--storage-address', client._config['storage_addresses'][0],
-         '--begin', '1998-01-03T08',
-        ],
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-    )
-    child.wait()
+    returncode, out, err = run_cli(
+        client, 'dblogger.query', '--begin', '1998-01-03T08')
+    assert returncode == 0, err
+    assert out
 
-    out = child.stdout.read()
-    err = child.stderr.read()
+def test_batch(client):
+    logger = logging.getLogger('test_logger')
+    logger.setLevel(logging.DEBUG)
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_age=60)
+    logger.addHandler(dbhandler)
+    try:
+        messages = ['test {0}'.format(i) for i in xrange(10)]
+        for m in messages: logger.warn(m)
+        dbhandler.flush()
 
-    assert child.returncode == 0, err
-    assert out
+        query = DBLoggerQuery(client)
+        responses = [record.message for key, record in query.filter()]
+        assert responses == messages
+    finally:
+        logger.removeHandler(dbhandler)
+        dbhandler.close()
+
+def test_batch_count(client):
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_count=5,
+                                   batch_age=60)
+    for i in xrange(5):
+        dbhandler.emit(logging.makeLogRecord(dict(msg='test %d' % i)))
+    ## the count limit writes the batch without an explicit flush
+    deadline = time.time() + 10
+    query = DBLoggerQuery(client)
+    while time.time() < deadline:
+        if len(list(query.filter())) == 5:
+            break
+        time.sleep(0.01)
+    assert len(list(query.filter())) == 5
+    dbhandler.close()
+
+def test_batch_close(client):
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_age=60)
+    for i in xrange(10):
+        dbhandler.emit(logging.makeLogRecord(dict(msg='test %d' % i)))
+    dbhandler.close()
+
+    query = DBLoggerQuery(client)
+    assert len(list(query.filter())) == 10
+    with pytest.raises(RuntimeError):
+        dbhandler.emit(logging.makeLogRecord(dict(msg='too late')))
+
+def test_storage_config_shared(client):
+    config = yakonfig.get_global_config('kvlayer')
+    first = DatabaseLogHandler(storage_config=config, index=True)
+    second = DatabaseLogHandler(storage_config=config, table_name='other')
+    try:
+        assert first.storage is second.storage
+        first.emit(logging.makeLogRecord(dict(msg='first')))
+        second.emit(logging.makeLogRecord(dict(msg='second')))
+        assert [r.message for k, r in
+                DBLoggerQuery(first.storage).filter()] == ['first']
+    finally:
+        first.close()
+        second.close()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_batch_fork(client):
+    config = yakonfig.get_global_config('kvlayer')
+    dbhandler = DatabaseLogHandler(storage_config=config, batch=True,
+                                   batch_age=60)
+    dbhandler.emit(logging.makeLogRecord(dict(msg='parent')))
+    storage, writer = dbhandler.storage, dbhandler.writer
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            ## the child gets its own client and writer thread
+            dbhandler.emit(logging.makeLogRecord(dict(msg='child')))
+            dbhandler.flush()
+            messages = [r.message for k, r in
+                        DBLoggerQuery(dbhandler.storage).filter()]
+            ok = (dbhandler.storage is not storage and
+                  dbhandler.writer is not writer and
+                  dbhandler.stats()['emitted'] == 1 and
+                  'child' in messages)
+        finally:
+            os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert dbhandler.writer is writer
+    dbhandler.close()
+    assert dbhandler.stats()['emitted'] == 1
+    assert 'parent' in [r.message for k, r in
+                        DBLoggerQuery(storage).filter()]
+
+def test_stats(client):
+    dbhandler = DatabaseLogHandler(client, codec='split', index=True)
+    for i in xrange(10):
+        dbhandler.emit(logging.makeLogRecord(dict(msg='test %d' % i,
+                                                  name='test',
+                                                  levelno=logging.INFO)))
+    stats = dbhandler.stats()
+    assert stats['emitted'] == 10
+    assert stats['failures'] == 0
+    assert stats['dropped'] == 0
+    ## a header, a body, a level index entry, and a name index entry
+    assert stats['rows_written'] == 40
+    assert stats['put']['count'] == 40
+    assert stats['format']['count'] == 10
+    assert stats['bytes_written'] > 0
+    assert stats['queue_depth'] == stats['max_queue_depth'] == 0
+
+def test_stats_batch(client):
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_age=60,
+                                   queue_size=5)
+    ## a full queue wakes the writer thread; holding its (reentrant)
+    ## lock keeps it from draining the queue between emits
+    with dbhandler.writer._cond:
+        for i in xrange(8):
+            dbhandler.emit(logging.makeLogRecord(dict(msg='test %d' % i)))
+        stats = dbhandler.stats()
+    assert stats['queue_depth'] == stats['max_queue_depth'] == 5
+    assert stats['emitted'] == 5
+    assert stats['dropped'] == 3
+    dbhandler.flush()
+    stats = dbhandler.stats()
+    assert stats['queue_depth'] == 0
+    assert stats['rows_written'] == 5
+    ## one put for the whole batch
+    assert stats['put']['count'] == 1
+    dbhandler.close()
+
+def test_queue_index(client):
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_age=60,
+                                   queue_size=5, overflow='drop_oldest',
+                                   index=True)
+    with dbhandler.writer._cond:
+        for i in xrange(8):
+            dbhandler.emit(logging.makeLogRecord(dict(
+                msg='test %d' % i, levelno=logging.ERROR)))
+        stats = dbhandler.stats()
+    ## index entries take no room in the queue, and are not counted
+    ## as dropped records
+    assert stats['queue_depth'] == 5
+    assert stats['dropped'] == 3
+    dbhandler.close()
+
+    expected = ['test %d' % i for i in xrange(3, 8)]
+    for indexed in (True, False):
+        query = DBLoggerQuery(client, indexed=indexed)
+        responses = [record.message for key, record in
+                     query.filter(level=logging.ERROR)
+                     if record.name != 'dblogger']
+        assert responses == expected
+
+def test_queue_split(client):
+    dbhandler = DatabaseLogHandler(client, batch=True, batch_age=60,
+                                   queue_size=5, overflow='drop_oldest',
+                                   codec='split')
+    with dbhandler.writer._cond:
+        for i in xrange(8):
+            dbhandler.emit(logging.makeLogRecord(dict(
+                msg='test %d' % i, levelno=logging.ERROR,
+                pathname='/src/test.py')))
+        stats = dbhandler.stats()
+    ## bodies share their header's place in the queue
+    assert stats['queue_depth'] == 5
+    assert stats['dropped'] == 3
+    dbhandler.close()
+
+    assert len(list(client.scan_keys('log'))) == \
+        len(list(client.scan_keys('log_body')))
+    records = [record for key, record in DBLoggerQuery(client).filter()
+               if record.name != 'dblogger']
+    assert [(r.message, r.pathname) for r in records] == \
+        [('test %d' % i, '/src/test.py') for i in xrange(3, 8)]
+
+def test_rate_limits(client):
+    dbhandler = DatabaseLogHandler(client, rate_limits=[
+        {'rate': 0.001, 'burst': 5, 'max_level': 'WARNING'}])
+    for i in xrange(100):
+        for name in ('storm', 'other'):
+            dbhandler.emit(logging.makeLogRecord(dict(
+                msg='%s %d' % (name, i), name=name, levelno=logging.INFO)))
+    dbhandler.emit(logging.makeLogRecord(dict(
+        msg='error', name='storm', levelno=logging.ERROR)))
+    assert dbhandler.stats()['suppressed'] == 190
+    dbhandler.close()
+
+    records = [r for k, r in DBLoggerQuery(client).filter()]
+    assert [r.message for r in records[:-2]] == \
+        ['%s %d' % (name, i) for i in xrange(5)
+         for name in ('storm', 'other')] + ['error']
+    ## summaries are written on close
+    assert [(r.name, r.message, r.suppressed) for r in records[-2:]] == [
+        ('dblogger', '95 records suppressed from other', 95),
+        ('dblogger', '95 records suppressed from storm', 95)]
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_rate_limits_exit(tmpdir, batch):
+    query, err = run_exit_child(tmpdir, batch=batch, rate_limits=[
+        {'rate': 0.001, 'burst': 5}])
+    assert 'Traceback' not in err
+    assert [r.message for k, r in query.filter()] == \
+        ['flood %d' % i for i in xrange(5)] + \
+        ['45 records suppressed from flood']
+
+@pytest.mark.parametrize('codec', ['pickle', 'compact', 'split'])
+def test_dedup(client, codec):
+    dbhandler = DatabaseLogHandler(client, codec=codec, dedup_window=1.0)
+    logger = logging.getLogger('test_dedup')
+    logger.propagate = False
+    logger.addHandler(dbhandler)
+    try:
+        for i in xrange(1000):
+            logger.warning('flood %d', i)
+        logger.warning('different')
+        dbhandler.flush()
+    finally:
+        logger.removeHandler(dbhandler)
+        dbhandler.close()
+
+    query = DBLoggerQuery(client)
+    records = [r for k, r in query.filter()]
+    assert [(r.message, query.repeat_count(r)) for r in records] == \
+        [('flood 0', 1), ('flood 1', 999), ('different', 1)]
+    ## stored at the time of the first repeat
+    assert records[1].created == records[1].repeat_first
+    assert records[1].repeat_first <= records[1].repeat_last
+    assert records[1].repeat_args == [('1',), ('2',), ('3',)]
+    assert [r.message for k, r in
+            query.filter(where={'repeat_count': 999})] == ['flood 1']
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_dedup_exit(tmpdir, batch):
+    query, err = run_exit_child(tmpdir, batch=batch, dedup_window=60)
+    assert 'Traceback' not in err
+    assert [(r.message, query.repeat_count(r))
+            for k, r in query.filter()] == [('flood 0', 1), ('flood 1', 49)]
+
+def test_dedup_quiet(client):
+    dbhandler = DatabaseLogHandler(client, dedup_window=0.05)
+    logger = logging.getLogger('test_dedup_quiet')
+    logger.propagate = False
+    logger.addHandler(dbhandler)
+    try:
+        for i in xrange(10):
+            logger.warning('flood %d', i)
+        ## the run is written once it ends, with nothing else logged
+        query = DBLoggerQuery(client)
+        deadline = time.time() + 5
+        records = []
+        while len(records) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+            records = [r for k, r in query.filter()]
+        assert [(r.message, query.repeat_count(r)) for r in records] == \
+            [('flood 0', 1), ('flood 1', 9)]
+    finally:
+        logger.removeHandler(dbhandler)
+        dbhandler.close()
+
+def test_stats_record(client):
+    dbhandler = DatabaseLogHandler(client, stats_interval=60, codec='split')
+    for i in xrange(3):
+        dbhandler.emit(logging.makeLogRecord(dict(msg='test %d' % i)))
+    dbhandler.emit(logging.makeLogRecord(dict(msg='later',
+                                              created=time.time() + 61)))
+    records = [r for k, r in DBLoggerQuery(client,
+                                           table_name='log_stats').filter()]
+    assert len(records) == 1
+    assert records[0].name == 'dblogger.stats'
+    assert records[0].emitted == 3
+    ## headers and bodies
+    assert records[0].put_count == 6
+    assert '3 records emitted' in records[0].getMessage()
+    assert len(list(DBLoggerQuery(client).filter())) == 4
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            captured.append(record)
+    captured = []
+    logger = logging.getLogger('test_stats_logger')
+    logger.propagate = False
+    logger.addHandler(Capture())
+    dbhandler = DatabaseLogHandler(client, table_name='other',
+                                   stats_interval=0,
+                                   stats_logger='test_stats_logger')
+    dbhandler.emit(logging.makeLogRecord(dict(msg='test')))
+    assert len(captured) == 1
+    assert captured[0].emitted == 0
+
+def test_compact_codec(client):
+    legacy = DatabaseLogHandler(client)
+    legacy.emit(logging.makeLogRecord(dict(created=time.time() - 1,
+                                           msg='legacy %d', args=(0,))))
+
+    logger = logging.getLogger('test_logger')
+    logger.setLevel(logging.DEBUG)
+    dbhandler = DatabaseLogHandler(client, codec='compact')
+    logger.addHandler(dbhandler)
+    try:
+        logger.warn('compact %d', 1, extra=dict(job_id=17))
+        try:
+            raise Exception('hello!')
+        except:
+            logger.warn('compact %d', 2, exc_info=True)
+
+        query = DBLoggerQuery(client)
+        records = [record for key, record in query.filter()]
+        assert [r.message for r in records] == \
+            ['legacy 0', 'compact 1', 'compact 2']
+        assert records[1].job_id == 17
+        assert 'hello!' in records[2].exc_text
+    finally:
+        logger.removeHandler(dbhandler)
+
+def test_segments(client):
+    dbhandler = DatabaseLogHandler(client, segment_size=4, batch_age=60,
+                                   codec='compact')
+    now = time.time()
+    ## emitted out of order; segments are packed in key order
+    created_list = [now + 3 * i for i in xrange(10)]
+    for created in reversed(created_list):
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created)))
+    dbhandler.close()
+
+    ## fewer rows than records
+    assert len(list(client.scan_keys('log'))) < len(created_list)
+
+    ## a plain row written later still sorts among the segments
+    plain = DatabaseLogHandler(client)
+    plain.emit(logging.makeLogRecord(
+        dict(created=now + 4, msg='test plain')))
+
+    query = DBLoggerQuery(client)
+    responses = [record.message for key, record in query.filter()]
+    expected = ['test %r' % c for c in created_list]
+    expected.insert(2, 'test plain')
+    assert responses == expected
+
+    ## boundaries fall inside segments
+    begin = created_list[2] - 0.5
+    end = created_list[6] + 0.5
+    responses = [record.message for key, record in
+                 query.filter(begin=begin, end=end)]
+    assert responses == ['test %r' % c for c in created_list[2:7]]
+
+@pytest.mark.parametrize('segment_size', [None, 3])
+def test_queries_parallel(client, segment_size):
+    dbhandler = DatabaseLogHandler(client, segment_size=segment_size,
+                                   batch_age=60, codec='compact')
+    now = time.time()
+    created_list = [now + 0.7 * i for i in xrange(40)]
+    for created in created_list:
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created,
+                 levelno=logging.WARNING if created > now + 10
+                 else logging.INFO)))
+    dbhandler.close()
+
+    query = DBLoggerQuery(client)
+    begin = created_list[3] - 0.1
+    end = created_list[35] + 0.1
+    for kwargs in [{}, {'level': logging.WARNING}]:
+        expected = [(key, record.message) for key, record in
+                    query.filter(begin=begin, end=end, **kwargs)]
+        assert expected
+        for parallel in [2, 5, 16]:
+            responses = [(key, record.message) for key, record in
+                         query.filter(begin=begin, end=end, parallel=parallel,
+                                      readahead=2, **kwargs)]
+            assert responses == expected
+
+    ## stopping early releases the shard threads
+    records = query.filter(begin=begin, end=end, parallel=4, readahead=1)
+    assert next(records)[1].message == 'test %r' % created_list[3]
+    records.close()
+
+
+def test_follow(client):
+    dbhandler = DatabaseLogHandler(client, segment_size=4, batch_age=60,
+                                   codec='compact')
+    now = time.time()
+    first = [now - 5 + 0.5 * i for i in xrange(6)]
+    for created in first:
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created)))
+    dbhandler.flush()
+
+    query = DBLoggerQuery(client)
+    cursor = FollowCursor(begin=first[1])
+    records = query.follow(cursor, min_interval=0.001, idle_timeout=0.05)
+    ## stop partway through the first segment
+    assert [next(records)[1].message for i in xrange(2)] == \
+        ['test %r' % c for c in first[1:3]]
+    records.close()
+
+    cursor = FollowCursor.loads(cursor.dumps())
+    responses = [record.message for key, record in
+                 query.follow(cursor, min_interval=0.001,
+                              idle_timeout=0.05)]
+    assert responses == ['test %r' % c for c in first[3:]]
+
+    ## a row arriving late, keyed before rows already read, is
+    ## still read, and nothing is read twice
+    late = DatabaseLogHandler(client)
+    late.emit(logging.makeLogRecord(dict(created=now - 4.2, msg='late')))
+    dbhandler.emit(logging.makeLogRecord(dict(created=now, msg='new')))
+    dbhandler.flush()
+    responses = [record.message for key, record in
+                 query.follow(cursor, min_interval=0.001,
+                              idle_timeout=0.05)]
+    assert sorted(responses) == ['late', 'new']
+    assert list(query.follow(cursor, min_interval=0.001,
+                             idle_timeout=0.05)) == []
+    dbhandler.close()
+
+
+def test_follow_late(client):
+    dbhandler = DatabaseLogHandler(client)
+    now = time.time()
+    dbhandler.emit(logging.makeLogRecord(dict(created=now - 0.1,
+                                              msg='first')))
+
+    query = DBLoggerQuery(client)
+    cursor = FollowCursor(begin=now - 5)
+    late = []
+    def follow():
+        return [record.message for key, record in
+                query.follow(cursor, lookback=2, min_interval=0.001,
+                             idle_timeout=0.05, rescan_interval=0,
+                             late_callback=lambda *args: late.append(args))]
+    assert follow() == ['first']
+    assert late == []
+
+    ## a row stored after the cursor moved past its key is not read,
+    ## but is reported
+    dbhandler.emit(logging.makeLogRecord(dict(created=now - 3,
+                                              msg='too late')))
+    dbhandler.emit(logging.makeLogRecord(dict(created=now, msg='new')))
+    assert follow() == ['new']
+    assert len(late) == 1
+    count, begin, end = late[0]
+    assert count == 1
+    assert begin < now - 3 <= end
+    assert cursor.late == 1
+    ## only once, even across a saved cursor
+    cursor = FollowCursor.loads(cursor.dumps())
+    assert cursor.late == 1
+    assert follow() == []
+    assert len(late) == 1
+
+def test_follow_poll_cost(client, monkeypatch):
+    dbhandler = DatabaseLogHandler(client)
+    now = time.time()
+    for i in xrange(500):
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=now - 5 + 0.01 * i, msg='test %d' % i)))
+
+    scanned = []
+    scan_keys = client.scan_keys
+    def counting_scan_keys(table, *key_ranges):
+        for key in scan_keys(table, *key_ranges):
+            scanned.append(key)
+            yield key
+    monkeypatch.setattr(client, 'scan_keys', counting_scan_keys)
+
+    query = DBLoggerQuery(client)
+    cursor = FollowCursor(begin=now - 6)
+    records = query.follow(cursor, min_interval=0.001, rescan_interval=60)
+    assert [next(records)[1].message for i in xrange(500)] == \
+        ['test %d' % i for i in xrange(500)]
+    assert cursor.high == max(cursor.seen)
+
+    ## later polls only scan past the newest row read
+    del scanned[:]
+    dbhandler.emit(logging.makeLogRecord(dict(created=now, msg='new')))
+    assert next(records)[1].message == 'new'
+    records.close()
+    assert len(scanned) <= 2
+
+    assert FollowCursor.loads(cursor.dumps()).high == cursor.high
+
+
+def test_queries_tail(client):
+    dbhandler = DatabaseLogHandler(client)
+    now = time.time()
+    for i in xrange(3):
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=now + i, msg='test %d' % i)))
+
+    query = DBLoggerQuery(client)
+    records = query.filter(begin=now - 1, tail=True)
+    assert [next(records)[1].message for i in xrange(3)] == \
+        ['test 0', 'test 1', 'test 2']
+    dbhandler.emit(logging.makeLogRecord(dict(created=now + 5, msg='more')))
+    assert next(records)[1].message == 'more'
+    records.close()
+
+
+@pytest.mark.parametrize(('segment_size', 'codec'),
+                         [(None, 'compact'), (3, 'compact'), (3, 'split')])
+def test_newest(client, segment_size, codec):
+    dbhandler = DatabaseLogHandler(client, segment_size=segment_size,
+                                   batch_age=60, codec=codec)
+    now = time.time()
+    ## an hour of history, then a recent burst
+    old = [now - 3600 + 10 * i for i in xrange(100)]
+    recent = [now - 2 + 0.25 * i for i in xrange(8)]
+    for created in old + recent:
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created,
+                 levelno=logging.ERROR if created in recent[::2]
+                 else logging.INFO)))
+    dbhandler.close()
+    messages = ['test %r' % c for c in old + recent]
+
+    query = DBLoggerQuery(client)
+    assert [r.message for k, r in query.newest()] == messages[::-1]
+    keys = [k for k, r in query.newest()]
+    assert keys == sorted(keys, reverse=True)
+    assert [r.message for k, r in query.last(3)] == messages[-3:]
+    assert query.last(0) == []
+    assert [r.message for k, r in query.last(1000)] == messages
+    assert [r.message for k, r in query.last(2, level='ERROR')] == \
+        ['test %r' % c for c in recent[2::2][-2:]]
+    ## boundaries fall inside segments
+    assert [r.message for k, r in
+            query.newest(begin=recent[1] - 0.1, end=recent[5] + 0.1)] == \
+        ['test %r' % c for c in reversed(recent[1:6])]
+
+    ## the last few records do not read the old history
+    scanned = []
+    scan = client.scan
+    def counting_scan(table, *key_ranges):
+        for item in scan(table, *key_ranges):
+            scanned.append(item[0])
+            yield item
+    client.scan = counting_scan
+    try:
+        assert [r.message for k, r in query.last(3, lazy=True)] == \
+            messages[-3:]
+    finally:
+        del client.scan
+    ## (plus one key to find the oldest row)
+    assert 0 < len(scanned) <= len(recent) + 1
+
+
+def test_newest_cost(client, monkeypatch):
+    dbhandler = DatabaseLogHandler(client)
+    now = time.time()
+    for i in xrange(2000):
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=now - 2 + 0.001 * i, msg='test %d' % i)))
+    dbhandler.close()
+
+    scanned = []
+    scan = client.scan
+    def counting_scan(table, *key_ranges):
+        for item in scan(table, *key_ranges):
+            scanned.append(item[0])
+            yield item
+    decoded = []
+    decode = DBLoggerQuery._decode
+    def counting_decode(self, item, *args, **kwargs):
+        decoded.append(item[0])
+        return decode(self, item, *args, **kwargs)
+    monkeypatch.setattr(client, 'scan', counting_scan)
+    monkeypatch.setattr(DBLoggerQuery, '_decode', counting_decode)
+
+    ## without segments, only the newest rows are read, and only the
+    ## records yielded are decoded
+    query = DBLoggerQuery(client, segmented=False)
+    assert [r.message for k, r in query.last(1)] == ['test 1999']
+    assert len(decoded) == 1
+    assert len(scanned) < 200
+
+    ## a table that may hold segments is read a segment span further
+    ## back, but still only the records yielded are decoded
+    del decoded[:]
+    query = DBLoggerQuery(client)
+    assert [r.message for k, r in query.last(1)] == ['test 1999']
+    assert len(decoded) == 1
+
+
+def test_newest_writers(client):
+    ## one writer packs a segment keyed well before the rows another
+    ## writer stores one at a time, but holding a newer record
+    packing = DatabaseLogHandler(client, segment_size=10, batch_age=60)
+    single = DatabaseLogHandler(client, segment_size=10, batch_age=60)
+    now = time.time()
+    for age in (8, 0.5):
+        packing.emit(logging.makeLogRecord(
+            dict(created=now - age, msg='test %r' % age)))
+    packing.close()
+    for age in (1, 0.8):
+        single.emit(logging.makeLogRecord(
+            dict(created=now - age, msg='test %r' % age)))
+        single.flush()
+    single.close()
+
+    query = DBLoggerQuery(client)
+    assert [r.message for k, r in query.newest(end=now)] == \
+        ['test %r' % age for age in (0.5, 0.8, 1, 8)]
+    assert [r.message for k, r in query.last(2, end=now)] == \
+        ['test 0.8', 'test 0.5']
+
+
+def test_configured_segments():
+    handler = {'class': 'dblogger.DatabaseLogHandler'}
+    console = {'class': 'logging.StreamHandler'}
+    assert configured_segments({})
+    assert configured_segments({'handlers': {'console': console}})
+    assert not configured_segments(
+        {'handlers': {'db': handler, 'console': console}})
+    assert configured_segments({'handlers': {
+        'db': handler, 'packed': dict(handler, segment_size=100)}})
+    assert configured_segments(
+        {'handlers': {'db': dict(handler, table_name='other')}})
+
+
+def test_newest_empty(client):
+    query = DBLoggerQuery(client)
+    assert list(query.newest()) == []
+    assert query.last(10) == []
+
+
+@pytest.mark.parametrize('segment_size', [None, 3])
+def test_index(client, segment_size):
+    dbhandler = DatabaseLogHandler(client, index=True,
+                                   segment_size=segment_size)
+    now = time.time()
+    levels = [logging.DEBUG, logging.INFO, logging.ERROR, logging.WARNING,
+              logging.CRITICAL, logging.DEBUG, logging.ERROR, logging.INFO]
+    names = ['app', 'app.db', 'app.db.pool', 'other', 'app.web',
+             'app.dbx', 'other.db', 'app.db']
+    for i, (levelno, name) in enumerate(zip(levels, names)):
+        dbhandler.emit(logging.makeLogRecord(dict(
+            created=now + i, levelno=levelno,
+            levelname=logging.getLevelName(levelno), name=name,
+            msg='test %d' % i)))
+    dbhandler.close()
+
+    for indexed in (True, False):
+        query = DBLoggerQuery(client, indexed=indexed)
+        responses = [record.message for key, record in
+                     query.filter(level='WARNING')]
+        assert responses == ['test 2', 'test 3', 'test 4', 'test 6']
+
+        responses = [record.message for key, record in
+                     query.filter(name='app.db')]
+        assert responses == ['test 1', 'test 2', 'test 7']
+
+        responses = [record.message for key, record in
+                     query.filter(name='app.db', level=logging.ERROR)]
+        assert responses == ['test 2']
+
+        responses = [record.message for key, record in
+                     query.filter(begin=now + 2.5, end=now + 6.5,
+                                  level=logging.ERROR)]
+        assert responses == ['test 4', 'test 6']
+
+def test_index_unregistered_levels(client):
+    dbhandler = DatabaseLogHandler(client, index=True)
+    now = time.time()
+    for i, levelno in enumerate([25, 35, 40, 45, 10]):
+        dbhandler.emit(logging.makeLogRecord(dict(
+            created=now + i, levelno=levelno,
+            levelname=logging.getLevelName(levelno), msg='test %d' % i)))
+    dbhandler.close()
+
+    for indexed in (True, False):
+        query = DBLoggerQuery(client, indexed=indexed)
+        assert [record.message for key, record in
+                query.filter(level=30)] == ['test 1', 'test 2', 'test 3']
+        assert [record.message for key, record in
+                query.filter(level=45)] == ['test 3']
+
+@pytest.mark.parametrize('codec', ['pickle', 'compact'])
+def test_queries_where(client, codec):
+    logger = logging.getLogger('test_logger')
+    logger.setLevel(logging.DEBUG)
+    dbhandler = DatabaseLogHandler(client, codec=codec)
+    logger.addHandler(dbhandler)
+    try:
+        for i in xrange(10):
+            logger.warn('test %d', i, extra=dict(job_id=i % 3))
+
+        query = DBLoggerQuery(client)
+        responses = [record.message for key, record in
+                     query.filter(where=['job_id=1', 'levelname=WARNING'])]
+        assert responses == ['test 1', 'test 4', 'test 7']
+
+        responses = [record.message for key, record in
+                     query.filter(where={'job_id': [0, 2]},
+                                  filter_str='test [0-4]')]
+        assert responses == ['test 0', 'test 2', 'test 3']
+    finally:
+        logger.removeHandler(dbhandler)
+
+def test_queries_lazy(client):
+    legacy = DatabaseLogHandler(client)
+    compact = DatabaseLogHandler(client, codec='compact')
+    now = time.time()
+    for i in xrange(6):
+        handler = legacy if i % 3 == 0 else compact
+        handler.emit(logging.makeLogRecord(
+            dict(created=now + i, msg='test %d' % i, job_id=i,
+                 levelno=logging.WARNING if i % 2 else logging.INFO)))
+
+    query = DBLoggerQuery(client)
+    for kwargs in [{}, {'level': logging.WARNING},
+                   {'where': {'job_id': [1, 2, 3]}}]:
+        expected = [(key, record.message) for key, record in
+                    query.filter(begin=now - 1, **kwargs)]
+        records = list(query.filter(begin=now - 1, lazy=True, **kwargs))
+        assert [(key, record.message) for key, record in records] == \
+            expected
+        for key, record in records:
+            if record.message in ('test 0', 'test 3'):
+                assert isinstance(record, logging.LogRecord)
+            else:
+                assert isinstance(record, LazyRecord)
+
+
+@pytest.mark.parametrize('segment_size', [None, 3])
+def test_split_codec(client, segment_size):
+    dbhandler = DatabaseLogHandler(client, codec='split', index=True,
+                                   segment_size=segment_size, batch_age=60)
+    now = time.time()
+    for i in xrange(20):
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=now + i, msg='test %d' % i, job_id=i,
+                 name='split.%s' % ('odd' if i % 2 else 'even'),
+                 funcName='f%d' % (i % 3),
+                 levelno=logging.ERROR if i % 5 == 0 else logging.INFO)))
+    dbhandler.close()
+    ## bodies are plain rows, never segments
+    assert len(list(client.scan_keys('log_body'))) == 20
+
+    fetched = []
+    class CountingQuery(DBLoggerQuery):
+        def _with_bodies(self, pending, wanted, accept):
+            fetched.extend(wanted)
+            return super(CountingQuery, self)._with_bodies(
+                pending, wanted, accept)
+
+    query = CountingQuery(client)
+    records = [record for key, record in query.filter()]
+    assert [r.message for r in records] == ['test %d' % i for i in xrange(20)]
+    assert [r.job_id for r in records] == range(20)
+    assert records[4].funcName == 'f1'
+
+    del fetched[:]
+    records = [record for key, record in query.filter(filter_str='test 1')]
+    assert [r.message for r in records] == \
+        ['test 1'] + ['test %d' % i for i in xrange(10, 20)]
+    assert len(fetched) == 11
+
+    ## header conditions run first, then body conditions
+    del fetched[:]
+    records = [record for key, record in
+               query.filter(where=['levelno>=ERROR', 'funcName=f0'])]
+    assert [r.message for r in records] == ['test 0', 'test 15']
+    assert len(fetched) == 4
+
+    query = DBLoggerQuery(client, indexed=True)
+    records = [record for key, record in query.filter(name='split.odd',
+                                                      level='ERROR')]
+    assert [(r.message, r.job_id) for r in records] == \
+        [('test 5', 5), ('test 15', 15)]
+
+
+@pytest.mark.parametrize('codec,segment_size', [('pickle', None),
+                                                ('split', 3)])
+def test_delete_range(client, codec, segment_size):
+    dbhandler = DatabaseLogHandler(client, codec=codec, index=True,
+                                   segment_size=segment_size, batch_age=60)
+    now = time.time()
+    created_list = [now + 20 * i for i in xrange(10)]
+    for created in created_list:
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created, name='a.b',
+                 levelno=logging.INFO)))
+    dbhandler.close()
+    ## as in a new process, which only knows the tables it sets up
+    dblogger.pool.clear()
+
+    query = DBLoggerQuery(client, indexed=True)
+    progress = []
+    deleted = query.delete_range(created_list[2], created_list[5],
+                                 batch_size=1,
+                                 progress=lambda t, n: progress.append(t))
+    assert deleted > 0
+    assert 'log' in progress and 'log_level' in progress
+
+    def messages(**kwargs):
+        return [record.message for key, record in query.filter(**kwargs)]
+    expected = ['test %r' % c for c in created_list[:2] + created_list[5:]]
+    assert messages() == expected
+    assert messages(level=logging.INFO) == expected
+    assert messages(name='a') == expected
+
+    ## everything up to a cutoff, as retention does
+    query.delete_range(end=created_list[7])
+    expected = ['test %r' % c for c in created_list[7:]]
+    assert messages() == expected
+    assert messages(name='a.b') == expected
+    if codec == 'split':
+        assert len(list(client.scan_keys('log_body'))) == 3
+
+    cleared = []
+    query.delete_range(progress=lambda t, n: cleared.append(t))
+    assert messages() == []
+    assert list(client.scan_keys('log_name')) == []
+    ## the body table is only touched if split records were written
+    assert ('log_body' in progress + cleared) == (codec == 'split')
+
+
+def test_partition_for():
+    assert partition_for('log', 'day', 1792281600.5) == \
+        ('log_2026_10_18', 1792281600, 1792368000)
+    assert partition_for('log', 'hour', 1792281600 + 3600 * 14 + 5) == \
+        ('log_2026_10_18_14', 1792332000, 1792335600)
+    with pytest.raises(ValueError):
+        partition_for('log', 'week', 0)
+
+
+@pytest.mark.parametrize('segment_size', [None, 3])
+def test_partitions(client, segment_size):
+    dbhandler = DatabaseLogHandler(client, partition='hour', index=True,
+                                   segment_size=segment_size, batch_age=60)
+    hour = (int(time.time()) // 3600 - 3) * 3600
+    created_list = [hour + 1800 * i + 1 for i in xrange(6)]
+    for created in created_list:
+        dbhandler.emit(logging.makeLogRecord(
+            dict(created=created, msg='test %r' % created, name='a',
+                 levelno=logging.INFO)))
+    dbhandler.close()
+    ## an unpartitioned record in the same base table
+    DatabaseLogHandler(client).emit(logging.makeLogRecord(
+        dict(created=hour + 2000, msg='plain')))
+
+    tables = sorted(k[0] for k in client.scan_keys('log_partitions'))
+    assert len(tables) == 3
+    assert tables[0] == partition_for('log', 'hour', hour)[0]
+
+    scanned = []
+    class TracingQuery(DBLoggerQuery):
+        def _filter_table(self, *args):
+            scanned.append(self.table_name)
+            return super(TracingQuery, self)._filter_table(*args)
+
+    query = TracingQuery(client, partitioned=True, indexed=True)
+    def messages(**kwargs):
+        return [record.message for key, record in query.filter(**kwargs)]
+    expected = ['test %r' % c for c in created_list]
+    expected.insert(2, 'plain')
+    assert messages() == expected
+    assert messages(name='a') == [m for m in expected if m != 'plain']
+    assert [r.message for k, r in query.newest()] == expected[::-1]
+    assert [r.message for k, r in query.last(2, end=hour + 3600)] == \
+        expected[1:3]
+
+    del scanned[:]
+    assert messages(begin=hour + 3600, end=hour + 7000) == \
+        ['test %r' % c for c in created_list[2:4]]
+    assert scanned == ['log', tables[1]]
+
+    assert DBLoggerQuery(client).filter().next()[1].message == 'plain'
+
+    cursor = FollowCursor(begin=hour + 3700)
+    assert [record.message for key, record in
+            query.follow(cursor, min_interval=0.001, idle_timeout=0.05)] == \
+        ['test %r' % c for c in created_list[3:]]
+
+    ## the first partition is dropped whole, the second trimmed
+    cleared = []
+    query.delete_range(end=hour + 5400,
+                       progress=lambda t, n: n is None and cleared.append(t))
+    assert tables[0] in cleared
+    assert sorted(k[0] for k in client.scan_keys('log_partitions')) == \
+        tables[1:]
+    assert messages() == ['test %r' % c for c in created_list[3:]]
+
+
+def test_retention_cli(client):
+    returncode, out, err = run_cli(
+        client, 'dblogger.retention', '--keep-days', '7')
+    assert returncode == 0, err
+    assert 'deleted' in out
+
+
+@pytest.mark.parametrize('extra', [
+    ['--format', 'jsonl', '--fields', 'created,message', '--limit', '3'],
+    ['--format', 'tsv', '--past', '-1'],
+    ['--format', 'json'],
+])
+def test_queries_cli_format(client, extra):
+    returncode, out, err = run_cli(client, 'dblogger.query', *extra)
+    assert returncode == 0, err
+    assert 'log records' in err
+    if 'json' in extra:
+        assert isinstance(json.loads(out), list)
+
+def test_queries_cli_count_only(client):
+    returncode, out, err = run_cli(
+        client, 'dblogger.query', '--count-only', '--past', '-1')
+    assert returncode == 0, err
+    assert out.strip().isdigit()
+
+def test_queries_cli_clear_indexed(client):
+    returncode, out, err = run_cli(
+        client, 'dblogger.query', '--clear', '--yes', '--indexed',
+        '--past', '-1')
+    assert returncode == 0, err
+    assert 'deleting logs' in out
+
+def test_queries_cli_where(client):
+    returncode, out, err = run_cli(
+        client, 'dblogger.query', '--where', 'levelname=ERROR',
+        '--where', 'this is not a condition')
+    assert returncode == 2
+    assert 'FIELD OP VALUE' in err
@@ -0,0 +1,72 @@
+"""tests for dblogger.dedup"""
+from __future__ import absolute_import
+import logging
+
+from dblogger.dedup import Deduplicator, sample_args
+
+
+def record(created, msg='value %d', args=(0,), lineno=10, name='test'):
+    return logging.makeLogRecord(dict(
+        created=created, msg=msg, args=args, lineno=lineno, name=name,
+        levelno=logging.INFO, pathname='/src/test.py'))
+
+
+def test_collapse():
+    dedup = Deduplicator(window=1.0, samples=2)
+    assert not dedup.absorb(record(100.0))
+    ## repeats within the window of the previous one are held back
+    assert all(dedup.absorb(record(100.0 + 0.5 * i, args=(i,)))
+               for i in xrange(1, 6))
+    ## other lines and messages are not repeats
+    assert not dedup.absorb(record(101.0, lineno=11))
+    assert not dedup.absorb(record(101.0, msg='other %d'))
+    assert not dedup.absorb(record(101.0, name='other'))
+    assert dedup.ready == []
+
+    ## a gap longer than the window ends the run
+    assert not dedup.absorb(record(104.0))
+    (collapsed,) = dedup.take_ready()
+    assert collapsed.repeat_count == 5
+    assert collapsed.repeat_first == 100.5
+    assert collapsed.repeat_last == 102.5
+    assert collapsed.repeat_args == [('1',), ('2',)]
+    assert collapsed.getMessage() == 'value 1'
+    assert collapsed.args is None
+    assert dedup.take_ready() == []
+
+
+def test_sweep():
+    dedup = Deduplicator(window=1.0)
+    dedup.absorb(record(100.0))
+    dedup.absorb(record(100.1))
+    dedup.absorb(record(100.2, lineno=11))
+    assert not dedup.sweep_due(100.2)
+    assert not dedup.sweep_due(101.0)
+    assert dedup.sweep_due(101.2)
+    dedup.sweep(101.2)
+    assert [r.repeat_count for r in dedup.take_ready()] == [1]
+    ## nothing left but the line 11 run, which never repeated
+    dedup.sweep(None)
+    assert dedup.take_ready() == []
+    assert not dedup.absorb(record(101.3))
+
+
+def test_max_span():
+    dedup = Deduplicator(window=1.0, max_span=10.0)
+    dedup.absorb(record(0.0))
+    for i in xrange(1, 26):
+        assert dedup.absorb(record(i * 0.5))
+    assert [r.repeat_count for r in dedup.take_ready()] == [20]
+    dedup.sweep(None)
+    assert [(r.repeat_count, r.repeat_first) for r in dedup.take_ready()] == \
+        [(5, 10.5)]
+
+
+def test_sample_args():
+    class Broken(object):
+        def __str__(self):
+            raise ValueError()
+    assert sample_args((1, 'a')) == ('1', 'a')
+    assert sample_args({'k': 2}) == {'k': '2'}
+    assert sample_args(None) is None
+    assert sample_args((Broken(),))[0].startswith('<')
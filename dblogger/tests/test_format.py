@@ -0,0 +1,63 @@
+"""tests for dblogger.format"""
+from __future__ import absolute_import
+import logging
+import sys
+
+import pytest
+
+from dblogger.configure import default_config
+from dblogger.format import FixedWidthFormatter
+
+FORMAT = default_config['formatters']['fixed']['format']
+
+
+def reference(record, datefmt=None):
+    '''Format `record` as FixedWidthFormatter did before caching.'''
+    filename = record.filename[:17 - 3 - len(str(record.lineno))]
+    record.fixed_width_filename_lineno = \
+        '{0}:{1}'.format(filename, record.lineno).ljust(17)
+    record.fixed_width_levelname = record.levelname.ljust(8)
+    return logging.Formatter(FORMAT, datefmt).format(record)
+
+
+def make_record(pathname='/src/dblogger/tests/test_format.py', lineno=42,
+                level=logging.INFO, msg='a message %d', args=(1,),
+                created=1400000000.25, exc_info=None, name='dblogger.test'):
+    record = logging.LogRecord(name, level, pathname, lineno, msg, args,
+                               exc_info, 'make_record')
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    return record
+
+
+@pytest.mark.parametrize('cache_size', [0, 2, 4096])
+@pytest.mark.parametrize('datefmt', [None, '%H:%M:%S'])
+def test_matches_reference(cache_size, datefmt):
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        exc_info = sys.exc_info()
+    formatter = FixedWidthFormatter(FORMAT, datefmt, cache_size=cache_size)
+    records = [
+        dict(),
+        dict(lineno=7),
+        dict(pathname='/short.py', level=logging.WARNING),
+        dict(pathname='/a/very_long_file_name_indeed.py', lineno=12345),
+        dict(created=1400000000.75),
+        dict(created=1400000001.5, level=logging.CRITICAL),
+        dict(exc_info=exc_info),
+        dict(msg=u'unicode \u2603 %s', args=('x',)),
+        dict(level=35),
+        dict(lineno=7),
+        dict(),
+    ]
+    for kwargs in records:
+        expected = reference(make_record(**kwargs), datefmt)
+        assert formatter.format(make_record(**kwargs)) == expected
+    assert len(formatter._locations) <= cache_size
+
+
+def test_default_config():
+    formatter = FixedWidthFormatter(FORMAT)
+    line = formatter.format(make_record(level=logging.ERROR))
+    assert 'test_format.:42   ERROR    a message 1' in line
@@ -0,0 +1,129 @@
+"""tests for dblogger.output"""
+from __future__ import absolute_import
+import json
+import logging
+from cStringIO import StringIO
+
+import pytest
+
+from dblogger.codec import LazyRecord, encode
+from dblogger.format import FixedWidthFormatter
+from dblogger.output import RecordWriter, console_formatter
+
+
+def make_record(msg='value %d', args=(1,), created=1400000000.5, **extra):
+    record = logging.LogRecord('test.output', logging.WARNING,
+                               '/src/test_output.py', 12, msg, args, None,
+                               'make_record')
+    record.created = created
+    record.__dict__.update(extra)
+    return record
+
+
+def write(records, output_format, **kwargs):
+    limit = kwargs.pop('limit', None)
+    out = StringIO()
+    writer = RecordWriter(out, output_format, **kwargs)
+    count = writer.write_all(records, limit=limit)
+    writer.close()
+    return count, out.getvalue()
+
+
+def test_jsonl():
+    records = [make_record(args=(i,)) for i in xrange(3)]
+    count, out = write(records, 'jsonl')
+    assert count == 3
+    lines = [json.loads(line) for line in out.splitlines()]
+    assert [line['message'] for line in lines] == \
+        ['value 0', 'value 1', 'value 2']
+    assert lines[0]['levelname'] == 'WARNING'
+    assert lines[0]['created'] == 1400000000.5
+    assert 'repeat_count' not in lines[0]
+
+
+def test_json_array():
+    assert write([], 'json') == (0, '[]\n')
+    records = [make_record(repeat_count=4, repeat_first=1.0,
+                           repeat_last=3.0), make_record()]
+    count, out = write(records, 'json', fields=['message', 'repeat_count'])
+    assert json.loads(out) == [{'message': 'value 1', 'repeat_count': 4},
+                               {'message': 'value 1', 'repeat_count': None}]
+
+
+def test_tsv_escapes():
+    record = make_record(msg='tab\there\nand \\ back', args=None)
+    count, out = write([record], 'tsv', fields=['name', 'message', 'lineno',
+                                                'missing'])
+    assert out == 'test.output\ttab\\there\\nand \\\\ back\t12\t\n'
+
+
+def test_fixed():
+    formatter = FixedWidthFormatter('%(levelname)s %(message)s')
+    records = [make_record(), make_record(repeat_count=3, repeat_first=1.0,
+                                          repeat_last=3.5)]
+    count, out = write(records, 'fixed', formatter=formatter)
+    assert out == ('WARNING value 1\n'
+                   'WARNING value 1 [repeated 3 times over 2.5 seconds]\n')
+
+
+def test_limit_and_lazy():
+    records = [make_record(args=(i,)) for i in xrange(10)]
+    for record in records:
+        record.message = record.getMessage()
+    records = [LazyRecord(encode(record)) for record in records]
+    count, out = write(iter(records), 'tsv', fields=['message'], limit=4)
+    assert count == 4
+    assert out == 'value 0\nvalue 1\nvalue 2\nvalue 3\n'
+    ## only the requested field was read
+    assert all(r._record is None for r in records)
+    count, out = write(records[:1], 'fixed',
+                       formatter=logging.Formatter('%(message)s'))
+    assert out == 'value 0\n'
+
+
+def test_non_utf8():
+    record = make_record(msg='bad \xff byte', args=None)
+    count, out = write([record], 'jsonl', fields=['message'])
+    assert json.loads(out) == {'message': u'bad \ufffd byte'}
+
+
+def test_chunks():
+    class Out(object):
+        def __init__(self):
+            self.writes = []
+            self.flushes = 0
+
+        def write(self, data):
+            self.writes.append(data)
+
+        def flush(self):
+            self.flushes += 1
+
+    out = Out()
+    writer = RecordWriter(out, 'jsonl', fields=['message'], chunk_size=4)
+    writer.write_all(make_record() for i in xrange(10))
+    writer.close()
+    assert [data.count('\n') for data in out.writes] == [4, 4, 2]
+    assert out.flushes == 0
+
+    out = Out()
+    writer = RecordWriter(out, 'jsonl', fields=['message'], flush=True)
+    writer.write(make_record())
+    assert out.writes == ['{"message": "value 1"}\n']
+    assert out.flushes == 1
+
+
+def test_bad_format():
+    with pytest.raises(ValueError):
+        RecordWriter(StringIO(), 'xml')
+
+
+def test_console_formatter(monkeypatch):
+    root = logging.getLogger()
+    formatter = logging.Formatter('%(message)s')
+    first = logging.StreamHandler()
+    first.setFormatter(formatter)
+    monkeypatch.setattr(root, 'handlers', [first, logging.StreamHandler()])
+    assert console_formatter() is formatter
+    monkeypatch.setattr(root, 'handlers', [logging.StreamHandler()])
+    assert isinstance(console_formatter(), FixedWidthFormatter)
@@ -0,0 +1,63 @@
+"""tests for dblogger.pool"""
+from __future__ import absolute_import
+import os
+
+import pytest
+
+from dblogger import pool
+
+
+class CountingStorage(object):
+    '''records setup_namespace calls'''
+    def __init__(self):
+        self.setups = []
+
+    def setup_namespace(self, tables):
+        self.setups.append(sorted(tables))
+
+
+def config(namespace):
+    return dict(storage_type='local', app_name='dbltest',
+                namespace=namespace)
+
+
+def test_client():
+    first = pool.client(config('test_pool_a'))
+    assert pool.client(config('test_pool_a')) is first
+    assert pool.client(config('test_pool_b')) is not first
+    pool.clear()
+    assert pool.client(config('test_pool_a')) is not first
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_client_fork():
+    parent = pool.client(config('test_pool_fork'))
+    pid = os.fork()
+    if pid == 0:
+        child = pool.client(config('test_pool_fork'))
+        os._exit(0 if child is not parent and
+                 pool.client(config('test_pool_fork')) is child else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert pool.client(config('test_pool_fork')) is parent
+
+
+def test_setup_namespace():
+    storage = CountingStorage()
+    pool.setup_namespace(storage, {'a': 1, 'b': 1})
+    pool.setup_namespace(storage, {'a': 1})
+    pool.setup_namespace(storage, {'a': 1, 'c': 2})
+    pool.setup_namespace(storage, {'c': 1})
+    assert storage.setups == [['a', 'b'], ['c'], ['c']]
+    assert CountingStorage().setups == []
+    other = CountingStorage()
+    pool.setup_namespace(other, {'a': 1})
+    assert other.setups == [['a']]
+
+
+def test_copy_config():
+    original = {'storage_type': 'local', 'addresses': ('a', 'b'),
+                'nested': {'x': [1, 2]}}
+    copied = pool.copy_config(original)
+    assert copied == {'storage_type': 'local', 'addresses': ['a', 'b'],
+                      'nested': {'x': [1, 2]}}
+    assert copied['nested'] is not original['nested']
@@ -0,0 +1,78 @@
+"""tests for dblogger.predicate"""
+from __future__ import absolute_import
+import logging
+import re
+
+import pytest
+
+from dblogger import codec
+from dblogger.predicate import compile_where, parse_condition
+
+
+def make_record(**kwargs):
+    record = logging.LogRecord('app.db', logging.WARNING, '/src/app/db.py',
+                               42, 'connection %s timed out', ('db1',), None,
+                               'connect')
+    record.__dict__.update(kwargs)
+    record.message = record.getMessage()
+    record.exc_text = ''
+    return record
+
+
+@pytest.mark.parametrize(('expr', 'expected'), [
+    ('levelname=WARNING', True),
+    ('levelname == ERROR', False),
+    ('level>=WARNING', True),
+    ('level>=ERROR', False),
+    ('levelno<40', True),
+    ('lineno in 41,42', True),
+    ('funcName in run,stop', False),
+    ('message=~timed out', True),
+    ('message=~^timed', False),
+    ('name!=app', True),
+    ('job_id=17', True),
+    ('job_id>20', False),
+    ('missing=1', False),
+])
+def test_conditions(expr, expected):
+    where = compile_where([expr])
+    assert where.match(make_record(job_id=17)) == expected
+
+
+def test_dict():
+    record = make_record()
+    assert compile_where({'name': 'app.db', 'lineno': [1, 42]}).match(record)
+    assert not compile_where({'name': 'app'}).match(record)
+    assert compile_where({'funcName': re.compile('conn')}).match(record)
+
+
+def test_keywords():
+    record = make_record()
+    assert compile_where(level=logging.INFO, name='app').match(record)
+    assert not compile_where(name='ap').match(record)
+    assert compile_where(message_re='connection').match(record)
+    assert not compile_where(message_re='timed').match(record)
+    assert compile_where() is None
+
+
+def test_pushdown():
+    where = compile_where(['levelname=WARNING', 'job_id=17'])
+    assert [c.field for c in where.stored] == ['levelname']
+    assert [c.field for c in where.deferred] == ['job_id']
+    fields = codec.decode_fields(codec.encode(make_record(job_id=17)))
+    assert where.match_fields(fields)
+    assert where.match(codec.make_record(fields), deferred_only=True)
+
+    where = compile_where(['levelname=ERROR'])
+    assert not where.match_fields(fields)
+
+
+def test_cost_order():
+    where = compile_where(['message=~x', 'funcName=run', 'lineno=1'])
+    assert [c.field for c in where.conditions] == \
+        ['lineno', 'funcName', 'message']
+
+
+def test_bad_condition():
+    with pytest.raises(ValueError):
+        parse_condition('just some words')
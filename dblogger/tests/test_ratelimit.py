@@ -0,0 +1,71 @@
+"""tests for dblogger.ratelimit"""
+from __future__ import absolute_import
+import logging
+
+import pytest
+
+from dblogger.ratelimit import RateLimiter
+
+
+def test_token_bucket():
+    limiter = RateLimiter([{'rate': 2, 'burst': 3}])
+    now = 1000.0
+    assert [limiter.allow('a', logging.INFO, now) for i in xrange(5)] == \
+        [True, True, True, False, False]
+    ## each logger and level has its own bucket
+    assert limiter.allow('b', logging.INFO, now)
+    assert limiter.allow('a', logging.WARNING, now)
+    ## two records per second come back
+    assert [limiter.allow('a', logging.INFO, now + 1) for i in xrange(3)] == \
+        [True, True, False]
+    assert limiter.suppressed == {'a': 3}
+    assert limiter.suppressed_total == 3
+
+
+def test_rule_choice():
+    limiter = RateLimiter([
+        {'rate': 1, 'max_level': 'WARNING'},
+        {'logger': 'noisy', 'rate': 1, 'burst': 2},
+        {'logger': 'noisy.quiet', 'rate': None},
+    ])
+    now = 1000.0
+    ## errors are not limited by the catch-all rule
+    assert all(limiter.allow('other', logging.ERROR, now)
+               for i in xrange(10))
+    assert [limiter.allow('other', logging.INFO, now)
+            for i in xrange(2)] == [True, False]
+    ## the longest matching logger wins, at any level
+    assert [limiter.allow('noisy.child', logging.ERROR, now)
+            for i in xrange(3)] == [True, True, False]
+    assert all(limiter.allow('noisy.quiet', logging.INFO, now)
+               for i in xrange(10))
+    ## a prefix that is not a parent logger does not match
+    assert [limiter.allow('noisyish', logging.INFO, now)
+            for i in xrange(2)] == [True, False]
+
+
+def test_sample():
+    values = iter([0.05, 0.5, 0.09, 0.99])
+    limiter = RateLimiter([{'sample': 0.1}], rand=lambda: next(values))
+    assert [limiter.allow('a', logging.INFO) for i in xrange(4)] == \
+        [True, False, True, False]
+
+
+def test_report():
+    limiter = RateLimiter([{'rate': 1}], report_interval=60)
+    assert not limiter.report_due()
+    for name in ('b', 'a', 'b'):
+        limiter.allow(name, logging.INFO, 0)
+        limiter.allow(name, logging.INFO, 0)
+    assert not limiter.report_due()
+    assert limiter.report_due(limiter._last_report + 60)
+    assert limiter.take_report() == [('a', 1), ('b', 3)]
+    assert limiter.take_report() == []
+    assert limiter.suppressed_total == 4
+
+
+@pytest.mark.parametrize('rule', [{'rate': 0}, {'sample': 2},
+                                  {'max_level': 'LOUD'}, {'rat': 1}])
+def test_bad_rules(rule):
+    with pytest.raises((ValueError, TypeError)):
+        RateLimiter([rule])
@@ -0,0 +1,169 @@
+"""tests for dblogger.spill"""
+from __future__ import absolute_import
+import logging
+import os
+import uuid
+
+import pytest
+
+from dblogger import DatabaseLogHandler, DBLoggerQuery
+from dblogger.benchmark import storage_client
+from dblogger.pool import setup_namespace
+from dblogger.spill import Spill, read_entries
+
+
+class FlakyStorage(object):
+    '''a storage client whose puts fail while `down` is set'''
+    def __init__(self):
+        self.storage = storage_client()
+        self.down = False
+
+    def setup_namespace(self, tables):
+        self.storage.setup_namespace(tables)
+
+    def put(self, table_name, *pairs):
+        if self.down:
+            raise IOError('storage is down')
+        self.storage.put(table_name, *pairs)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+@pytest.fixture
+def flaky(request):
+    storage = FlakyStorage()
+    request.addfinalizer(storage.storage.delete_namespace)
+    return storage
+
+
+@pytest.fixture
+def spill(request, flaky, tmpdir):
+    setup_namespace(flaky, {'t': (uuid.UUID,)})
+    spill = Spill(flaky, str(tmpdir), prefix='t', retry_interval=60)
+    request.addfinalizer(spill.close)
+    return spill
+
+
+def rows(n):
+    return [('t', (uuid.UUID(int=i),), 'value %d' % i) for i in xrange(n)]
+
+
+def test_replay(flaky, spill):
+    assert not spill.diverting()
+    spill.spill_failed(None, rows(5))
+    assert spill.diverting()
+    assert spill.append(rows(10)[5:]) == 5
+    assert spill.counters()['spilled'] == 10
+    assert spill.spill_bytes > 0
+
+    flaky.down = True
+    assert not spill.replay()
+    assert list(flaky.storage.scan('t')) == []
+    flaky.down = False
+    assert spill.replay()
+    assert not spill.diverting()
+    assert list(flaky.storage.scan('t')) == \
+        [(key, value) for _, key, value in rows(10)]
+    assert spill.counters() == {'spilled': 10, 'spill_dropped': 0,
+                                'replayed': 10, 'spill_bytes': 0}
+    assert os.listdir(spill.directory) == []
+
+
+def test_torn_entry(spill):
+    spill.append(rows(3))
+    spill.close()
+    with open(spill.path, 'ab') as f:
+        f.write('\x00\x00\x01')
+    assert [key for _, _, key, _ in read_entries(spill.path)] == \
+        [key for _, key, _ in rows(3)]
+
+
+def test_max_bytes(flaky, tmpdir):
+    setup_namespace(flaky, {'t': (uuid.UUID,)})
+    spill = Spill(flaky, str(tmpdir), prefix='t', max_bytes=300,
+                  retry_interval=60)
+    try:
+        written = spill.append(rows(10))
+        assert 0 < written < 10
+        assert spill.spill_dropped == 10 - written
+        assert spill.spill_bytes <= 300
+    finally:
+        spill.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_orphan(flaky, tmpdir):
+    setup_namespace(flaky, {'t': (uuid.UUID,)})
+    pid = os.fork()
+    if pid == 0:
+        try:
+            Spill(flaky, str(tmpdir), prefix='t').append(rows(4))
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.listdir(str(tmpdir)) == ['t.%d.spill' % pid]
+
+    spill = Spill(flaky, str(tmpdir), prefix='t', retry_interval=60)
+    try:
+        assert spill.replay()
+        assert spill.replayed == 4
+        assert len(list(flaky.storage.scan('t'))) == 4
+        assert os.listdir(str(tmpdir)) == []
+    finally:
+        spill.close()
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_handler_spill(flaky, tmpdir, batch):
+    dbhandler = DatabaseLogHandler(flaky, batch=batch, batch_age=60,
+                                   codec='split', index=True,
+                                   spill_dir=str(tmpdir), retry_interval=60)
+    try:
+        flaky.down = True
+        for i in xrange(5):
+            dbhandler.emit(logging.makeLogRecord(dict(
+                msg='test %d' % i, name='test', levelno=logging.INFO)))
+        dbhandler.flush()
+        stats = dbhandler.stats()
+        ## a header, a body, a level index entry, and a name index entry
+        assert stats['spilled'] == 20
+        assert stats['put_errors'] == 1
+
+        flaky.down = False
+        query = DBLoggerQuery(flaky.storage, indexed=True)
+        assert list(query.filter()) == []
+        assert dbhandler._spill.replay()
+        dbhandler.emit(logging.makeLogRecord(dict(
+            msg='test 5', name='test', levelno=logging.INFO)))
+        dbhandler.flush()
+        assert [r.message for k, r in query.filter(name='test')] == \
+            ['test %d' % i for i in xrange(6)]
+        assert dbhandler.stats()['spilled'] == 20
+    finally:
+        dbhandler.close()
+
+
+def test_put_budget(flaky, tmpdir):
+    dbhandler = DatabaseLogHandler(flaky, spill_dir=str(tmpdir),
+                                   put_budget=0, retry_interval=60)
+    try:
+        dbhandler.emit(logging.makeLogRecord(dict(msg='slow')))
+        dbhandler.emit(logging.makeLogRecord(dict(msg='diverted')))
+        stats = dbhandler.stats()
+        assert stats['put']['count'] == 1
+        assert stats['spilled'] == 1
+    finally:
+        dbhandler.close()
+
+
+def test_serialize_failure(flaky, tmpdir):
+    dbhandler = DatabaseLogHandler(flaky, spill_dir=str(tmpdir))
+    try:
+        record = logging.makeLogRecord(dict(msg='unpicklable'))
+        record.unpicklable = lambda: None
+        ## stored as the error text, without exiting
+        dbhandler.emit(record)
+        assert dbhandler.stats()['failures'] == 1
+    finally:
+        dbhandler.close()
@@ -0,0 +1,48 @@
+"""tests for dblogger.stats"""
+from __future__ import absolute_import
+
+from dblogger.stats import BUCKET_BOUNDS, HandlerStats, Histogram, flatten
+
+
+def test_histogram():
+    h = Histogram()
+    assert h.snapshot()['p50'] is None
+    assert h.snapshot()['max'] == 0
+    for i in xrange(90):
+        h.add(0.001)
+    for i in xrange(10):
+        h.add(0.1)
+    h.add(1000)
+    snapshot = h.snapshot()
+    assert snapshot['count'] == 101
+    assert snapshot['max'] == 1000
+    assert 0.001 <= snapshot['p50'] < 0.002
+    assert 0.1 <= snapshot['p99'] < 0.2
+    assert sum(count for bound, count in snapshot['buckets']) == 101
+    assert snapshot['buckets'][-1] == [None, 1]
+    assert h.percentile(1.0) == 1000
+    assert len(h.buckets) == len(BUCKET_BOUNDS) + 1
+
+
+def test_handler_stats():
+    stats = HandlerStats()
+    stats.record_emit(0.0001)
+    stats.record_emit(0.0001, emitted=False, failed=True)
+    stats.record_put(0.01, 3, 300)
+    stats.record_put(0.5, 2, 200, failed=True)
+    snapshot = stats.snapshot(dropped=4, queue_depth=1, max_queue_depth=7)
+    assert snapshot['emitted'] == 1
+    assert snapshot['failures'] == 1
+    assert snapshot['rows_written'] == 3
+    assert snapshot['bytes_written'] == 300
+    assert snapshot['put_errors'] == 1
+    assert snapshot['put']['count'] == 2
+    assert snapshot['dropped'] == 4
+    assert snapshot['max_queue_depth'] == 7
+
+    flat = flatten(snapshot)
+    assert flat['put_count'] == 2
+    assert flat['put_max'] == 0.5
+    assert flat['format_count'] == 2
+    assert flat['bytes_written'] == 300
+    assert not any(isinstance(v, (dict, list)) for v in flat.itervalues())
@@ -0,0 +1,54 @@
+"""tests for dblogger.utils"""
+from __future__ import absolute_import
+import os
+import time
+import uuid
+
+import pytest
+
+from dblogger.utils import KeyGenerator, gen_uuid, tick_uuid, time_tick, \
+    uuid_time
+
+
+def test_key_generator_order():
+    gen = KeyGenerator()
+    now = time.time()
+    keys = [gen(now) for i in xrange(1000)]
+    assert len(set(keys)) == len(keys)
+    ## same time, so in call order
+    assert keys == sorted(keys)
+    assert all(isinstance(k, uuid.UUID) for k in keys)
+    assert uuid.UUID(str(keys[0])) == keys[0]
+    assert abs(uuid_time(keys[0]) - now) < 0.001
+
+    ## compatible with gen_uuid and tick_uuid range bounds
+    assert gen_uuid(now - 0.01) < keys[0] < gen_uuid(now + 0.01)
+    assert tick_uuid(time_tick(now)) <= keys[0] <= \
+        tick_uuid(time_tick(now), last=True)
+    assert gen(now - 1) < keys[0] < gen(now + 1)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_key_generator_fork():
+    gen = KeyGenerator()
+    now = time.time()
+    parent = [gen(now) for i in xrange(10)]
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write_fd, ''.join(gen(now).bytes for i in xrange(10)))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while len(data) < 160:
+        chunk = os.read(read_fd, 160)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    child = [uuid.UUID(bytes=data[i:i + 16]) for i in xrange(0, 160, 16)]
+    assert len(child) == 10
+    assert not set(child) & set(parent + [gen(now) for i in xrange(10)])
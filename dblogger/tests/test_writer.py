@@ -0,0 +1,133 @@
+"""tests for dblogger.writer"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+import pytest
+
+from dblogger.writer import BatchWriter
+
+
+class BlockingStorage(object):
+    '''records puts, but only once `release` is set'''
+    def __init__(self):
+        self.release = threading.Event()
+        self.puts = []
+
+    def put(self, table_name, *pairs):
+        self.release.wait()
+        self.puts.extend((table_name, key, value) for key, value in pairs)
+
+
+def stalled_writer(**kwargs):
+    '''a writer whose thread is stuck writing a first record "a"'''
+    storage = BlockingStorage()
+    writer = BatchWriter(storage, max_count=1, max_age=60, **kwargs)
+    writer.put('log', ('a',), 'a')
+    deadline = time.time() + 10
+    while writer.depth and time.time() < deadline:
+        time.sleep(0.001)
+    assert writer.depth == 0
+    return storage, writer
+
+
+def written(storage):
+    return [value for table_name, key, value in storage.puts
+            if table_name == 'log']
+
+
+def test_unbounded():
+    storage = BlockingStorage()
+    storage.release.set()
+    writer = BatchWriter(storage, max_age=60)
+    for c in 'abcd':
+        writer.put('log', (c,), c)
+    assert writer.flush(10)
+    assert written(storage) == list('abcd')
+    assert writer.close(10)
+    with pytest.raises(RuntimeError):
+        writer.put('log', ('e',), 'e')
+
+
+def test_drop_newest():
+    storage, writer = stalled_writer(max_queue=2)
+    assert writer.put('log', ('b',), 'b')
+    assert writer.put('log', ('c',), 'c')
+    assert not writer.put('log', ('d',), 'd')
+    storage.release.set()
+    assert writer.close(10)
+    assert written(storage) == list('abc')
+    assert writer.dropped_total == 1
+
+
+def test_drop_oldest():
+    storage, writer = stalled_writer(max_queue=2, overflow='drop_oldest')
+    for c in 'bcd':
+        assert writer.put('log', (c,), c)
+    storage.release.set()
+    assert writer.close(10)
+    assert written(storage) == list('acd')
+    assert writer.dropped_total == 1
+
+
+def test_drop_oldest_rows():
+    storage, writer = stalled_writer(max_queue=2, overflow='drop_oldest')
+    for c in 'bcd':
+        assert writer.put('log', (c,), c,
+                          rows=[('index', (c, 1), ''), ('index', (c, 2), '')])
+    assert writer.depth == 2
+    storage.release.set()
+    assert writer.close(10)
+    assert written(storage) == list('acd')
+    assert [key for table_name, key, value in storage.puts
+            if table_name == 'index'] == [('c', 1), ('c', 2),
+                                          ('d', 1), ('d', 2)]
+    assert writer.dropped_total == 1
+
+
+def test_drop_below():
+    storage, writer = stalled_writer(max_queue=2, overflow='drop_below',
+                                     overflow_level=logging.WARNING)
+    assert writer.put('log', ('b',), 'b', logging.INFO)
+    assert writer.put('log', ('c',), 'c', logging.ERROR)
+    assert not writer.put('log', ('d',), 'd', logging.DEBUG)
+    assert writer.put('log', ('e',), 'e', logging.ERROR)
+    assert not writer.put('log', ('f',), 'f', logging.ERROR)
+    storage.release.set()
+    assert writer.close(10)
+    assert written(storage) == list('ace')
+    assert writer.dropped_total == 3
+
+
+def test_block():
+    storage, writer = stalled_writer(max_queue=1, overflow='block',
+                                     block_timeout=0.05)
+    assert writer.put('log', ('b',), 'b')
+    start = time.time()
+    assert not writer.put('log', ('c',), 'c')
+    assert time.time() - start >= 0.05
+    storage.release.set()
+    assert writer.close(10)
+    assert written(storage) == list('ab')
+
+
+def test_drop_report():
+    reports = []
+    def report(dropped):
+        reports.append(dropped)
+        return [('summary', ('summary',), 'dropped %d' % dropped)]
+    storage, writer = stalled_writer(max_queue=1, report_callback=report,
+                                     report_interval=3600)
+    writer.put('log', ('b',), 'b')
+    writer.put('log', ('c',), 'c')
+    writer.put('log', ('d',), 'd')
+    storage.release.set()
+    assert writer.close(10)
+    assert reports == [2]
+    assert ('summary', ('summary',), 'dropped 2') in storage.puts
+
+
+def test_bad_policy():
+    with pytest.raises(ValueError):
+        BatchWriter(BlockingStorage(), overflow='drop_everything')
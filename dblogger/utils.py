@@ -1,7 +1,11 @@
 
+import itertools
+import os
 import random
+import socket
 import struct
 import time
+import zlib
 
 from uuid import UUID
 
@@ -20,6 +24,86 @@ def gen_uuid(timestamp=None, sequence=None):
     return UUID(bytes=bytes)
 
 
+_MASK32 = (1 << 32) - 1
+_MASK64 = (1 << 64) - 1
+
+
+class KeyGenerator(object):
+    '''Generate unique record keys cheaply.
+
+    Keys have the same layout as :func:`gen_uuid` keys: the high 64
+    bits are the time, in units of 1/1024 second, so keys from both
+    sort together and :func:`gen_uuid` and :func:`tick_uuid` bounds
+    work for range scans.  The low 64 bits are a 32-bit prefix for
+    the process, derived once from the host name, process id, and a
+    random nonce, and a 32-bit counter, so keys for the same time
+    from one process are distinct and in call order, and keys from
+    different processes collide only if their prefixes do.
+
+    The prefix and counter are recomputed if the process id changes,
+    so a forked child does not repeat its parent's keys.  Calling the
+    generator is safe from several threads.
+
+    '''
+    def __init__(self):
+        self._pid = None
+        self._prefix = 0
+        self._counter = None
+
+    def _reset(self, pid):
+        nonce = os.urandom(8)
+        seed = '{0}\0{1}\0{2}'.format(socket.gethostname(), pid, nonce)
+        self._prefix = (zlib.crc32(seed) & _MASK32) << 32
+        self._counter = itertools.count(
+            struct.unpack('>L', nonce[:4])[0])
+        self._pid = pid
+
+    def __call__(self, timestamp):
+        '''Get a new key for a record created at `timestamp`.
+
+        :param float timestamp: record creation time
+        :rtype: :class:`uuid.UUID`
+
+        '''
+        pid = os.getpid()
+        if pid != self._pid:
+            self._reset(pid)
+        key = _new_uuid(UUID)
+        # skip UUID.__init__, whose argument checks cost more than
+        # the rest of this put together
+        key.__dict__['int'] = (
+            ((long(timestamp * 1024) & _MASK64) << 64) |
+            self._prefix | (next(self._counter) & _MASK32))
+        return key
+
+
+_new_uuid = object.__new__
+
+#: Shared :class:`KeyGenerator` for :class:`dblogger.DatabaseLogHandler`
+gen_key = KeyGenerator()
+
+
+_humantime_cache = (None, None)
+
+
+def humantime(timestamp):
+    '''Format `timestamp` as a fixed-format local time string.
+
+    This is the ``%(humantime)s`` property added by
+    :class:`dblogger.DatabaseLogHandler`.  Since log records arrive in
+    bursts, the formatted string for the most recent second is cached.
+
+    '''
+    global _humantime_cache
+    second = int(timestamp)
+    cached_second, cached = _humantime_cache
+    if second != cached_second:
+        cached = time.strftime('%Y-%m-%dT%H:%M:%S-%Z',
+                               time.localtime(second))
+        _humantime_cache = (second, cached)
+    return cached
+
+
 def random_slice(items):
     start = random.randint(0, len(items))
     end = random.randint(0, len(items))
@@ -28,3 +112,28 @@ def random_slice(items):
 
 def datetime_to_time(datetime):
     return time.mktime(datetime.timetuple())
+
+
+def time_tick(timestamp):
+    '''Get the time part of a :func:`gen_uuid` key for a timestamp.'''
+    return long(timestamp * 1024)
+
+
+def tick_uuid(tick, last=False):
+    '''Get the first or last possible key for a :func:`time_tick` value.
+
+    These make exact range boundaries, unlike :func:`gen_uuid`, whose
+    low-order bits are random.
+
+    '''
+    low = (1 << 64) - 1 if last else 0
+    return UUID(int=(tick << 64) | low)
+
+
+def uuid_time(key):
+    '''Get the timestamp encoded in a key made by :func:`gen_uuid`.
+
+    The result is only as precise as the key, about a millisecond.
+
+    '''
+    return struct.unpack('>q', key.bytes[:8])[0] / 1024.0
@@ -0,0 +1,444 @@
+'''Background batching writer for :class:`dblogger.DatabaseLogHandler`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2013-2014 Diffeo, Inc.
+
+A :class:`BatchWriter` owns a daemon thread that collects serialized
+log records and writes them to :mod:`kvlayer` as a single multi-pair
+:meth:`~kvlayer.AbstractStorage.put` per table.  A batch is written
+when it holds `max_count` records, `max_bytes` bytes of values, or
+when its oldest record is `max_age` seconds old, whichever comes
+first.  :meth:`BatchWriter.flush` and :meth:`BatchWriter.close` wait
+for outstanding records to be written, up to a deadline, and every
+live writer is closed by an :mod:`atexit` hook so that a normal
+interpreter shutdown does not lose buffered records.  The hook first
+calls every writer's `close_callback`, so that records held back
+elsewhere are put while every writer still accepts them.
+
+The buffer may also be bounded by `max_queue`.  When it is full,
+:meth:`BatchWriter.put` applies an overflow policy instead of
+growing the buffer:
+
+``drop_newest``
+    Discard the record being added.
+
+``drop_oldest``
+    Discard the oldest buffered record to make room.
+
+``drop_below``
+    Discard the record being added if its level is below
+    `overflow_level`; otherwise discard the oldest buffered record
+    below that level, or the new record if there is none.
+
+``block``
+    Wait up to `block_timeout` seconds for room, then discard the
+    record being added.
+
+Discarded records are counted, and every `report_interval` seconds
+that saw drops, and once more on close, `report_callback` is asked
+for a summary record that is written regardless of the bound.
+
+If `segment_size` is set, records for the tables named in
+`segment_tables` are packed into compressed multi-record segments as
+described in :mod:`dblogger.segment` before being written.
+
+If `stats` is given, a :class:`dblogger.stats.HandlerStats`, every
+write is timed and counted in it.
+
+If `spill` is given, a :class:`dblogger.spill.Spill`, writes that
+fail are spilled to it instead of going to `error_callback`, and
+while it is diverting, batches go to it without trying the database.
+
+.. autoclass:: BatchWriter
+
+'''
+from __future__ import absolute_import
+
+import atexit
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from dblogger import segment
+
+#: Default number of seconds to wait for buffered records on close
+DEFAULT_CLOSE_TIMEOUT = 5.0
+
+#: Names of the supported overflow policies
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'drop_below', 'block')
+
+_live_writers = weakref.WeakSet()
+
+
+class BatchWriter(object):
+    '''Write (table, key, value) triples to kvlayer from a thread.
+
+    Callers hand records to :meth:`put`, which only appends to an
+    in-memory buffer.  The background thread wakes up when a size,
+    count, or age limit is reached and writes everything buffered,
+    grouped by table, in the order it was received.
+
+    If a write fails, `error_callback` is called with the
+    :func:`sys.exc_info` triple and the list of ``(table_name, key,
+    value)`` triples that were not written.  The default prints the
+    traceback to :data:`sys.stderr`; it must not log through
+    :mod:`logging`, since that could feed back into this writer.
+
+    If `max_queue` is set, at most that many records are buffered and
+    `overflow` names the policy for records beyond that; see the
+    module documentation.  `report_callback` is called from the
+    writer thread as ``report_callback(dropped)`` and returns a list
+    of ``(table_name, key, value)`` triples describing the drops.
+
+    '''
+    def __init__(self, storage, max_count=1000, max_bytes=1048576,
+                 max_age=1.0, close_timeout=DEFAULT_CLOSE_TIMEOUT,
+                 error_callback=None, max_queue=None,
+                 overflow='drop_newest', overflow_level=logging.WARNING,
+                 block_timeout=0.1, report_callback=None,
+                 report_interval=60.0, segment_size=None,
+                 segment_tables=(), stats=None, spill=None,
+                 close_callback=None):
+        '''Create and start a new batching writer.
+
+        :param storage: storage client to write to
+        :type storage: :class:`kvlayer.AbstractStorage`
+        :param int max_count: write once this many records are buffered
+        :param int max_bytes: write once values total this many bytes
+        :param float max_age: write once the oldest buffered record
+          is this many seconds old
+        :param float close_timeout: seconds the :mod:`atexit` hook
+          waits for buffered records
+        :param error_callback: called as ``error_callback(exc_info,
+          triples)`` when a write fails
+        :param int max_queue: maximum number of buffered records,
+          or :const:`None` for no limit
+        :param str overflow: policy name from :data:`OVERFLOW_POLICIES`
+        :param int overflow_level: level threshold for ``drop_below``
+        :param float block_timeout: seconds ``block`` waits for room
+        :param report_callback: builds a summary record for dropped
+          records
+        :param float report_interval: minimum seconds between summaries
+        :param int segment_size: maximum records per segment, or
+          :const:`None` to write every record as its own row
+        :param segment_tables: names of tables whose records are
+          packed into segments; the writer keeps these in the
+          :attr:`segment_tables` set, which callers may add to
+        :param stats: counters to record writes in
+        :type stats: :class:`dblogger.stats.HandlerStats`
+        :param spill: spill file for rows that cannot be written
+        :type spill: :class:`dblogger.spill.Spill`
+        :param close_callback: called with no arguments by the
+          :mod:`atexit` hook before it closes any writer
+        :raise exceptions.ValueError: if `overflow` is not a known policy
+
+        '''
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy {0!r}, expected one '
+                             'of {1!r}'.format(overflow, OVERFLOW_POLICIES))
+        self.storage = storage
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.close_timeout = close_timeout
+        self.error_callback = error_callback or self._print_error
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.overflow_level = overflow_level
+        self.block_timeout = block_timeout
+        self.report_callback = report_callback
+        self.report_interval = report_interval
+        self.segment_size = segment_size
+        self.segment_tables = set(segment_tables)
+        self.stats = stats
+        self.spill = spill
+        self.close_callback = close_callback
+        if spill is not None:
+            self.error_callback = spill.spill_failed
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._oldest = None
+        #: number of records ever accepted by :meth:`put`
+        self._enqueued = 0
+        #: number of records handed to storage (or to error_callback)
+        self._done = 0
+        self._flush_requested = False
+        self._closed = False
+        #: records dropped since the last summary
+        self._dropped = 0
+        #: records dropped over the life of the writer
+        self.dropped_total = 0
+        #: most records ever buffered at once
+        self.max_depth = 0
+        self._last_report = time.time()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='dblogger-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        _live_writers.add(self)
+
+    def put(self, table_name, key, value, levelno=logging.NOTSET,
+            rows=()):
+        '''Buffer one record for writing.
+
+        This never waits on the database.  If the buffer is bounded
+        and full, the overflow policy decides which record is
+        dropped; only the ``block`` policy waits, and then at most
+        `block_timeout` seconds.
+
+        `rows` are further ``(table_name, key, value)`` triples that
+        belong to the record, such as its index entries.  They take
+        no room of their own in the buffer, and are written or
+        dropped together with the record.
+
+        :param str table_name: kvlayer table to write to
+        :param tuple key: kvlayer key tuple
+        :param str value: serialized record
+        :param int levelno: level of the record, for ``drop_below``
+        :param list rows: other rows to write with the record
+        :return: :const:`False` if this record was dropped
+        :raise exceptions.RuntimeError: if the writer is closed
+
+        '''
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('BatchWriter is closed')
+            if self._full() and not self._make_room(levelno):
+                self._drop()
+                return False
+            if not self._pending:
+                self._oldest = time.time()
+            rows = tuple(rows)
+            self._pending.append((table_name, key, value, levelno, rows))
+            self._pending_bytes += len(value) + sum(len(v) for t, k, v
+                                                    in rows)
+            self._enqueued += 1
+            if len(self._pending) > self.max_depth:
+                self.max_depth = len(self._pending)
+            if self._batch_ready():
+                self._cond.notify_all()
+            return True
+
+    @property
+    def depth(self):
+        '''Number of records currently buffered.'''
+        return len(self._pending)
+
+    def _full(self):
+        return (self.max_queue is not None and
+                len(self._pending) >= self.max_queue)
+
+    def _make_room(self, levelno):
+        '''Apply the overflow policy to a full buffer.
+
+        Must be called with the condition held.  Returns
+        :const:`True` if the new record should be added.
+
+        '''
+        if self.overflow == 'drop_oldest':
+            self._discard(0)
+            return True
+        if self.overflow == 'drop_below':
+            if levelno < self.overflow_level:
+                return False
+            for index, pending in enumerate(self._pending):
+                if pending[3] < self.overflow_level:
+                    self._discard(index)
+                    return True
+            return False
+        if self.overflow == 'block':
+            self._cond.notify_all()
+            deadline = time.time() + self.block_timeout
+            while self._full() and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return not self._closed
+        return False
+
+    def _discard(self, index):
+        table_name, key, value, levelno, rows = self._pending[index]
+        del self._pending[index]
+        self._pending_bytes -= len(value) + sum(len(v) for t, k, v in rows)
+        # a discarded record counts as handled, so that flush()
+        # callers waiting on it are released
+        self._done += 1
+        self._drop()
+
+    def _drop(self):
+        self._dropped += 1
+        self.dropped_total += 1
+
+    def flush(self, timeout=None):
+        '''Wait until every record put so far has been written.
+
+        :param float timeout: maximum seconds to wait, or :const:`None`
+          to wait indefinitely
+        :return: :const:`True` if everything was written in time
+
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            target = self._enqueued
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._done < target and self._thread.is_alive():
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._done >= target
+
+    def close(self, timeout=None):
+        '''Write out buffered records and stop the background thread.
+
+        Further calls to :meth:`put` fail.  Calling this more than
+        once is harmless.
+
+        :param float timeout: maximum seconds to wait, or :const:`None`
+          to wait indefinitely
+        :return: :const:`True` if everything was written in time
+
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        _live_writers.discard(self)
+        with self._cond:
+            return self._done >= self._enqueued
+
+    def _batch_ready(self):
+        '''Decide whether the buffer should be written now.
+
+        Must be called with the condition held.
+
+        '''
+        if not self._pending:
+            return False
+        if self._flush_requested or self._closed or self._full():
+            return True
+        if len(self._pending) >= self.max_count:
+            return True
+        if self._pending_bytes >= self.max_bytes:
+            return True
+        return time.time() - self._oldest >= self.max_age
+
+    def _report_due(self):
+        if self.report_callback is None or self._dropped == 0:
+            return False
+        if self._closed:
+            return True
+        return time.time() - self._last_report >= self.report_interval
+
+    def _take_report(self):
+        '''Build the summary record for dropped records, if one is due.
+
+        Must be called with the condition held.
+
+        '''
+        if not self._report_due():
+            return []
+        dropped = self._dropped
+        self._dropped = 0
+        self._last_report = time.time()
+        return [triple + (logging.NOTSET, ())
+                for triple in self.report_callback(dropped)]
+
+    def _next_wakeup(self):
+        wakeups = []
+        if self._pending:
+            wakeups.append(self._oldest + self.max_age)
+        if self.report_callback is not None and self._dropped:
+            wakeups.append(self._last_report + self.report_interval)
+        if not wakeups:
+            return None
+        return max(0, min(wakeups) - time.time())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._batch_ready() or self._report_due()):
+                    if self._closed:
+                        self._cond.notify_all()
+                        return
+                    if not self._pending:
+                        self._flush_requested = False
+                    self._cond.wait(self._next_wakeup())
+                batch = list(self._pending)
+                self._pending.clear()
+                self._pending_bytes = 0
+                self._oldest = None
+                self._cond.notify_all()
+                report = self._take_report()
+            self._write(batch + report)
+            with self._cond:
+                self._done += len(batch)
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        by_table = {}
+        order = []
+        for table_name, key, value, levelno, rows in batch:
+            rows = ((table_name, key, value),) + rows
+            for table_name, key, value in rows:
+                if table_name not in by_table:
+                    by_table[table_name] = []
+                    order.append(table_name)
+                by_table[table_name].append((key, value))
+        for table_name in order:
+            pairs = by_table[table_name]
+            if self.segment_size and table_name in self.segment_tables:
+                pairs = segment.pack(pairs, self.segment_size)
+            if self.spill is not None and self.spill.diverting():
+                self.spill.append([(table_name, k, v) for (k, v) in pairs])
+                continue
+            start = time.time()
+            try:
+                self.storage.put(table_name, *pairs)
+            except Exception:
+                if self.stats is not None:
+                    self.stats.record_put(time.time() - start, len(pairs),
+                                          0, failed=True)
+                self.error_callback(
+                    sys.exc_info(),
+                    [(table_name, k, v) for (k, v) in pairs])
+            else:
+                elapsed = time.time() - start
+                if self.stats is not None:
+                    self.stats.record_put(elapsed, len(pairs),
+                                          sum(len(v) for k, v in pairs))
+                if self.spill is not None:
+                    self.spill.observe(elapsed)
+
+    @staticmethod
+    def _print_error(exc_info, triples):
+        sys.stderr.write('dblogger: failed to write %d log records\n'
+                         % len(triples))
+        traceback.print_exception(*exc_info)
+
+
+@atexit.register
+def _close_all_writers():
+    writers = list(_live_writers)
+    for writer in writers:
+        if writer.close_callback is not None:
+            try:
+                writer.close_callback()
+            except Exception:
+                traceback.print_exc()
+    for writer in writers:
+        writer.close(writer.close_timeout)
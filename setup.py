@@ -142,6 +142,9 @@ setup(
     entry_points={
         'console_scripts': [
             'dblogger = dblogger.query:main',
+            'dblogger-retention = dblogger.retention:main',
+            'dblogger-collector = dblogger.collector:main',
+            'dblogger-benchmark = dblogger.benchmark:main',
         ]
     },
 )